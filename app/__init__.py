@@ -5,7 +5,7 @@ import time
 import socket
 import datetime
 from bs4 import BeautifulSoup
-from flask import Flask, url_for, g, request
+from flask import Flask, url_for, g, request, get_flashed_messages
 from flask_login import LoginManager, current_user
 from flask_webpack import Webpack
 from flask_babel import Babel, _
@@ -70,7 +70,7 @@ def create_app():
                                'url_for': url_for, 'asset_url_for': webpack.asset_url_for, 'func': misc,
                                'form': forms, 'hostname': socket.gethostname(), 'datetime': datetime,
                                'e': escape_html, 'markdown': misc.our_markdown, '_': _, 'get_locale': get_locale,
-                               'BeautifulSoup': BeautifulSoup})
+                               'BeautifulSoup': BeautifulSoup, 'get_flashed_messages': get_flashed_messages})
 
     if app.config['TESTING']:
         import logging
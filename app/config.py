@@ -29,6 +29,13 @@ cfg_defaults = { # key => default value
         "cache": {
             "type": "null"
         },
+        "search": {
+            "backend": "database"
+        },
+        "votes": {
+            "write_behind": False,
+            "flush_interval": 5
+        },
         "sendgrid": {
             "api_key": '',
             "default_from": 'noreply@shitposting.space',
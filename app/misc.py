@@ -18,8 +18,10 @@ import bcrypt
 import tinycss2
 from captcha.image import ImageCaptcha
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 from io import BytesIO
 from PIL import Image
+import numpy
 from bs4 import BeautifulSoup
 from functools import update_wrapper
 import misaka as m
@@ -33,12 +35,13 @@ from flask_babel import _
 from .caching import cache
 from .socketio import socketio
 from .badges import badges
+from . import ranking, search, sitestats, unread, userstats, votebuffer, voteundo
 
 from .models import Sub, SubPost, User, SiteMetadata, SubSubscriber, Message, UserMetadata
 from .models import SubPostVote, SubPostComment, SubPostCommentVote, SiteLog, SubLog, db
 from .models import SubMetadata, rconn, SubStylesheet, UserIgnores, SubUploads, SubFlair
 from .models import SubMod, SubBan
-from peewee import JOIN, fn, SQL, NodeList
+from peewee import JOIN, fn, Case, IntegrityError
 import requests
 import logging
 
@@ -90,8 +93,15 @@ class SiteUser(object):
                 if i not in self.top_bar:
                     self.top_bar.append(i)
 
+        # For membership checks
+        self.subscribed_sids = set(self.subsid)
+        self.subscribed_names = set(self.subscriptions)
+        self.blocked_sids = set(self.blocksid)
+
         self.score = self.user['score']
         self.given = self.user['given']
+        # Snapshots cached before we had xp don't have it
+        self.xp = self.user.get('xp')
         # If status is not 0, user is banned
         if self.user['status'] != 0:
             self.is_active = False
@@ -142,13 +152,13 @@ class SiteUser(object):
     def has_subscribed(self, name):
         """ Returns True if the current user has subscribed to sub """
         if len(name) == 36:  # TODO: BAD NASTY HACK REMOVE THIS.
-            return name in self.subsid
+            return name in self.subscribed_sids
         else:
-            return name in self.subscriptions
+            return name in self.subscribed_names
 
     def has_blocked(self, sid):
         """ Returns True if the current user has blocked sub """
-        return sid in self.blocksid
+        return sid in self.blocked_sids
 
     def likes_scroll(self):
         """ Returns true if user likes scroll """
@@ -158,10 +168,9 @@ class SiteUser(object):
         """ Returns true if user selects to block sub styles """
         return 'nostyles' in self.prefs
 
-    @cache.memoize(300)
     def get_user_level(self):
         """ Returns the level and xp of a user. """
-        return get_user_level(self.uid, self.score)
+        return get_user_level(self.uid, self.xp)
 
     def get_top_bar(self):
         return self.top_bar
@@ -175,13 +184,14 @@ class SiteUser(object):
             umd.save()
         except UserMetadata.DoesNotExist:
             UserMetadata.create(uid=self.uid, key=key, value=value)
+        invalidate_user_cache(self.uid)
 
     @cache.memoize(30)
     def get_global_stylesheet(self):
         if self.subtheme:
             try:
-                css = SubStylesheet.select().join(Sub).where(fn.Lower(Sub.name) == self.subtheme.lower()).get()
-            except SubStylesheet.DoesNotExist:
+                css = SubStylesheet.get(SubStylesheet.sid == get_sid(self.subtheme))
+            except (SubStylesheet.DoesNotExist, Sub.DoesNotExist):
                 return ''
             return css.content
         return ''
@@ -334,31 +344,54 @@ def reset_ratelimit(per, scope_func=lambda: get_ip(), key_func=lambda: request.e
     redis.delete(key)
 
 
-def safeRequest(url, recieve_timeout=10):
-    """ Gets stuff for the internet, with timeouts and size restrictions """
+def safeRequest(url, recieve_timeout=10, content_types=None, stop_when=None, chunk_size=65536):
+    """ Gets stuff for the internet, with timeouts and size restrictions
+    @param content_types: if present, a tuple of accepted content types (or prefixes, like 'image/'). Other responses
+    raise ValueError before the body is downloaded.
+    @param stop_when: if present, called after every chunk with the response, the data received so far and the
+    offset where the last chunk starts. The download stops (and returns what was received) when it returns True.
+    """
     # Returns (Response, File)
     max_size = 25000000  # won't download more than 25MB
     try:
         r = requests.get(url, stream=True, timeout=recieve_timeout, headers={'User-Agent': 'Throat/1 (Phuks)'})
     except:
         raise ValueError('error fetching')
-    r.raise_for_status()
+    try:
+        r.raise_for_status()
 
-    if int(r.headers.get('Content-Length', 1)) > max_size:
-        raise ValueError('response too large')
+        if int(r.headers.get('Content-Length', 1)) > max_size:
+            raise ValueError('response too large')
 
-    size = 0
-    start = time.time()
-    f = b''
-    for chunk in r.iter_content(1024):
-        if time.time() - start > recieve_timeout:
-            raise ValueError('timeout reached')
+        if content_types and not r.headers.get('content-type', '').split(";")[0].lower().startswith(content_types):
+            raise ValueError('unexpected content type')
+
+        start = time.time()
+        f = bytearray()
+        for chunk in r.iter_content(chunk_size):
+            if time.time() - start > recieve_timeout:
+                raise ValueError('timeout reached')
+
+            offset = len(f)
+            f += chunk
+            if len(f) > max_size:
+                raise ValueError('response too large')
+            if stop_when and stop_when(r, f, offset):
+                break
+    finally:
+        r.close()
+    return r, bytes(f)
 
-        size += len(chunk)
-        f += chunk
-        if size > max_size:
-            raise ValueError('response too large')
-    return r, f
+
+RE_HEAD_END = re.compile(rb'</head\s*>', re.IGNORECASE)
+
+
+def html_head_received(response, data, offset):
+    """ stop_when for safeRequest: stops HTML downloads once we got the whole <head> (title, OpenGraph tags, etc) """
+    if 'html' not in response.headers.get('content-type', '').lower():
+        return False
+    # Only look at the last chunk (plus a few bytes in case the tag was split between chunks)
+    return RE_HEAD_END.search(data, max(0, offset - 8)) is not None
 
 
 RE_AMENTION_BARE = r'(?<=^|(?<=[^a-zA-Z0-9-_\.]))((@|\/u\/|\/' + config.site.sub_prefix + r'\/)([A-Za-z0-9\-\_]+))'
@@ -403,9 +436,9 @@ md = m.Markdown(PhuksDown(sanitization_mode='escape'),
                             'superscript'])
 
 
-def our_markdown(text):
+def render_markdown(text):
     """ Here we create a custom markdown function where we load all the
-    extensions we need. """
+    extensions we need. Use our_markdown instead unless the text is a one-off (like a preview). """
 
     def repl(match):
         if match.group(3) is None:
@@ -428,6 +461,32 @@ def our_markdown(text):
         return '> tfw tried to break the site'
 
 
+# Rendered markdown is cached by a hash of the source text, so edits never need to invalidate anything.
+# Bump the version if the renderer's output changes.
+MARKDOWN_CACHE_VERSION = 1
+MARKDOWN_CACHE_SIZE = 2048
+MARKDOWN_CACHE_TTL = 86400
+_markdown_cache = OrderedDict()
+
+
+def our_markdown(text):
+    """ Renders markdown. Results are cached in-process (LRU) and in redis """
+    key = 'markdown/{0}/{1}'.format(MARKDOWN_CACHE_VERSION, hashlib.sha1(text.encode()).hexdigest())
+    html = _markdown_cache.pop(key, None)
+    if html is None:
+        html = redis.get(key)
+        if html is None:
+            html = render_markdown(text)
+            redis.setex(key, MARKDOWN_CACHE_TTL, html)
+        else:
+            html = html.decode()
+
+    _markdown_cache[key] = html
+    while len(_markdown_cache) > MARKDOWN_CACHE_SIZE:
+        _markdown_cache.popitem(last=False)
+    return html
+
+
 @cache.memoize(5)
 def is_sub_banned(sub, user=None, uid=None):
     """ Returns True if 'user' is banned 'sub' """
@@ -555,27 +614,28 @@ def workWithMentions(data, receivedby, post, sub, cid=None, c_user=current_user)
         else:
             mts = mts[:5]
 
-        for mtn in mts:
-            # Send notifications.
-            try:
-                user = User.get(fn.Lower(User.name) == mtn.lower())
-            except User.DoesNotExist:
-                continue
-            if user.uid != c_user.uid and user.uid != receivedby:
-                # Checks done. Send our shit
-                if cid:
-                    link = url_for('sub.view_perm', pid=post.pid, sub=subname, cid=cid)
-                else:
-                    link = url_for('sub.view_post', pid=post.pid, sub=subname)
-                create_message(c_user.uid, user.uid,
-                               subject="You've been tagged in a post",
-                               content="@{0} tagged you in [{1}]({2})"
-                               .format(c_user.name, "Here: " + post.title, link),
-                               link=link, mtype=8)
-                socketio.emit('notification',
-                              {'count': get_notification_count(user.uid)},
-                              namespace='/snt',
-                              room='user' + user.uid)
+        if not mts:
+            return
+
+        # Send notifications.
+        uids = [uid for uid in get_uids(mts) if uid != c_user.uid and uid != receivedby]
+        if not uids:
+            return
+
+        # Checks done. Send our shit
+        if cid:
+            link = url_for('sub.view_perm', pid=post.pid, sub=subname, cid=cid)
+        else:
+            link = url_for('sub.view_post', pid=post.pid, sub=subname)
+        posted = datetime.utcnow()
+        content = "@{0} tagged you in [{1}]({2})".format(c_user.name, "Here: " + post.title, link)
+        Message.insert_many([{'sentby': c_user.uid, 'receivedby': uid, 'subject': "You've been tagged in a post",
+                              'mlink': link, 'content': content, 'posted': posted, 'mtype': 8}
+                             for uid in uids]).execute()
+        unread.incr_many(uids, 8)
+
+        for uid, count in get_notification_counts(uids).items():
+            socketio.emit('notification', {'count': count}, namespace='/snt', room='user' + uid)
 
 
 def getUser(uid):
@@ -583,11 +643,56 @@ def getUser(uid):
     return User.select().where(User.uid == uid).dicts().get()
 
 
-@cache.memoize(5)
 def getDomain(link):
     """ Gets Domain from url """
-    x = urlparse(link)
-    return x.netloc
+    return get_link_domain(link)
+
+
+# Public suffixes with more than one label (we don't ship the whole public suffix list). Registrable domains
+# under these get one more label, so 'news.bbc.co.uk' groups under 'bbc.co.uk' and not 'co.uk'.
+MULTI_LABEL_SUFFIXES = frozenset((
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk', 'sch.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'co.nz', 'net.nz', 'org.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'co.kr', 'or.kr', 'co.in', 'net.in', 'org.in',
+    'com.br', 'net.br', 'org.br', 'gov.br', 'com.ar', 'com.mx', 'com.cn', 'net.cn', 'org.cn',
+    'com.tw', 'com.hk', 'com.sg', 'com.tr', 'com.ua', 'com.pl', 'co.il', 'co.za',
+    'github.io', 'gitlab.io', 'blogspot.com', 'appspot.com', 'herokuapp.com', 'wordpress.com', 'tumblr.com',
+))
+
+
+def get_link_host(link):
+    """ Returns the host of a link: lowercase, without credentials, port or trailing dot.
+    Returns None if the link has no host. """
+    try:
+        host = urlparse(link).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return host.rstrip('.') or None
+
+
+def get_link_domain(link):
+    """ Returns the normalized host of a link: what get_link_host returns, without a leading 'www.'.
+    Returns None if the link has no host. This is what we store in SubPost.domain """
+    host = get_link_host(link)
+    if not host:
+        return None
+    if host.startswith('www.'):
+        host = host[4:]
+    return host[:255] or None
+
+
+def get_base_domain(domain):
+    """ Returns the registrable domain (eTLD+1) of a normalized domain. This is what we store in SubPost.base_domain """
+    if not domain:
+        return None
+    labels = domain.split('.')
+    if ':' in domain or labels[-1].isdigit():  # IP address
+        return domain
+    if len(labels) > 2 and '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
 
 
 @cache.memoize(300)
@@ -610,30 +715,72 @@ def isVideo(link):
     return link.lower().endswith(suffix)
 
 
-@cache.memoize(10)
-def get_user_level(uid, score=None):
-    """ Returns the user's level and XP as a tuple (level, xp) """
-    if not score:
-        user = User.get(User.uid == uid)
-        xp = user.score
-    else:
-        xp = score
-    userbadges = getUserBadges(uid)
-    for badge in userbadges:
-        xp += badge['score']
+def get_level(xp):
+    """ Returns the level that corresponds to `xp` and the xp as a tuple (level, xp) """
     if xp <= 0:  # We don't want to do the sqrt of a negative number
         return 0, xp
     level = math.sqrt(xp / 10)
     return int(level), xp
 
 
-def _image_entropy(img):
-    """calculate the entropy of an image"""
-    hist = img.histogram()
-    hist_size = sum(hist)
-    hist = [float(h) / hist_size for h in hist]
+def get_user_level(uid, xp=None):
+    """ Returns the user's level and XP as a tuple (level, xp). Pass `xp` if you already have it """
+    if xp is not None:
+        return get_level(xp)
+    return get_user_levels([uid]).get(uid, (0, 0))
+
 
-    return -sum(p * math.log(p, 2) for p in hist if p != 0)
+def get_user_levels(uids):
+    """ Same as get_user_level for several users at once. Returns a uid -> (level, xp) dict """
+    users = list(User.select(User.uid, User.xp).where(User.uid << list(uids)).dicts())
+    return {x['uid']: get_level(x['xp']) for x in votebuffer.merge('user', users, 'uid')}
+
+
+def update_user_xp(*uids):
+    """ Recalculates the xp of the given users (everybody's if no uids are given) from their score and badges.
+    Call it after giving or taking badges away; score changes update the xp along with the score. """
+    badge_score = Case(UserMetadata.value, [(k, v['score']) for k, v in badges.items()], 0)
+    bonus = UserMetadata.select(fn.COALESCE(fn.SUM(badge_score), 0)).where(
+        (UserMetadata.uid == User.uid) & (UserMetadata.key == 'badge'))
+    query = User.update(xp=User.score + bonus)
+    if uids:
+        query = query.where(User.uid << uids)
+    query.execute()
+    if uids:
+        invalidate_user_cache(*uids)
+
+
+# Values handled at once by smart_crop, so its memory use doesn't grow with the size of the image
+SMART_CROP_CHUNK = 1 << 20
+
+
+def smart_crop(im):
+    """ Crops a tall RGB image to a square, keeping the window of rows with the most entropy """
+    x, y = im.size
+    if y <= x:
+        return im
+
+    # Entropy of every row (log2(n) - sum(c * log2(c)) / n, with a lookup table for c * log2(c)), from the
+    # histogram of the row (256 bins per channel, like Image.histogram). Done a few rows at a time, converting
+    # only those rows to an array.
+    n = x * 3
+    clogc = numpy.arange(n + 1, dtype=numpy.float64)
+    clogc[1:] *= numpy.log2(clogc[1:])
+    channels = numpy.arange(3, dtype=numpy.uint16) * 256
+    rows = max(1, SMART_CROP_CHUNK // n)
+    entropy = numpy.empty(y, dtype=numpy.float64)
+    for start in range(0, y, rows):
+        chunk = numpy.asarray(im.crop((0, start, x, min(start + rows, y))))
+        count = len(chunk)
+        bins = (chunk + channels).reshape(count, n).astype(numpy.intp)
+        bins += numpy.arange(count, dtype=numpy.intp)[:, None] * 768
+        hist = numpy.bincount(bins.ravel(), minlength=count * 768).reshape(count, 768)
+        entropy[start:start + count] = numpy.log2(n) - clogc[hist].sum(axis=1) / n
+
+    # The sum of every window of `x` rows using cumulative sums
+    totals = numpy.concatenate(([0], numpy.cumsum(entropy)))
+    top = int(numpy.argmax(totals[x:] - totals[:-x]))
+    return im.crop((0, top, x, top + x))
 
 
 THUMB_NAMESPACE = uuid.UUID('f674f09a-4dcf-4e4e-a0b2-79153e27e387')
@@ -644,7 +791,8 @@ def get_thumbnail(link):
     """ Tries to fetch a thumbnail """
     # 1 - Check if it's an image
     try:
-        req = safeRequest(link)
+        req = safeRequest(link, content_types=('image/gif', 'image/jpeg', 'image/png', 'text/html'),
+                          stop_when=html_head_received)
     except (requests.exceptions.RequestException, ValueError):
         return ''
     ctype = req[0].headers.get('content-type', '').split(";")[0].lower()
@@ -663,13 +811,13 @@ def get_thumbnail(link):
             return ''
         try:
             img = urljoin(link, og('meta', {'property': 'og:image'})[0].get('content'))
-            req = safeRequest(img)
+            req = safeRequest(img, content_types=('image/',))
             im = Image.open(BytesIO(req[1])).convert('RGB')
         except (OSError, ValueError, IndexError):
             # no image, try fetching just the favicon then
             try:
                 img = urljoin(link, og('link', {'rel': 'icon'})[0].get('href'))
-                req = safeRequest(img)
+                req = safeRequest(img, content_types=('image/',))
                 im = Image.open(BytesIO(req[1]))
                 n_im = Image.new("RGBA", im.size, "WHITE")
                 n_im.paste(im, (0, 0), im)
@@ -679,19 +827,7 @@ def get_thumbnail(link):
     else:
         return ''
 
-    x, y = im.size
-    while y > x:
-        slice_height = min(y - x, 10)
-        bottom = im.crop((0, y - slice_height, x, y))
-        top = im.crop((0, 0, x, slice_height))
-
-        if _image_entropy(bottom) < _image_entropy(top):
-            im = im.crop((0, 0, x, y - slice_height))
-        else:
-            im = im.crop((0, slice_height, x, y))
-
-        x, y = im.size
-
+    im = smart_crop(im)
     im.thumbnail((70, 70), Image.ANTIALIAS)
     im.seek(0)
     md5 = hashlib.md5(im.tobytes())
@@ -765,7 +901,8 @@ def getSinglePost(pid):
     if current_user.is_authenticated:
         posts = SubPost.select(SubPost.nsfw, SubPost.sid, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted,
                                SubPost.score, SubPost.upvotes, SubPost.downvotes,
-                               SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'),
+                               SubPost.thumbnail, SubPost.link, SubPost.domain,
+                               User.name.alias('user'), Sub.name.alias('sub'),
                                SubPost.flair, SubPost.edited,
                                SubPost.comments, SubPostVote.positive, User.uid, User.status.alias('userstatus'),
                                SubPost.deleted, SubPost.ptype)
@@ -775,20 +912,22 @@ def getSinglePost(pid):
     else:
         posts = SubPost.select(SubPost.nsfw, SubPost.sid, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted,
                                SubPost.score, SubPost.upvotes, SubPost.downvotes,
-                               SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'),
+                               SubPost.thumbnail, SubPost.link, SubPost.domain,
+                               User.name.alias('user'), Sub.name.alias('sub'),
                                SubPost.flair, SubPost.edited,
                                SubPost.comments, User.uid, User.status.alias('userstatus'), SubPost.deleted,
                                SubPost.ptype)
     posts = posts.join(User, JOIN.LEFT_OUTER).switch(SubPost).join(Sub, JOIN.LEFT_OUTER).where(
         SubPost.pid == pid).dicts().get()
-    return posts
+    return votebuffer.merge('post', [posts], 'pid')[0]
 
 
 def postListQueryBase(*extra, nofilter=False, noAllFilter=False, noDetail=False, adminDetail=False):
     if current_user.is_authenticated and not noDetail:
         posts = SubPost.select(SubPost.nsfw, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted,
                                SubPost.deleted, SubPost.score, SubPost.ptype,
-                               SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'),
+                               SubPost.thumbnail, SubPost.link, SubPost.domain,
+                               User.name.alias('user'), Sub.name.alias('sub'),
                                SubPost.flair, SubPost.edited, Sub.sid,
                                SubPost.comments, SubPostVote.positive, User.uid, User.status.alias('userstatus'),
                                *extra)
@@ -798,7 +937,8 @@ def postListQueryBase(*extra, nofilter=False, noAllFilter=False, noDetail=False,
     else:
         posts = SubPost.select(SubPost.nsfw, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted,
                                SubPost.deleted, SubPost.score, SubPost.ptype,
-                               SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'),
+                               SubPost.thumbnail, SubPost.link, SubPost.domain,
+                               User.name.alias('user'), Sub.name.alias('sub'),
                                SubPost.flair, SubPost.edited, Sub.sid,
                                SubPost.comments, User.uid, User.status.alias('userstatus'), *extra)
     posts = posts.join(User, JOIN.LEFT_OUTER).switch(SubPost).join(Sub, JOIN.LEFT_OUTER)
@@ -821,22 +961,145 @@ def postListQueryHome(noDetail=False, nofilter=False):
             SubPost.sid == SiteMetadata.value)
 
 
+def get_hot_score(score, posted):
+    """ Returns the hot ranking of a post. This is what gets stored in `SubPost.hot` """
+    return score * 20 + (posted.replace(tzinfo=timezone.utc).timestamp() - 1134028003) / 1500
+
+
 def getPostList(baseQuery, sort, page):
     if sort == "top":
-        posts = baseQuery.order_by(SubPost.score.desc()).paginate(page, 25)
+        posts = baseQuery.order_by(SubPost.score.desc(), SubPost.pid.desc()).paginate(page, 25)
     elif sort == "new":
         posts = baseQuery.order_by(SubPost.pid.desc()).paginate(page, 25)
     else:
-        if config.database.engine == "PostgresqlDatabase":
-            hot = SubPost.score * 20 + (fn.EXTRACT(NodeList((SQL('EPOCH FROM'), SubPost.posted))) - 1134028003) / 1500
-            posts = baseQuery.order_by(hot.desc()).limit(100).paginate(page, 25)
+        posts = baseQuery.order_by(SubPost.hot.desc(), SubPost.pid.desc()).limit(100).paginate(page, 25)
+    return posts
+
+
+def _post_sort_key(sort):
+    """ Returns the column used to sort a post listing """
+    if sort == "top":
+        return SubPost.score
+    elif sort == "hot":
+        return SubPost.hot
+    return SubPost.pid
+
+
+def getPostListAfter(baseQuery, sort, after=None, limit=25):
+    """ Like getPostList, but paginated by keyset instead of OFFSET. `after` is the (sort key, pid) tuple of the
+    last post of the previous page (see decode_post_cursor) or None to get the first page.
+    Fetches `limit` + 1 rows so the caller can tell if there are more pages. """
+    key = _post_sort_key(sort)
+    if after:
+        if key is SubPost.pid:
+            baseQuery = baseQuery.where(SubPost.pid < after[1])
         else:
-            posts = baseQuery.order_by(
-                (SubPost.score * 20 + (fn.Unix_Timestamp(SubPost.posted) - 1134028003) / 1500).desc()).limit(
-                100).paginate(page, 25)
+            baseQuery = baseQuery.where((key < after[0]) | ((key == after[0]) & (SubPost.pid < after[1])))
+    if key is SubPost.pid:
+        return baseQuery.order_by(SubPost.pid.desc()).limit(limit + 1)
+    return baseQuery.order_by(key.desc(), SubPost.pid.desc()).limit(limit + 1)
+
+
+def encode_post_cursor(post, sort):
+    """ Returns an opaque token pointing right after `post` (a dict) on a listing sorted by `sort` """
+    key = {'top': 'score', 'hot': 'hot', 'relevance': 'relevance'}.get(sort, 'pid')
+    return base64.urlsafe_b64encode(json.dumps([post[key], post['pid']]).encode()).decode()
+
+
+def decode_post_cursor(token):
+    """ Returns the (sort key, pid) tuple stored in a token created by encode_post_cursor.
+    Raises ValueError if the token is not valid. """
+    try:
+        key, pid = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(pid, int) or not isinstance(key, (int, float)):
+        raise ValueError('invalid cursor')
+    return key, pid
+
+
+# Max. number of pids read from the rankings or the search index at once by getRankedPostList and getSearchPostList
+RANKED_CHUNK = 500
+
+
+def getRankedPostList(baseQuery, sort, page, sids=None):
+    """ Same as getPostList, but takes the page of posts from the redis rankings when they're available.
+    `sids` is the sid or list of sids the listing is made of, or None for the whole site.
+    The rankings are the same for everybody, so the posts `baseQuery` filters out (blocked subs, nsfw) are skipped
+    and the page is filled up with the ones that follow them.
+    Returns a list of dicts. """
+    per_page = ranking.PER_PAGE
+    start = (page - 1) * per_page
+    offset = 0
+    skipped = 0
+    posts = []
+    # Count the posts of the previous pages without loading them
+    while skipped < start:
+        pids = ranking.get_range(sort, offset, min(start - skipped, RANKED_CHUNK), sids)
+        if pids is None:
+            return votebuffer.merge('post', list(getPostList(baseQuery, sort, page).dicts()), 'pid')
+        if not pids:
+            return []
+        skipped += baseQuery.select(SubPost.pid).where(SubPost.pid << pids).count()
+        offset += len(pids)
+
+    count = per_page
+    while len(posts) < per_page:
+        pids = ranking.get_range(sort, offset, count, sids)
+        if pids is None:
+            if offset == 0:
+                return votebuffer.merge('post', list(getPostList(baseQuery, sort, page).dicts()), 'pid')
+            break
+        if not pids:
+            break
+        found = {x['pid']: x for x in baseQuery.where(SubPost.pid << pids).dicts()}
+        posts += [found[pid] for pid in pids if pid in found][:per_page - len(posts)]
+        if len(pids) < count:
+            break
+        offset += len(pids)
+        # Some were filtered out, so there will probably be more of them
+        count = min((per_page - len(posts)) * 2, RANKED_CHUNK)
+    return votebuffer.merge('post', posts, 'pid')
+
+
+def getSearchPostList(baseQuery, term, page=1, after=None, limit=25):
+    """ Returns a list of dicts with the posts matching `term`, the most relevant first. Every post gets a
+    'relevance' key. `after` is a cursor created by encode_post_cursor(post, 'relevance').
+    Like in getRankedPostList, the matches `baseQuery` filters out are skipped and the list is filled up with
+    the ones that follow them, so a list shorter than `limit` means there are no more results. """
+    skip = 0 if after else (page - 1) * limit
+    posts = []
+    # Count the posts of the previous pages without loading them
+    while skip > 0:
+        results = search.search(term, min(skip, RANKED_CHUNK), after)
+        if not results:
+            return []
+        after = (results[-1][1], results[-1][0])
+        skip -= baseQuery.select(SubPost.pid).where(SubPost.pid << [pid for pid, _ in results]).count()
+
+    count = limit
+    while len(posts) < limit:
+        results = search.search(term, count, after)
+        if not results:
+            break
+        relevance = dict(results)
+        found = {x['pid']: dict(x, relevance=relevance[x['pid']])
+                 for x in baseQuery.where(SubPost.pid << list(relevance)).dicts()}
+        posts += [found[pid] for pid, _ in results if pid in found][:limit - len(posts)]
+        if len(results) < count:
+            break
+        after = (results[-1][1], results[-1][0])
+        count = min((limit - len(posts)) * 2, RANKED_CHUNK)
     return posts
 
 
+def getHomeSids():
+    """ Returns the sids of the subs shown in the home page """
+    if current_user.is_authenticated:
+        return current_user.subsid
+    return [x['sid'] for x in getDefaultSubs()]
+
+
 @cache.memoize(600)
 def getAnnouncementPid():
     return SiteMetadata.select().where(SiteMetadata.key == 'announcement').get()
@@ -873,32 +1136,144 @@ def getStickies(sid):
     return posts
 
 
-def load_user(user_id):
-    user = User.select(fn.Count(Message.mid).alias('notifications'),
-                       User.given, User.score, User.name, User.uid, User.status, User.email, User.language)
-    user = user.join(Message, JOIN.LEFT_OUTER, on=(
-            (Message.receivedby == User.uid) & (Message.mtype != 6) & (Message.mtype != 9) &
-            (Message.mtype != 41) & Message.read.is_null(True))).switch(User)
-    user = user.group_by(User.uid).where(User.uid == user_id).dicts().get()
-
-    if request.path == '/socket.io/':
-        return SiteUser(user, [], [])
+# load_user keeps a snapshot of every user (the user row, prefs and subscriptions) in redis and a copy of the most
+# recent ones in-process. Snapshots are versioned: anything that changes them must call invalidate_user_cache,
+# which bumps the version and makes everybody rebuild it.
+USER_SNAPSHOT_TTL = 600
+USER_SNAPSHOT_LRU_SIZE = 1024
+_user_snapshots = OrderedDict()
+
+
+def invalidate_user_cache(*uids):
+    """ Discards the cached snapshots of the given users """
+    p = redis.pipeline()
+    for uid in uids:
+        p.incr('user/{0}/version'.format(uid))
+    p.execute()
+
+
+def _build_user_snapshot(user_id):
+    user = User.select(User.given, User.score, User.xp, User.name, User.uid, User.status, User.email,
+                       User.language)
+    user = user.where(User.uid == user_id).dicts().get()
+
+    prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(UserMetadata.uid == user_id)
+    prefs = prefs.where((UserMetadata.value == '1') | (UserMetadata.key == 'subtheme')).dicts()
+
+    subs = SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status).join(Sub, on=(
+            Sub.sid == SubSubscriber.sid)).switch(SubSubscriber).where(SubSubscriber.uid == user_id)
+    subs = subs.order_by(SubSubscriber.order.asc()).dicts()
+    return {'user': user, 'prefs': list(prefs), 'subs': list(subs)}
+
+
+def get_user_snapshot(user_id):
+    """ Returns the cached snapshot of a user used to build SiteUser. Raises User.DoesNotExist """
+    version = redis.get('user/{0}/version'.format(user_id))
+    version = version.decode() if version else '0'
+
+    cached = _user_snapshots.pop(user_id, None)
+    if cached and cached[0] == version:
+        snapshot = cached[1]
     else:
-        prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(UserMetadata.uid == user_id)
-        prefs = prefs.where((UserMetadata.value == '1') | (UserMetadata.key == 'subtheme')).dicts()
+        key = 'user/{0}/snapshot/{1}'.format(user_id, version)
+        snapshot = redis.get(key)
+        if snapshot:
+            snapshot = json.loads(snapshot.decode())
+        else:
+            snapshot = _build_user_snapshot(user_id)
+            redis.setex(key, USER_SNAPSHOT_TTL, json.dumps(snapshot))
 
-        try:
-            subs = SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status).join(Sub, on=(
-                    Sub.sid == SubSubscriber.sid)).switch(SubSubscriber).where(SubSubscriber.uid == user_id)
-            subs = subs.order_by(SubSubscriber.order.asc()).dicts()
-            return SiteUser(user, subs, prefs)
-        except User.DoesNotExist:
-            return None
+    _user_snapshots[user_id] = (version, snapshot)
+    while len(_user_snapshots) > USER_SNAPSHOT_LRU_SIZE:
+        _user_snapshots.popitem(last=False)
+    return snapshot
+
+
+def load_user(user_id):
+    try:
+        snapshot = get_user_snapshot(user_id)
+    except User.DoesNotExist:
+        return None
+    user = dict(snapshot['user'], notifications=get_notification_count(user_id))
+    votebuffer.merge('user', [user], 'uid')
+    return SiteUser(user, snapshot['subs'], snapshot['prefs'])
 
 
 def get_notification_count(uid):
-    return Message.select().where((Message.receivedby == uid) & (Message.mtype != 6) & (Message.mtype != 9) & (
-            Message.mtype != 41) & Message.read.is_null(True)).count()
+    return unread.count(uid, exclude=(6, 9, 41))
+
+
+def get_notification_counts(uids):
+    """ Same as get_notification_count for several users at once. Returns a uid -> count dict """
+    return {uid: get_notification_count(uid) for uid in uids}
+
+
+# Sub and user names can't be renamed, so the lowercase name -> sid/uid mapping is cached in-process and in redis
+# without invalidation. Names that don't exist are never cached (they might get registered later).
+NAME_CACHE_TTL = 86400
+NAME_CACHE_LRU_SIZE = 8192
+_name_cache = OrderedDict()
+
+
+def _resolve_names(model, names):
+    """ Returns a lowercase name -> id dict for the given Sub or User names. Names that don't exist are left out """
+    kind, id_field = ('sub', Sub.sid) if model is Sub else ('user', User.uid)
+    names = list(set(x.lower() for x in names))
+    result = {}
+    missing = []
+    for name in names:
+        ident = _name_cache.pop((kind, name), None)
+        if ident is None:
+            missing.append(name)
+        else:
+            result[name] = ident
+
+    if missing:
+        cached = redis.mget(['name/{0}/{1}'.format(kind, x) for x in missing])
+        for name, ident in zip(list(missing), cached):
+            if ident:
+                result[name] = ident.decode()
+                missing.remove(name)
+
+    if missing:
+        rows = model.select(id_field, model.name).where(fn.Lower(model.name) << missing).tuples()
+        p = redis.pipeline()
+        for ident, name in rows:
+            result[name.lower()] = ident
+            p.setex('name/{0}/{1}'.format(kind, name.lower()), NAME_CACHE_TTL, ident)
+        p.execute()
+
+    for name, ident in result.items():
+        _name_cache[(kind, name)] = ident
+    while len(_name_cache) > NAME_CACHE_LRU_SIZE:
+        _name_cache.popitem(last=False)
+    return result
+
+
+def get_sid(name):
+    """ Returns the sid of a sub from its (case insensitive) name. Raises Sub.DoesNotExist """
+    try:
+        return _resolve_names(Sub, [name])[name.lower()]
+    except KeyError:
+        raise Sub.DoesNotExist
+
+
+def get_uid(name):
+    """ Returns the uid of a user from their (case insensitive) name. Raises User.DoesNotExist """
+    try:
+        return _resolve_names(User, [name])[name.lower()]
+    except KeyError:
+        raise User.DoesNotExist
+
+
+def get_sids(names):
+    """ Returns the sids of the subs that exist among `names` """
+    return list(_resolve_names(Sub, names).values())
+
+
+def get_uids(names):
+    """ Returns the uids of the users that exist among `names` """
+    return list(_resolve_names(User, names).values())
 
 
 def get_errors(form, first=False):
@@ -1101,29 +1476,20 @@ def upload_file(max_size=16777216):
     return f_name, True
 
 
-def getSubMods(sid):
-    modsquery = SubMod.select(User.uid, User.name, SubMod.power_level).join(User, on=(User.uid == SubMod.uid)).where(
-        SubMod.sid == sid)
-    modsquery = modsquery.where((User.status == 0) & (SubMod.invite == False))
+# getSubData and getSubMods are served from a per-sub snapshot stored in redis next to a version counter.
+# Anything that changes a sub's metadata, mods or stylesheet must call invalidate_sub_cache.
+SUB_SNAPSHOT_TTL = 3600
 
-    owner, mods, janitors, owner_uids, janitor_uids, mod_uids = ({}, {}, {}, [], [], [])
-    for i in modsquery:
-        if i.power_level == 0:
-            owner[i.uid] = i.user.name
-            owner_uids.append(i.uid)
-        elif i.power_level == 1:
-            mods[i.uid] = i.user.name
-            mod_uids.append(i.uid)
-        elif i.power_level == 2:
-            janitors[i.uid] = i.user.name
-            janitor_uids.append(i.uid)
 
-    if not owner:
-        owner['0'] = config.site.placeholder_account
-    return {'owners': owner, 'mods': mods, 'janitors': janitors, 'all': owner_uids + janitor_uids + mod_uids}
+def invalidate_sub_cache(*sids):
+    """ Discards the cached snapshots of the given subs """
+    p = redis.pipeline()
+    for sid in sids:
+        p.incr('sub/{0}/version'.format(sid))
+    p.execute()
 
 
-def getSubData(sid, simple=False, extra=False):
+def _build_sub_snapshot(sid):
     sdata = SubMetadata.select().where(SubMetadata.sid == sid)
     data = {'xmod2': [], 'sticky': []}
     for p in sdata:
@@ -1135,6 +1501,71 @@ def getSubData(sid, simple=False, extra=False):
         else:
             data[p.key] = p.value
 
+    xmods = []
+    if data.get('xmod2'):
+        xmods = list(User.select(User.uid, User.name).where((User.uid << data['xmod2']) & (User.status == 0)).dicts())
+
+    try:
+        creator = User.select(User.uid, User.name, User.status).where(User.uid == data.get('mod')).dicts().get()
+    except User.DoesNotExist:
+        creator = None
+
+    try:
+        stylesheet = SubStylesheet.get(SubStylesheet.sid == sid).content
+    except SubStylesheet.DoesNotExist:
+        stylesheet = ''
+
+    mods = SubMod.select(User.uid, User.name, SubMod.power_level).join(User, on=(User.uid == SubMod.uid)).where(
+        SubMod.sid == sid)
+    mods = mods.where((User.status == 0) & (SubMod.invite == False)).dicts()
+    return {'metadata': data, 'xmods': xmods, 'creator': creator, 'stylesheet': stylesheet, 'mods': list(mods)}
+
+
+def get_sub_snapshot(sid):
+    """ Returns the cached metadata, mods, creator and stylesheet of a sub """
+    version, snapshot = redis.mget('sub/{0}/version'.format(sid), 'sub/{0}/snapshot'.format(sid))
+    version = int(version) if version else 0
+    if snapshot:
+        snapshot = json.loads(snapshot.decode())
+        if snapshot['version'] == version:
+            return snapshot
+
+    snapshot = _build_sub_snapshot(sid)
+    snapshot['version'] = version
+    redis.setex('sub/{0}/snapshot'.format(sid), SUB_SNAPSHOT_TTL, json.dumps(snapshot))
+    return snapshot
+
+
+def get_modded_sids(uid):
+    """ Returns the sids of the subs a user moderates or created. Their snapshots include the user """
+    sids = set(x.sid_id for x in SubMod.select(SubMod.sid).where(SubMod.uid == uid))
+    sids.update(x.sid_id for x in SubMetadata.select(SubMetadata.sid).where(
+        (SubMetadata.key == 'mod') & (SubMetadata.value == uid)))
+    return sids
+
+
+def getSubMods(sid):
+    owner, mods, janitors, owner_uids, janitor_uids, mod_uids = ({}, {}, {}, [], [], [])
+    for i in get_sub_snapshot(sid)['mods']:
+        if i['power_level'] == 0:
+            owner[i['uid']] = i['name']
+            owner_uids.append(i['uid'])
+        elif i['power_level'] == 1:
+            mods[i['uid']] = i['name']
+            mod_uids.append(i['uid'])
+        elif i['power_level'] == 2:
+            janitors[i['uid']] = i['name']
+            janitor_uids.append(i['uid'])
+
+    if not owner:
+        owner['0'] = config.site.placeholder_account
+    return {'owners': owner, 'mods': mods, 'janitors': janitors, 'all': owner_uids + janitor_uids + mod_uids}
+
+
+def getSubData(sid, simple=False, extra=False):
+    snapshot = get_sub_snapshot(sid)
+    data = snapshot['metadata']
+
     if not simple:
         try:
             data['videomode']
@@ -1148,37 +1579,14 @@ def getSubData(sid, simple=False, extra=False):
 
         if extra:
             if data.get('xmod2'):
-                try:
-                    data['xmods'] = User.select(User.uid, User.name).where(
-                        (User.uid << data['xmod2']) & (User.status == 0)).dicts()
-                except User.DoesNotExist:
-                    data['xmods'] = []
+                data['xmods'] = snapshot['xmods']
 
-        try:
-            creator = User.select(User.uid, User.name, User.status).where(User.uid == data.get('mod')).dicts().get()
-        except User.DoesNotExist:
-            creator = {'uid': '0', 'name': 'Nobody'}
+        creator = snapshot['creator'] or {'uid': '0', 'name': 'Nobody'}
         data['creator'] = creator if creator.get('status', None) == 0 else {'uid': '0', 'name': _('[Deleted]')}
-
-        try:
-            data['stylesheet'] = SubStylesheet.get(SubStylesheet.sid == sid).content
-        except SubStylesheet.DoesNotExist:
-            data['stylesheet'] = ''
+        data['stylesheet'] = snapshot['stylesheet']
     return data
 
 
-@cache.memoize(5)
-def getUserGivenScore(uid):
-    pos = SubPostVote.select().where(SubPostVote.uid == uid).where(SubPostVote.positive == 1).count()
-    neg = SubPostVote.select().where(SubPostVote.uid == uid).where(SubPostVote.positive == 0).count()
-    cpos = SubPostCommentVote.select().where(SubPostCommentVote.uid == uid).where(
-        SubPostCommentVote.positive == 1).count()
-    cneg = SubPostCommentVote.select().where(SubPostCommentVote.uid == uid).where(
-        SubPostCommentVote.positive == 0).count()
-
-    return pos + cpos, neg + cneg, (pos + cpos) - (neg + cneg)
-
-
 # Note for future self:
 #  We keep constantly switching from camelCase to snake_case for function names.
 #  For fucks sake make your mind.
@@ -1250,8 +1658,10 @@ def pick_random_security_question():
 def create_message(mfrom, to, subject, content, link, mtype):
     """ Creates a message. """
     posted = datetime.utcnow()
-    return Message.create(sentby=mfrom, receivedby=to, subject=subject, mlink=link, content=content, posted=posted,
-                          mtype=mtype)
+    msg = Message.create(sentby=mfrom, receivedby=to, subject=subject, mlink=link, content=content, posted=posted,
+                         mtype=mtype)
+    unread.incr(to, mtype)
+    return msg
 
 
 try:
@@ -1351,17 +1761,80 @@ def create_sublog(action, uid, sid, comment='', link='', admin=False, target=Non
     SubLog.create(action=action, uid=uid, sid=sid, desc=comment, link=link, admin=admin, target=target).save()
 
 
+# Banned domains are compiled into a trie of their labels in reverse order ('news.example.com' is stored
+# as com -> example -> news) that every process keeps in memory. ban_domain and remove_banned_domain must call
+# invalidate_domain_bans, which bumps a version in redis and makes everybody rebuild it.
+DOMAIN_BANS_VERSION_KEY = 'domainbans/version'
+_domain_bans = (None, None)
+
+
+def invalidate_domain_bans():
+    redis.incr(DOMAIN_BANS_VERSION_KEY)
+
+
+def _build_domain_ban_trie():
+    trie = {}
+    for ban in SiteMetadata.select(SiteMetadata.value).where(SiteMetadata.key == 'banned_domain'):
+        # 'www.' is kept: banning www.example.com doesn't ban example.com
+        domain = get_link_host('//' + ban.value)
+        if not domain:
+            continue
+        node = trie
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[''] = domain  # labels are never empty, so this can't clash with a child
+    return trie
+
+
+def get_domain_ban_trie():
+    global _domain_bans
+    version = redis.get(DOMAIN_BANS_VERSION_KEY)
+    if _domain_bans[1] is None or _domain_bans[0] != version:
+        _domain_bans = (version, _build_domain_ban_trie())
+    return _domain_bans[1]
+
+
+def get_domain_ban(domain):
+    """ Returns the banned domain `domain` (a host, see get_link_host) falls under (itself or one of its
+    parents), or None if it's not banned """
+    node = get_domain_ban_trie()
+    for label in reversed(domain.split('.')):
+        node = node.get(label)
+        if node is None:
+            return None
+        if '' in node:
+            return node['']
+    return None
+
+
 def is_domain_banned(link):
-    bans = SiteMetadata.select().where(SiteMetadata.key == 'banned_domain')
-    banned_domains, banned_domains_b = ([], [])
-    for ban in bans:
-        banned_domains.append(ban.value)
-        banned_domains_b.append('.' + ban.value)
-
-    url = urlparse(link)
-    if (url.netloc in banned_domains) or (url.netloc.endswith(tuple(banned_domains_b))):
-        return True
-    return False
+    """ Returns True if the domain of the link or any of its parent domains is banned """
+    host = get_link_host(link)
+    return bool(host) and get_domain_ban(host) is not None
+
+
+def iter_domain_posts(domain, batch_size=500):
+    """ Yields, in batches of up to `batch_size`, the posts (not deleted) linking to `domain` or any of its
+    subdomains. Meant to re-scan existing posts after banning a domain without loading all of them at once. """
+    host = get_link_host('//' + domain)
+    domain = get_link_domain('//' + domain)
+    if not domain:
+        return
+    query = SubPost.select(SubPost.pid, SubPost.sid, SubPost.uid, SubPost.link, SubPost.domain)
+    query = query.where((SubPost.base_domain == get_base_domain(domain)) & (SubPost.deleted == 0))
+    if get_base_domain(domain) != domain:
+        query = query.where((SubPost.domain == domain) | SubPost.domain.endswith('.' + domain))
+    last = 0
+    while True:
+        posts = list(query.where(SubPost.pid > last).order_by(SubPost.pid).limit(batch_size))
+        if not posts:
+            return
+        last = posts[-1].pid
+        if host != domain:
+            # SubPost.domain has no 'www.', so for www.example.com we got the posts of example.com too
+            posts = [x for x in posts if ('.' + (get_link_host(x.link) or '')).endswith('.' + host)]
+        if posts:
+            yield posts
 
 
 def create_captcha():
@@ -1398,11 +1871,64 @@ def validate_captcha(token, response):
     return False
 
 
-def get_all_subs():
-    """ Temporary function until we work out a better autocomplete
-    for createpost """
-    # TODO
-    return [x.name for x in Sub.select(Sub.name)]
+COMMENT_PATH_SEGMENT = 8
+COMMENT_PATH_LENGTH = 255
+# get_comment_tree only shows this many levels of comments below the root (the last one as a "load more" link)
+COMMENT_TREE_DEPTH = 4
+
+
+def get_comment_path(cid, parent=None):
+    """ Returns the materialized path and depth of a new comment.
+    @param cid: the cid of the new comment
+    @param parent: the parent SubPostComment, if any
+    Every comment's path starts with the path of all its ancestors. When a thread gets too deep to fit
+    in the column we stop adding segments, so the deepest comments share the path of an ancestor
+    and subtree queries return a few extra rows (which build_comment_tree drops).
+    """
+    segment = hashlib.md5(str(cid).encode()).hexdigest()[:COMMENT_PATH_SEGMENT]
+    if parent is None:
+        return segment, 0
+    if len(parent.path) + COMMENT_PATH_SEGMENT > COMMENT_PATH_LENGTH:
+        return parent.path, parent.depth + 1
+    return parent.path + segment, parent.depth + 1
+
+
+def get_comment_subtree(pid, root=None, context=False):
+    """ Returns the cid and parentcid of the comments get_comment_tree needs to build a tree, sorted by score.
+    @param pid: the post's pid
+    @param root: the SubPostComment the tree starts on, or None for the whole post
+    @param context: if True, also fetch the parent of `root`
+    """
+    comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == pid)
+    if root is None:
+        comments = comments.where(SubPostComment.depth <= COMMENT_TREE_DEPTH)
+    else:
+        # Paths are hex strings, so everything that starts with root.path sorts between it and root.path + 'g'
+        subtree = (SubPostComment.path >= root.path) & (SubPostComment.path < root.path + 'g') & \
+                  (SubPostComment.depth <= root.depth + COMMENT_TREE_DEPTH)
+        if context and root.parentcid_id:
+            subtree = subtree | (SubPostComment.cid == root.parentcid_id)
+        comments = comments.where(subtree)
+    return comments.order_by(SubPostComment.score.desc()).dicts()
+
+
+def build_comment_tree(comments):
+    """ Builds a bare comment tree in a single pass.
+    @param comments: list of comments (dicts with at least cid and parentcid), in the order the siblings should have
+    @return: the list of top-level comments and a cid -> comment dict. Every comment gets a `children` list.
+    """
+    index = {}
+    for i in comments:
+        i['children'] = []
+        index[i['cid']] = i
+
+    tree = []
+    for i in comments:
+        if i['parentcid'] is None:
+            tree.append(i)
+        elif i['parentcid'] in index:
+            index[i['parentcid']]['children'].append(i)
+    return tree, index
 
 
 def get_comment_tree(comments, root=None, only_after=None, uid=None, provide_context=True):
@@ -1416,39 +1942,20 @@ def get_comment_tree(comments, root=None, only_after=None, uid=None, provide_con
     @param provide_context:
     """
 
-    def build_tree(tuff, rootcid=None):
-        """ Builds a comment tree """
-        res = []
-        for i in tuff[::]:
-            if i['parentcid'] == rootcid:
-                tuff.remove(i)
-                i['children'] = build_tree(tuff, rootcid=i['cid'])
-                res.append(i)
-        return res
-
     # 2 - Build bare comment tree
-    comment_tree = build_tree(list(comments))
+    comment_tree, comment_index = build_comment_tree(list(comments))
 
     # 2.1 - get only a branch of the tree if necessary
     if root:
-        def select_branch(commentslst, rootcid):
-            """ Finds a branch with a certain root and returns a new tree """
-            for i in commentslst:
-                if i['cid'] == rootcid:
-                    return i
-                k = select_branch(i['children'], rootcid)
-                if k:
-                    return k
-
-        comment_tree = select_branch(comment_tree, root)
+        comment_tree = comment_index.get(root)
         if comment_tree:
             # include the parent of the root for context.
             if comment_tree['parentcid'] is None or not provide_context:
                 comment_tree = [comment_tree]
             else:
-                orig_root = [x for x in list(comments) if x['cid'] == comment_tree['parentcid']]
-                orig_root[0]['children'] = [comment_tree]
-                comment_tree = orig_root
+                orig_root = comment_index[comment_tree['parentcid']]
+                orig_root['children'] = [comment_tree]
+                comment_tree = [orig_root]
         else:
             return []
     # 3 - Trim tree (remove all children of depth=3 comments, all siblings after #5
@@ -1467,7 +1974,7 @@ def get_comment_tree(comments, root=None, only_after=None, uid=None, provide_con
                     return []
                 or_len = len(tree)
                 trimmedtree = True
-        if depth > 3:
+        if depth >= COMMENT_TREE_DEPTH:
             return [{'cid': None, 'more': len(tree), 'pcid': pcid}] if tree else []
         if (len(tree) > 5 and depth > 0) or (len(tree) > 10):
             tree = tree[:6] if depth > 0 else tree[:11]
@@ -1495,7 +2002,7 @@ def get_comment_tree(comments, root=None, only_after=None, uid=None, provide_con
     if uid:
         expcomms = expcomms.join(SubPostCommentVote, JOIN.LEFT_OUTER,
                                  on=((SubPostCommentVote.uid == uid) & (SubPostCommentVote.cid == SubPostComment.cid)))
-    expcomms = expcomms.where(SubPostComment.cid << cid_list).dicts()
+    expcomms = votebuffer.merge('comment', list(expcomms.where(SubPostComment.cid << cid_list).dicts()), 'cid')
 
     commdata = {}
     for comm in expcomms:
@@ -1544,9 +2051,72 @@ def get_messages(mtype, read=False, uid=None):
     return query
 
 
-@cache.memoize(1)
 def get_unread_count(mtype):
-    return get_messages(mtype, True).count()
+    return unread.count(current_user.uid, mtype)
+
+
+# A vote is retried this many times if it loses a race against another vote of the same user on the same target
+VOTE_RETRIES = 3
+
+
+def _get_vote_target(target_type, pcid, uid):
+    """ Loads a post or comment for cast_vote in a single query, along with the current vote of `uid` on it
+    ('vote'), the score of its author ('author_score') and whether `uid` is banned on its sub ('ban').
+    Raises DoesNotExist if the post or comment doesn't exist or was deleted. """
+    if target_type == "post":
+        target = SubPost.select(SubPost.uid, SubPost.sid, SubPost.score, SubPost.hot, SubPost.pid.alias('id'),
+                                SubPost.posted, SubPostVote.positive.alias('vote'), SubMetadata.xid.alias('ban'),
+                                User.score.alias('author_score'))
+        target = target.join(SubPostVote, JOIN.LEFT_OUTER, on=(
+                (SubPostVote.pid == SubPost.pid) & (SubPostVote.uid == uid))).switch(SubPost)
+        target = target.where((SubPost.pid == pcid) & (SubPost.deleted == 0))
+    else:
+        target = SubPostComment.select(SubPostComment.uid, SubPost.sid, SubPostComment.score,
+                                       SubPostComment.cid.alias('id'), SubPostComment.time.alias('posted'),
+                                       SubPostCommentVote.positive.alias('vote'), SubMetadata.xid.alias('ban'),
+                                       User.score.alias('author_score'))
+        target = target.join(SubPost, on=(SubPost.pid == SubPostComment.pid)).switch(SubPostComment)
+        target = target.join(SubPostCommentVote, JOIN.LEFT_OUTER, on=(
+                (SubPostCommentVote.cid == SubPostComment.cid) & (SubPostCommentVote.uid == uid)))
+        target = target.switch(SubPostComment)
+        target = target.where((SubPostComment.cid == pcid) & SubPostComment.status.is_null(True))
+    target = target.join(SubMetadata, JOIN.LEFT_OUTER, on=(
+            (SubMetadata.sid == SubPost.sid) & (SubMetadata.key == 'ban') & (SubMetadata.value == uid)))
+    author = SubPost.uid if target_type == "post" else SubPostComment.uid
+    target = target.join(User, JOIN.LEFT_OUTER, on=(User.uid == author))
+    return target.dicts().get()
+
+
+def _record_vote(target_type, uid, pcid, current, positive):
+    """ Inserts, flips or removes the vote of `uid` on a post or comment. `current` is the value of the vote
+    when we loaded it (None if there was none). Every statement checks that the vote didn't change since then,
+    relying on the unique (uid, pid) and (uid, cid) indexes.
+    Returns a (score, upvotes, downvotes, given) tuple with the changes to apply to the target's counters and to
+    the voter's `given`, or None if somebody else changed the vote first. """
+    if target_type == "post":
+        model, field = SubPostVote, SubPostVote.pid
+    else:
+        model, field = SubPostCommentVote, SubPostCommentVote.cid
+    value = 1 if positive else -1
+    match = (field == pcid) & (model.uid == uid) & (model.positive == current)
+
+    if current is None:
+        try:
+            with db.atomic():
+                model.insert({field: pcid, model.uid: uid, model.positive: int(positive),
+                              model.datetime: datetime.utcnow()}).execute()
+        except IntegrityError:
+            return None
+        return (value, 1, 0, value) if positive else (value, 0, 1, value)
+
+    if bool(current) == positive:  # Same vote again: undo it
+        if not model.delete().where(match).execute():
+            return None
+        return (-value, -1, 0, -value) if positive else (-value, 0, -1, -value)
+
+    if not model.update(positive=int(positive)).where(match).execute():
+        return None
+    return (value * 2, 1, -1, value) if positive else (value * 2, -1, 1, value)
 
 
 def cast_vote(uid, target_type, pcid, value):
@@ -1558,7 +2128,7 @@ def cast_vote(uid, target_type, pcid, value):
       """
     # XXX: This function returns api3 objects
     try:
-        user = User.get(User.uid == uid)
+        user = votebuffer.merge('user', [dict(get_user_snapshot(uid)['user'])], 'uid')[0]
     except User.DoesNotExist:
         return jsonify(msg=_("Unknown error. User disappeared")), 403
 
@@ -1566,122 +2136,82 @@ def cast_vote(uid, target_type, pcid, value):
         voteValue = 1
     elif value == "down" or value is False:
         voteValue = -1
-        if user.given < 0:
+        if user['given'] < 0:
             return jsonify(msg=_('Score balance is negative')), 403
     else:
         return jsonify(msg=_("Invalid vote value")), 400
 
-    if target_type == "post":
-        target_model = SubPost
-        try:
-            target = SubPost.select(SubPost.uid, SubPost.score, SubPost.upvotes, SubPost.downvotes,
-                                    SubPost.pid.alias('id'), SubPost.posted)
-            target = target.where((SubPost.pid == pcid) & (SubPost.deleted == 0)).get()
-        except SubPost.DoesNotExist:
-            return jsonify(msg=_('Post does not exist')), 404
-
-        if target.deleted:
-            return jsonify(msg=_("You can't vote on deleted posts")), 400
+    if target_type not in ("post", "comment"):
+        return jsonify(msg=_("Invalid target")), 400
+    target_model = SubPost if target_type == "post" else SubPostComment
+    positive = voteValue == 1
 
+    for _attempt in range(VOTE_RETRIES):
         try:
-            qvote = SubPostVote.select().where(SubPostVote.pid == pcid).where(SubPostVote.uid == uid).get()
-        except SubPostVote.DoesNotExist:
-            qvote = False
-    elif target_type == "comment":
-        target_model = SubPostComment
-        try:
-            target = SubPostComment.select(SubPostComment.uid, SubPost.sid, SubPostComment.pid, SubPostComment.status,
-                                           SubPostComment.score,
-                                           SubPostComment.upvotes, SubPostComment.downvotes,
-                                           SubPostComment.cid.alias('id'), SubPostComment.time.alias('posted'))
-            target = target.join(SubPost).where(SubPostComment.cid == pcid).where(SubPostComment.status.is_null(True))
-            target = target.objects().get()
-        except SubPostComment.DoesNotExist:
+            target = _get_vote_target(target_type, pcid, uid)
+        except target_model.DoesNotExist:
+            if target_type == "post":
+                return jsonify(msg=_('Post does not exist')), 404
             return jsonify(msg=_('Comment does not exist')), 404
 
-        if target.uid_id == user.uid:
+        if target_type == "comment" and target['uid'] == uid:
             return jsonify(msg=_("You can't vote on your own comments")), 400
-        if target.status:
-            return jsonify(msg=_("You can't vote on deleted comments")), 400
 
-        try:
-            qvote = SubPostCommentVote.select().where(SubPostCommentVote.cid == pcid).where(
-                SubPostCommentVote.uid == uid).get()
-        except SubPostCommentVote.DoesNotExist:
-            qvote = False
+        if target['ban']:
+            return jsonify(msg=_('You are banned on this sub.')), 403
+
+        if (datetime.utcnow() - target['posted'].replace(tzinfo=None)) > timedelta(days=60):
+            return jsonify(msg=_("Post is archived")), 400
+
+        # The vote and all the counters change together or not at all (unless the counters are buffered)
+        with db.atomic():
+            changes = _record_vote(target_type, uid, pcid, target['vote'], positive)
+            if changes:
+                new_score, upvotes, downvotes, given = changes
+                # The voter's row isn't contended, so this one isn't buffered
+                userstats.add_votes(uid, upvotes, downvotes)
+                if not votebuffer.enabled():
+                    upd_fields = dict(score=target_model.score + new_score, upvotes=target_model.upvotes + upvotes,
+                                      downvotes=target_model.downvotes + downvotes)
+                    if target_type == "post":
+                        # The time component of the hot ranking never changes, so it just moves along with the score
+                        upd_fields['hot'] = SubPost.hot + (new_score * 20)
+                    target_model.update(**upd_fields).where(target_model._meta.primary_key == pcid).execute()
+                    # The author's score and the voter's given in a single statement
+                    User.update(score=User.score + Case(User.uid, [(target['uid'], new_score)], 0),
+                                xp=User.xp + Case(User.uid, [(target['uid'], new_score)], 0),
+                                given=User.given + Case(User.uid, [(uid, given)], 0)).where(
+                        User.uid << [target['uid'], uid]).execute()
+        if changes:
+            break
     else:
-        return jsonify(msg=_("Invalid target")), 400
-
-    try:
-        SubMetadata.get((SubMetadata.sid == target.sid) & (SubMetadata.key == "ban") & (SubMetadata.value == user.uid))
-        return jsonify(msg=_('You are banned on this sub.')), 403
-    except SubMetadata.DoesNotExist:
-        pass
-
-    if (datetime.utcnow() - target.posted.replace(tzinfo=None)) > timedelta(days=60):
-        return jsonify(msg=_("Post is archived")), 400
-
-    positive = True if voteValue == 1 else False
-    undone = False
-
-    if qvote:
-        if bool(qvote.positive) == (True if voteValue == 1 else False):
-            qvote.delete_instance()
-
-            if positive:
-                upd_q = target_model.update(score=target_model.score - voteValue, upvotes=target_model.upvotes - 1)
-            else:
-                upd_q = target_model.update(score=target_model.score - voteValue, downvotes=target_model.downvotes - 1)
-            new_score = -voteValue
-            undone = True
-            User.update(score=User.score - voteValue).where(User.uid == target.uid).execute()
-            User.update(given=User.given - voteValue).where(User.uid == uid).execute()
-        else:
-            qvote.positive = positive
-            qvote.save()
-
-            if positive:
-                upd_q = target_model.update(score=target_model.score + (voteValue * 2),
-                                            upvotes=target_model.upvotes + 1, downvotes=target_model.downvotes - 1)
-            else:
-                upd_q = target_model.update(score=target_model.score + (voteValue * 2),
-                                            upvotes=target_model.upvotes - 1, downvotes=target_model.downvotes + 1)
-            new_score = (voteValue * 2)
-            User.update(score=User.score + (voteValue * 2)).where(User.uid == target.uid).execute()
-            User.update(given=User.given + voteValue).where(User.uid == uid).execute()
-    else:  # First vote cast on post
-        now = datetime.utcnow()
-        if target_type == "post":
-            sp_vote = SubPostVote.create(pid=pcid, uid=uid, positive=positive, datetime=now)
-        else:
-            sp_vote = SubPostCommentVote.create(cid=pcid, uid=uid, positive=positive, datetime=now)
-
-        sp_vote.save()
-
-        if positive:
-            upd_q = target_model.update(score=target_model.score + voteValue, upvotes=target_model.upvotes + 1)
-        else:
-            upd_q = target_model.update(score=target_model.score + voteValue, downvotes=target_model.downvotes + 1)
-        new_score = voteValue
-        User.update(score=User.score + voteValue).where(User.uid == target.uid).execute()
-        User.update(given=User.given + voteValue).where(User.uid == uid).execute()
+        return jsonify(msg=_("Unknown error. Please try again")), 409
 
+    undone = new_score == -voteValue
+    sitestats.incr(upvotes=upvotes, downvotes=downvotes)
+    if votebuffer.enabled():
+        pending, author_pending = votebuffer.add(target_type, target['id'], new_score, upvotes, downvotes,
+                                                 target['uid'], uid, given)
+    else:
+        pending, author_pending = new_score, new_score
+    score = target['score'] + pending
     if target_type == "post":
-        upd_q.where(SubPost.pid == target.id).execute()
-        socketio.emit('threadscore', {'pid': target.id, 'score': target.score + new_score},
-                      namespace='/snt', room=target.id)
+        ranking.incr_post(target['id'], target['sid'], new_score)
+        socketio.emit('threadscore', {'pid': target['id'], 'score': score},
+                      namespace='/snt', room=target['id'])
 
         socketio.emit('yourvote',
-                      {'pid': target.id, 'status': voteValue if not undone else 0, 'score': target.score + new_score},
+                      {'pid': target['id'], 'status': voteValue if not undone else 0, 'score': score},
                       namespace='/snt',
                       room='user' + uid)
-    else:
-        upd_q.where(SubPostComment.cid == target.id).execute()
 
-    socketio.emit('uscore', {'score': target.uid.score + new_score},
-                  namespace='/snt', room="user" + target.uid_id)
+    invalidate_user_cache(uid)
+    if target['uid']:
+        invalidate_user_cache(target['uid'])
+        socketio.emit('uscore', {'score': (target['author_score'] or 0) + author_pending},
+                      namespace='/snt', room="user" + target['uid'])
 
-    return jsonify(score=target.score + new_score, rm=undone)
+    return jsonify(score=score, rm=undone)
 
 
 def is_sub_mod(uid, sid, power_level, can_admin=False):
@@ -4,8 +4,8 @@ import sys
 import redis
 import copy
 from flask import g
-from peewee import IntegerField, DateTimeField, BooleanField, Proxy, Model, Database
-from peewee import CharField, ForeignKeyField, TextField, PrimaryKeyField
+from peewee import IntegerField, DateTimeField, BooleanField, Proxy, Model, Database, DoubleField
+from peewee import CharField, ForeignKeyField, TextField, PrimaryKeyField, DateField
 from playhouse.db_url import connect as db_url_connect
 from playhouse.flask_utils import FlaskDB
 from .config import config
@@ -80,6 +80,7 @@ class User(BaseModel):
 
     score = IntegerField(default=0)  # AKA phuks taken
     given = IntegerField(default=0)  # AKA phuks given
+    xp = IntegerField(default=0)  # score + the score of the user's badges (see misc.get_user_level)
     # status: 0 = OK; 10 = deleted
     status = IntegerField(default=0)
     resets = IntegerField(default=0)
@@ -88,6 +89,22 @@ class User(BaseModel):
 
     class Meta:
         table_name = 'user'
+        indexes = (
+            (('joindate', 'uid'), False),
+        )
+
+
+class UserStats(BaseModel):
+    """ Activity counters shown in the profiles, built and kept up to date by app/userstats.py """
+    uid = ForeignKeyField(db_column='uid', model=User, field='uid', primary_key=True)
+    post_count = IntegerField(default=0)
+    comment_count = IntegerField(default=0)
+    upvotes_given = IntegerField(default=0)
+    downvotes_given = IntegerField(default=0)
+    habits = TextField(default='{}')  # JSON sub name -> number of posts
+
+    class Meta:
+        table_name = 'user_stats'
 
 
 class Client(BaseModel):
@@ -234,6 +251,9 @@ class SubPost(BaseModel):
     content = TextField(null=True)
     deleted = IntegerField(null=True)
     link = CharField(null=True)
+    # Normalized host of the link and its registrable domain (see misc.get_link_domain and misc.get_base_domain)
+    domain = CharField(null=True, max_length=255)
+    base_domain = CharField(null=True, max_length=255)
     nsfw = BooleanField(null=True)
     pid = PrimaryKeyField()
     posted = DateTimeField(null=True)
@@ -243,6 +263,8 @@ class SubPost(BaseModel):
     score = IntegerField(null=True)  # XXX: Deprecated
     upvotes = IntegerField(default=0)
     downvotes = IntegerField(default=0)
+    # Precomputed hot ranking (see misc.get_hot_score). Kept up to date when voting.
+    hot = DoubleField(default=0)
 
     sid = ForeignKeyField(db_column='sid', null=True, model=Sub, field='sid')
     thumbnail = CharField(null=True)
@@ -253,6 +275,38 @@ class SubPost(BaseModel):
 
     class Meta:
         table_name = 'sub_post'
+        indexes = (
+            (('sid', 'deleted', 'hot'), False),
+            (('deleted', 'hot'), False),
+            (('domain', 'pid'), False),
+            (('base_domain', 'pid'), False),
+        )
+
+
+class SiteStatsDaily(BaseModel):
+    """ What was added to the site counters every day (see app/sitestats.py) """
+    day = DateField()
+    key = CharField(max_length=32)
+    value = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'site_stats_daily'
+        indexes = (
+            (('day', 'key'), True),
+        )
+
+
+class SubPostSearchToken(BaseModel):
+    """ Inverted index used by the post search (see app/search.py) """
+    token = CharField(max_length=32)
+    pid = ForeignKeyField(db_column='pid', model=SubPost, field='pid')
+    weight = IntegerField()
+
+    class Meta:
+        table_name = 'sub_post_search_token'
+        indexes = (
+            (('token', 'pid'), True),
+        )
 
 
 class SubPostPollOption(BaseModel):
@@ -289,9 +343,16 @@ class SubPostComment(BaseModel):
     time = DateTimeField(null=True)
     uid = ForeignKeyField(db_column='uid', null=True, model=User,
                           field='uid', backref='comments')
+    # Materialized path: a short hash of the cid of every ancestor and of the comment itself (see
+    # misc.get_comment_path). Used to fetch a whole branch with a single range query.
+    path = CharField(null=True, max_length=255)
+    depth = IntegerField(default=0)
 
     class Meta:
         table_name = 'sub_post_comment'
+        indexes = (
+            (('pid', 'path'), False),
+        )
 
 
 class SubPostCommentVote(BaseModel):
@@ -304,6 +365,9 @@ class SubPostCommentVote(BaseModel):
 
     class Meta:
         table_name = 'sub_post_comment_vote'
+        indexes = (
+            (('uid', 'cid'), True),
+        )
 
 
 class SubPostMetadata(BaseModel):
@@ -328,6 +392,9 @@ class SubPostVote(BaseModel):
 
     class Meta:
         table_name = 'sub_post_vote'
+        indexes = (
+            (('uid', 'pid'), True),
+        )
 
 
 class SubStylesheet(BaseModel):
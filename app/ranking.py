@@ -0,0 +1,105 @@
+""" Post rankings stored in redis sorted sets.
+
+We keep one sorted set of pids per sort (hot, new, top) for every sub and another one for the whole site.
+Listings read a page of pids from here and only hydrate those posts from the database.
+The sets are filled by `rebuild()` (see scripts/ranking.py); until then `get_range` returns None and the
+callers keep using SQL.
+
+The sets hold every post that isn't deleted, whoever is looking; the per-user filters (blocked subs, nsfw) are
+applied when the page is hydrated. Anything that brings a deleted post back has to `add_post` it again.
+"""
+import hashlib
+from .models import rconn, SubPost
+
+SORTS = ('hot', 'new', 'top')
+PER_PAGE = 25
+# How long we keep the union of several subs (used for the home page) around
+UNION_TTL = 30
+
+# ZINCRBY on every set in KEYS, but only if the post (ARGV[1]) is in it already. ARGV[i + 1] is the amount for KEYS[i]
+_incr = rconn.register_script("""
+for i, key in ipairs(KEYS) do
+    if redis.call('zscore', key, ARGV[1]) then
+        redis.call('zincrby', key, ARGV[i + 1], ARGV[1])
+    end
+end
+""")
+
+
+def _key(sort, sid=None):
+    return 'ranking/{0}/{1}'.format(sort, sid if sid else 'all')
+
+
+def _values(pid, score, hot):
+    return {'hot': hot, 'new': pid, 'top': score}
+
+
+def is_ready():
+    """ Returns True if the rankings were built """
+    return bool(rconn.exists('ranking/ready'))
+
+
+def add_post(pid, sid, score, hot):
+    """ Adds a new post to the rankings of its sub and the site """
+    p = rconn.pipeline()
+    for sort, value in _values(pid, score, hot).items():
+        p.zadd(_key(sort, sid), {pid: value})
+        p.zadd(_key(sort), {pid: value})
+    p.execute()
+
+
+def incr_post(pid, sid, score):
+    """ Adds a change of the score of a post to its rankings. Only the change is sent, so concurrent votes can't
+    write a stale score. Posts not in the rankings (deleted ones) are left alone """
+    _incr(keys=[_key('hot', sid), _key('hot'), _key('top', sid), _key('top')],
+          args=[pid, score * 20, score * 20, score, score])
+
+
+def remove_post(pid, sid):
+    """ Removes a post from all the rankings """
+    p = rconn.pipeline()
+    for sort in SORTS:
+        p.zrem(_key(sort, sid), pid)
+        p.zrem(_key(sort), pid)
+    p.execute()
+
+
+def get_range(sort, start, count, sids=None):
+    """ Returns the list of `count` pids starting at position `start` (0 being the first post).
+    `sids` can be a single sid, a list of sids (the union of those subs) or None for the whole site.
+    Returns None if the rankings are not available. """
+    if sort not in SORTS or not is_ready():
+        return None
+
+    if isinstance(sids, (list, tuple, set)):
+        if not sids:
+            return []
+        sids = sorted(sids)
+        key = 'ranking/union/{0}/{1}'.format(sort, hashlib.md5(''.join(sids).encode()).hexdigest())
+        if not rconn.exists(key):
+            p = rconn.pipeline()
+            p.zunionstore(key, [_key(sort, x) for x in sids], aggregate='MAX')
+            p.expire(key, UNION_TTL)
+            p.execute()
+    else:
+        key = _key(sort, sids)
+
+    return [int(x) for x in rconn.zrevrange(key, start, start + count - 1)]
+
+
+def rebuild():
+    """ Rebuilds all the rankings from the database """
+    for key in rconn.scan_iter('ranking/*'):
+        rconn.delete(key)
+
+    posts = SubPost.select(SubPost.pid, SubPost.sid, SubPost.score, SubPost.hot).where(SubPost.deleted == 0)
+    p = rconn.pipeline()
+    for i, post in enumerate(posts.tuples().iterator()):
+        pid, sid, score, hot = post
+        for sort, value in _values(pid, score or 0, hot).items():
+            p.zadd(_key(sort, sid), {pid: value})
+            p.zadd(_key(sort), {pid: value})
+        if i % 1000 == 0:
+            p.execute()
+    p.set('ranking/ready', '1')
+    p.execute()
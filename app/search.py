@@ -0,0 +1,157 @@
+""" Post search.
+
+Posts are split into tokens and stored in an inverted index (token -> the pids that contain it, with a weight
+for every pid). A search returns the pids that contain every token of the query, ordered by the sum of their
+weights (the relevance) and then by pid, which is also what the `after` cursors point to.
+
+The index is updated when posts are created, edited or deleted. Backends are picked with the `search.backend`
+config option; the only one we ship is 'database', which keeps the index in the sub_post_search_token table.
+To (re)build the index for existing posts, use scripts/search.py.
+"""
+import re
+from abc import ABC, abstractmethod
+from importlib import import_module
+from peewee import fn
+from .config import config
+from .models import db, SubPost, SubPostSearchToken
+
+TOKEN_RE = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 32
+# Tokens past this are ignored when searching (every token is another posting list to intersect)
+MAX_QUERY_TOKENS = 8
+# Matches in the title count as this many matches in the content
+TITLE_WEIGHT = 5
+# Maximum weight a token can get from the post's content, so repeating a word doesn't push posts up forever
+MAX_CONTENT_WEIGHT = 10
+STOPWORDS = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it',
+                       'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'with'))
+
+
+def tokenize(text):
+    """ Returns the list of searchable tokens in `text`, in order and with repetitions """
+    if not text:
+        return []
+    tokens = (x.replace("'", '') for x in TOKEN_RE.findall(text.lower()))
+    return [x for x in tokens if MIN_TOKEN_LENGTH <= len(x) <= MAX_TOKEN_LENGTH and x not in STOPWORDS]
+
+
+def get_weights(title, content):
+    """ Returns a token -> weight dict for a post """
+    weights = {}
+    for token in tokenize(content):
+        weights[token] = weights.get(token, 0) + 1
+    weights = {k: min(v, MAX_CONTENT_WEIGHT) for k, v in weights.items()}
+    for token in tokenize(title):
+        weights[token] = weights.get(token, 0) + TITLE_WEIGHT
+    return weights
+
+
+class SearchBackend(ABC):
+    """ Interface of the search backends """
+
+    @abstractmethod
+    def index_post(self, pid, title, content):
+        """ Adds a post to the index or updates it """
+
+    @abstractmethod
+    def remove_post(self, pid):
+        """ Removes a post from the index """
+
+    @abstractmethod
+    def clear(self):
+        """ Removes everything from the index """
+
+    @abstractmethod
+    def search(self, tokens, limit, after=None, offset=0):
+        """ Returns a list of (pid, relevance) tuples for the posts that contain all the `tokens`.
+        `after` is a (relevance, pid) tuple: only results ranked after it are returned. """
+
+
+class DatabaseIndex(SearchBackend):
+    """ Keeps the posting lists in the sub_post_search_token table, one (token, pid, weight) row per posting """
+
+    def index_post(self, pid, title, content):
+        weights = get_weights(title, content)
+        current = SubPostSearchToken.select(SubPostSearchToken.token, SubPostSearchToken.weight)
+        current = {x.token: x.weight for x in current.where(SubPostSearchToken.pid == pid)}
+
+        with db.atomic():
+            removed = [x for x in current if x not in weights]
+            if removed:
+                SubPostSearchToken.delete().where((SubPostSearchToken.pid == pid) &
+                                                  (SubPostSearchToken.token << removed)).execute()
+            for token, weight in weights.items():
+                if token in current and current[token] != weight:
+                    SubPostSearchToken.update(weight=weight).where((SubPostSearchToken.pid == pid) &
+                                                                   (SubPostSearchToken.token == token)).execute()
+            added = [{'token': k, 'pid': pid, 'weight': v} for k, v in weights.items() if k not in current]
+            for i in range(0, len(added), 500):
+                SubPostSearchToken.insert_many(added[i:i + 500]).execute()
+
+    def remove_post(self, pid):
+        SubPostSearchToken.delete().where(SubPostSearchToken.pid == pid).execute()
+
+    def clear(self):
+        SubPostSearchToken.delete().execute()
+
+    def search(self, tokens, limit, after=None, offset=0):
+        relevance = fn.SUM(SubPostSearchToken.weight)
+        query = SubPostSearchToken.select(SubPostSearchToken.pid, relevance.alias('relevance'))
+        query = query.where(SubPostSearchToken.token << tokens).group_by(SubPostSearchToken.pid)
+        # Every token has at most one posting per post, so this is the intersection of all the posting lists
+        query = query.having(fn.COUNT(SubPostSearchToken.pid) == len(tokens))
+        if after:
+            query = query.having((relevance < after[0]) |
+                                 ((relevance == after[0]) & (SubPostSearchToken.pid < after[1])))
+        query = query.order_by(relevance.desc(), SubPostSearchToken.pid.desc()).limit(limit).offset(offset)
+        return [(pid, int(score)) for pid, score in query.tuples()]
+
+
+BACKENDS = {'database': DatabaseIndex}
+_backend = None
+
+
+def get_backend():
+    """ Returns the configured backend. `search.backend` is either a name from BACKENDS or the dotted path
+    to a SearchBackend subclass """
+    global _backend
+    if _backend is None:
+        name = config.search.backend
+        if name in BACKENDS:
+            backend = BACKENDS[name]
+        else:
+            path, class_name = name.rsplit('.', 1)
+            backend = getattr(import_module(path), class_name)
+        _backend = backend()
+    return _backend
+
+
+def index_post(post):
+    """ Adds or updates a post (a SubPost instance) in the index """
+    get_backend().index_post(post.pid, post.title, post.content)
+
+
+def remove_post(pid):
+    get_backend().remove_post(pid)
+
+
+def search(query, limit=25, after=None, offset=0):
+    """ Returns a list of (pid, relevance) tuples for the posts matching `query` (a string), best first.
+    `after` is a (relevance, pid) tuple taken from the last result of the previous page. """
+    tokens = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TOKENS]
+    if not tokens:
+        return []
+    return get_backend().search(tokens, limit, after, offset)
+
+
+def rebuild():
+    """ Indexes all the posts that weren't deleted from scratch. Returns the number of posts indexed """
+    backend = get_backend()
+    backend.clear()
+    count = 0
+    posts = SubPost.select(SubPost.pid, SubPost.title, SubPost.content).where(SubPost.deleted == 0)
+    for post in posts.order_by(SubPost.pid).iterator():
+        backend.index_post(post.pid, post.title, post.content)
+        count += 1
+    return count
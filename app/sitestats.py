@@ -0,0 +1,140 @@
+""" Site-wide counters shown in the admin dashboard.
+
+The totals (users, subs, posts, comments, upvotes and downvotes) live in a redis hash and are updated with `incr`
+by everything that creates or removes those things. Every change is also added to a hash for the current day
+(UTC); `rollup` moves the days that are over to the site_stats_daily table, which keeps the history.
+
+Counting the big tables takes a long time, so the totals are only set from the database by
+scripts/sitestats.py --recount. Until then `get_totals` returns None and only the daily counters are kept.
+The changes made while it counts are kept too, but the rows created while a table is being counted may end
+up counted twice.
+"""
+import datetime
+from peewee import IntegrityError
+from .models import rconn, db, User, Sub, SubPost, SubPostComment, SubPostVote, SubPostCommentVote, SiteStatsDaily
+
+COUNTERS = ('users', 'subs', 'posts', 'comments', 'upvotes', 'downvotes')
+TOTALS_KEY = 'sitestats/totals'
+# Present in the totals hash while recount is running
+COUNTING_FIELD = '_counting'
+# Days that have a hash waiting to be rolled up
+DAYS_KEY = 'sitestats/days'
+
+# ARGV is the day followed by (counter, amount) pairs. The totals are only touched if they were counted already
+_incr = rconn.register_script("""
+local counted = redis.call('exists', KEYS[1]) == 1
+redis.call('sadd', KEYS[3], ARGV[1])
+for i = 2, #ARGV, 2 do
+    if counted then
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('hincrby', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+""")
+
+# Reads and deletes a hash in one go, so no increment can land between the two
+_take = rconn.register_script("""
+local values = redis.call('hgetall', KEYS[1])
+redis.call('del', KEYS[1])
+return values
+""")
+
+
+def _today():
+    return datetime.datetime.utcnow().date().isoformat()
+
+
+def _day_key(day):
+    return 'sitestats/day/{0}'.format(day)
+
+
+def incr(**amounts):
+    """ Adds to the counters, ie. `incr(posts=1, upvotes=1)`. Amounts may be negative """
+    args = []
+    for counter, amount in amounts.items():
+        if amount:
+            args.extend((counter, amount))
+    if args:
+        day = _today()
+        _incr(keys=[TOTALS_KEY, _day_key(day), DAYS_KEY], args=[day] + args)
+
+
+def get_totals():
+    """ Returns a counter -> total dict, or None if the totals weren't counted yet """
+    totals = {k.decode(): int(v) for k, v in rconn.hgetall(TOTALS_KEY).items()}
+    if not totals or COUNTING_FIELD in totals:
+        return None
+    return {x: totals.get(x, 0) for x in COUNTERS}
+
+
+def recount():
+    """ Counts everything from the database and stores it as the totals. Slow, use scripts/sitestats.py """
+    # The totals hash exists from now on, so whatever happens while we count is added to it. The counts are
+    # added to that at the end, and until then get_totals ignores the hash
+    p = rconn.pipeline()
+    p.delete(TOTALS_KEY)
+    p.hset(TOTALS_KEY, COUNTING_FIELD, 1)
+    p.execute()
+
+    ups = SubPostVote.select().where(SubPostVote.positive == 1).count()
+    downs = SubPostVote.select().where(SubPostVote.positive == 0).count()
+    ups += SubPostCommentVote.select().where(SubPostCommentVote.positive == 1).count()
+    downs += SubPostCommentVote.select().where(SubPostCommentVote.positive == 0).count()
+    totals = {'users': User.select().count(), 'subs': Sub.select().count(), 'posts': SubPost.select().count(),
+              'comments': SubPostComment.select().count(), 'upvotes': ups, 'downvotes': downs}
+    p = rconn.pipeline()
+    for key, value in totals.items():
+        p.hincrby(TOTALS_KEY, key, value)
+    p.hdel(TOTALS_KEY, COUNTING_FIELD)
+    p.execute()
+    return get_totals()
+
+
+def _store_day(day, counts):
+    with db.atomic():
+        for key, value in counts.items():
+            try:
+                with db.atomic():
+                    SiteStatsDaily.insert(day=day, key=key, value=value).execute()
+            except IntegrityError:
+                # The day was rolled up before and something was counted for it after that
+                SiteStatsDaily.update(value=SiteStatsDaily.value + value).where(
+                    (SiteStatsDaily.day == day) & (SiteStatsDaily.key == key)).execute()
+
+
+def rollup():
+    """ Moves the daily counters of the days that are over from redis to the database """
+    today = _today()
+    for day in sorted(x.decode() for x in rconn.smembers(DAYS_KEY)):
+        if day >= today:
+            continue
+        rconn.srem(DAYS_KEY, day)
+        values = _take(keys=[_day_key(day)])
+        counts = {values[i].decode(): int(values[i + 1]) for i in range(0, len(values), 2)}
+        try:
+            _store_day(day, counts)
+        except Exception:
+            # Put them back for the next time
+            p = rconn.pipeline()
+            for key, value in counts.items():
+                p.hincrby(_day_key(day), key, value)
+            p.sadd(DAYS_KEY, day)
+            p.execute()
+            raise
+
+
+def get_daily(days=14):
+    """ Returns a list of (date, {counter: amount}) tuples with what was added every day for the last `days`
+    days, today included, newest first """
+    rollup()
+    today = datetime.datetime.utcnow().date()
+    dates = [today - datetime.timedelta(days=i) for i in range(days)]
+    daily = {x: dict.fromkeys(COUNTERS, 0) for x in dates}
+    rows = SiteStatsDaily.select().where(SiteStatsDaily.day >= dates[-1])
+    for row in rows.dicts():
+        if row['key'] in daily.get(row['day'], {}):
+            daily[row['day']][row['key']] = row['value']
+    for key, value in rconn.hgetall(_day_key(today.isoformat())).items():
+        if key.decode() in daily[today]:
+            daily[today][key.decode()] += int(value)
+    return [(x, daily[x]) for x in dates]
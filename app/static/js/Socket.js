@@ -78,6 +78,13 @@ socket.on('threadcomments', function(data){
   document.querySelector('div[pid="' + data.pid + '"] .comments').innerHTML = _('comments (%1)', data.comments);
 })
 
+socket.on('threadthumbnail', function(data){
+  var th = document.querySelector('div[pid="' + data.pid + '"] .thumbnail');
+  if(th){
+    th.innerHTML = '<img alt="' + _('Thumbnail') + '" src="' + data.thumbnail + '"/>';
+  }
+});
+
 socket.on('threadtitle', function(data){
   document.querySelector('div[pid="' + data.pid + '"] .title').innerHTML = data.title;
 });
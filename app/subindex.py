@@ -0,0 +1,221 @@
+""" In-memory index of sub names, used for the sub autocomplete and the sub search.
+
+Every process keeps two radix trees (tries where chains of single-child nodes are merged into one edge):
+one with the lowercase sub names, used for prefix matches, and another one with every suffix of them, used
+for substring matches. Every node of the first tree keeps its best `TOP_SIZE` names (by subscribers), so a
+prefix query is just a walk down the tree.
+
+The index is built the first time it's used and rebuilt every `REBUILD_INTERVAL` seconds to pick up
+subscriber changes. New subs are added with `add_sub`, which also tells the other processes to rebuild
+their index (they check for it at most every `CHECK_INTERVAL` seconds). Those rebuilds happen in a background
+thread; requests keep using the old index until the new one is ready.
+"""
+import bisect
+import logging
+import threading
+import time
+from .models import rconn, db, Sub
+
+TOP_SIZE = 20
+CHECK_INTERVAL = 10
+REBUILD_INTERVAL = 3600
+VERSION_KEY = 'subindex/version'
+
+
+class _Node:
+    __slots__ = ('children', 'top', 'names')
+
+    def __init__(self):
+        self.children = {}  # first character of the edge -> (edge label, child node)
+        self.top = []  # best (-subscribers, lowercase name, name) tuples of the subtree, only in the prefix tree
+        self.names = None  # names that end exactly here
+
+    def add_top(self, entry):
+        if len(self.top) >= TOP_SIZE and entry >= self.top[-1]:
+            return
+        if any(x[2] == entry[2] for x in self.top):
+            return
+        bisect.insort(self.top, entry)
+        del self.top[TOP_SIZE:]
+
+
+class RadixTree:
+    def __init__(self, keep_top=False):
+        self.root = _Node()
+        self.keep_top = keep_top
+
+    def insert(self, key, entry):
+        """ Stores `entry` (a (-subscribers, lowercase name, name) tuple) under `key` """
+        node = self.root
+        i = 0
+        while True:
+            if self.keep_top:
+                node.add_top(entry)
+            if i == len(key):
+                break
+            edge = node.children.get(key[i])
+            if edge is None:
+                child = _Node()
+                node.children[key[i]] = (key[i:], child)
+                node = child
+                i = len(key)
+                continue
+            label, child = edge
+            if key.startswith(label, i):
+                common = len(label)
+            else:
+                common = 1
+                while common < len(label) and i + common < len(key) and label[common] == key[i + common]:
+                    common += 1
+                # Split the edge: label[:common] leads to a new node with the rest of the old edge below it
+                middle = _Node()
+                middle.top = list(child.top)
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[i]] = (label[:common], middle)
+                child = middle
+            node = child
+            i += common
+        if node.names is None:
+            node.names = set()
+        node.names.add(entry[2])
+
+    def find(self, key):
+        """ Returns the node whose subtree holds every key starting with `key`, or None """
+        node = self.root
+        i = 0
+        while i < len(key):
+            edge = node.children.get(key[i])
+            if edge is None:
+                return None
+            label, child = edge
+            if len(key) - i <= len(label):
+                # The key ends somewhere along this edge
+                return child if label.startswith(key[i:]) else None
+            if not key.startswith(label, i):
+                return None
+            node = child
+            i += len(label)
+        return node
+
+    @staticmethod
+    def walk(node):
+        """ Yields every name stored in the subtree of `node`. In the suffix tree names can come up more than once """
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            if node.names:
+                yield from node.names
+            pending.extend(child for label, child in node.children.values())
+
+
+class SubIndex:
+    def __init__(self, subs):
+        """ `subs` is an iterable of (name, subscribers, posts) tuples """
+        self.entries = {}
+        self.posts = {}
+        self.prefixes = RadixTree(keep_top=True)
+        self.suffixes = RadixTree()
+        for name, subscribers, posts in subs:
+            self.add(name, subscribers, posts)
+
+    def add(self, name, subscribers, posts=0):
+        key = name.lower()
+        entry = (-(subscribers or 0), key, name)
+        self.entries[name] = entry
+        self.posts[name] = posts or 0
+        self.prefixes.insert(key, entry)
+        for i in range(len(key)):
+            self.suffixes.insert(key[i:], entry)
+
+    def complete(self, query, limit):
+        """ Returns up to `limit` (at most TOP_SIZE) names for the autocomplete. Names starting with `query`
+        go first, then the ones containing it. Both groups are sorted by subscribers. """
+        query = query.lower()
+        node = self.prefixes.find(query)
+        names = [x[2] for x in node.top[:limit]] if node else []
+        if len(names) < limit:
+            node = self.suffixes.find(query)
+            if node:
+                rest = sorted(self.entries[x] for x in set(RadixTree.walk(node)).difference(names))
+                names.extend(x[2] for x in rest[:limit - len(names)])
+        return names
+
+    def search(self, term, sort='name', desc=False):
+        """ Returns every name containing `term`, sorted by `sort` ('name', 'subscribers' or 'posts') """
+        node = self.suffixes.find(term.lower())
+        names = set(RadixTree.walk(node)) if node else set()
+        keys = {'name': lambda x: (x.lower(), x),
+                'subscribers': lambda x: (-self.entries[x][0], x),
+                'posts': lambda x: (self.posts[x], x)}
+        return sorted(names, key=keys[sort], reverse=desc)
+
+
+_index = None
+_built = 0
+_checked = 0
+_version = None
+_rebuilding = threading.Lock()
+
+
+def _get_version():
+    version = rconn.get(VERSION_KEY)
+    return int(version) if version else 0
+
+
+def rebuild():
+    """ Builds this process' index from the database """
+    global _index, _built, _checked, _version
+    version = _get_version()
+    index = SubIndex(Sub.select(Sub.name, Sub.subscribers, Sub.posts).tuples())
+    _index, _version = index, version
+    _built = _checked = time.time()
+
+
+def _rebuild_in_background():
+    if not _rebuilding.acquire(blocking=False):
+        return  # Already on it
+
+    def run():
+        try:
+            with db.connection_context():
+                rebuild()
+        except Exception:
+            logging.exception('Could not rebuild the sub index')
+        finally:
+            _rebuilding.release()
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_index():
+    """ Returns the index. If it's too old or another process added a sub, a new one is built in the background
+    and the current one is returned in the meantime """
+    global _checked
+    now = time.time()
+    if _index is None:
+        rebuild()
+    elif now - _built > REBUILD_INTERVAL:
+        _rebuild_in_background()
+    elif now - _checked > CHECK_INTERVAL:
+        _checked = now
+        if _get_version() != _version:
+            _rebuild_in_background()
+    return _index
+
+
+def add_sub(name, subscribers=0):
+    """ Adds a new sub to the index of this process and makes the others rebuild theirs """
+    global _version
+    index = get_index()
+    index.add(name, subscribers)
+    _version = rconn.incr(VERSION_KEY)
+
+
+def complete(query, limit=10):
+    """ Returns up to `limit` sub names starting with or containing `query`, the most subscribed first """
+    return get_index().complete(query, min(limit, TOP_SIZE))
+
+
+def search(term, sort='name', desc=False, page=1, per_page=50):
+    """ Returns a page of the names of the subs containing `term`, sorted by `sort` (see SubIndex.search) """
+    start = (page - 1) * per_page
+    return get_index().search(term, sort, desc)[start:start + per_page]
@@ -0,0 +1,43 @@
+""" Background thumbnail fetching.
+
+Fetching a thumbnail can take several downloads, so posts are created without one and queued here with
+`enqueue`. The worker (see scripts/thumbnails.py) fetches the thumbnail, stores it in the post and pushes it
+to the clients over socketio.
+"""
+import json
+import logging
+from .config import config
+from .models import rconn, SubPost, UserUploads
+from .socketio import socketio
+from . import misc
+
+QUEUE_KEY = 'thumbnails/queue'
+
+
+def enqueue(pid, link):
+    """ Queues the thumbnail of a post for fetching """
+    rconn.rpush(QUEUE_KEY, json.dumps({'pid': pid, 'link': link}))
+
+
+def process(pid, link):
+    """ Fetches the thumbnail of a post and saves it """
+    thumbnail = misc.get_thumbnail(link)
+    if not thumbnail:
+        return
+
+    SubPost.update(thumbnail=thumbnail).where(SubPost.pid == pid).execute()
+    UserUploads.update(thumbnail=thumbnail).where(UserUploads.pid == pid).execute()
+    data = {'pid': pid, 'thumbnail': config.storage.thumbnails.url + thumbnail}
+    socketio.emit('threadthumbnail', data, namespace='/snt', room='/all/new')
+    socketio.emit('threadthumbnail', data, namespace='/snt', room=pid)
+
+
+def work():
+    """ Processes the queue forever """
+    while True:
+        _, job = rconn.blpop(QUEUE_KEY)
+        job = json.loads(job.decode())
+        try:
+            process(job['pid'], job['link'])
+        except Exception:
+            logging.exception('Could not fetch the thumbnail for post %s', job['pid'])
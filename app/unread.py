@@ -0,0 +1,121 @@
+""" Unread message counters.
+
+Every user has a redis hash with the number of unread messages of each mtype. The hash is built from the
+database the first time it's needed and kept up to date by everything that creates messages or marks them
+as read. If the counters ever drift, `reset` them (see scripts/unread.py) and they'll be rebuilt.
+
+Messages can be sent or read while a hash is being rebuilt, so it's created before counting (the same way
+sitestats.recount does it) and the counts are added to whatever changed in the meantime.
+"""
+from peewee import fn
+from .models import rconn, Message
+
+# Increments a counter only if the user's hash was built already (otherwise it'll be built from the database)
+_incr = rconn.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2])
+end
+return nil
+""")
+
+
+# Present in a user's hash while rebuild is counting
+COUNTING_FIELD = '_counting'
+# How long a rebuild may take before its hash is dropped and built again
+COUNTING_TTL = 60
+
+# Creates the hash with the counting marker, unless it exists already. The '_' field makes sure the hash
+# still exists when there's nothing unread
+_start = rconn.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('hset', KEYS[1], '_', 0, ARGV[1], 1)
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+""")
+
+# ARGV is the marker followed by (mtype, count) pairs, which are added to whatever was counted by `incr` while
+# rebuild was running. Does nothing if the hash was reset in the meantime
+_finish = rconn.register_script("""
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('hdel', KEYS[1], ARGV[1])
+redis.call('persist', KEYS[1])
+return 1
+""")
+
+
+def _key(uid):
+    return 'unread/{0}'.format(uid)
+
+
+def _count(uid):
+    """ Counts the unread messages of a user in the database """
+    counts = Message.select(Message.mtype, fn.Count(Message.mid).alias('count'))
+    counts = counts.where((Message.receivedby == uid) & Message.read.is_null(True)).group_by(Message.mtype)
+    # Messages without a mtype aren't shown in any mailbox
+    return {x['mtype']: x['count'] for x in counts.dicts() if x['mtype'] is not None}
+
+
+def rebuild(uid):
+    """ Builds the counters of a user from the database, unless somebody else did already, and returns the counts.
+    `reset` them first to rebuild them """
+    # The hash exists from now on, so the messages sent or read while we count are added to it. The counts are
+    # added to that at the end, and until then get_counts ignores the hash
+    started = _start(keys=[_key(uid)], args=[COUNTING_FIELD, COUNTING_TTL])
+    counts = _count(uid)
+    if started:
+        args = [COUNTING_FIELD]
+        for mtype, amount in counts.items():
+            args.extend((mtype, amount))
+        _finish(keys=[_key(uid)], args=args)
+    return counts
+
+
+def get_counts(uid):
+    """ Returns a mtype -> unread messages dict """
+    counts = rconn.hgetall(_key(uid))
+    if not counts:
+        return rebuild(uid)
+    if COUNTING_FIELD.encode() in counts:
+        # Somebody else is rebuilding it
+        return _count(uid)
+    result = {}
+    for k, v in counts.items():
+        if k.isdigit():
+            result[int(k)] = int(v)
+    return result
+
+
+def count(uid, mtypes=None, exclude=()):
+    """ Returns the number of unread messages of the given types (or all of them but `exclude`) """
+    counts = get_counts(uid)
+    return sum(v for k, v in counts.items() if (mtypes is None or k in mtypes) and k not in exclude)
+
+
+def incr(uid, mtype, amount=1):
+    """ Adds `amount` (which may be negative) to a counter """
+    if amount and mtype is not None:
+        _incr(keys=[_key(uid)], args=[mtype, amount])
+
+
+def incr_many(uids, mtype, amount=1):
+    """ Same as `incr` for several users """
+    p = rconn.pipeline()
+    for uid in uids:
+        _incr(keys=[_key(uid)], args=[mtype, amount], client=p)
+    p.execute()
+
+
+def reset(*uids):
+    """ Drops the counters of the given users, or everybody's if no uids are given """
+    if uids:
+        rconn.delete(*[_key(uid) for uid in uids])
+    else:
+        for key in rconn.scan_iter('unread/*'):
+            rconn.delete(key)
@@ -0,0 +1,109 @@
+""" Per-user activity counters shown in the profiles.
+
+Every user gets a user_stats row with the number of posts and comments they made, the upvotes and downvotes they
+gave and how many posts they made in each sub (their posting habits). The row is built from the database the
+first time it's needed and then kept up to date by everything that creates posts, comments or votes, so showing
+a profile only reads that row. Like the posts and comments themselves, the counters include deleted ones.
+If the counters ever drift, `reset` them (see scripts/userstats.py) and they'll be rebuilt.
+"""
+import json
+from peewee import fn, IntegrityError
+from .models import db, UserStats, Sub, SubPost, SubPostComment, SubPostVote, SubPostCommentVote
+
+# Number of subs shown in the posting habits
+HABITS_SIZE = 10
+
+
+def _count_votes(model, uid):
+    """ Returns a positive -> count dict with the votes of a user """
+    votes = model.select(model.positive, fn.COUNT(model.xid)).where(model.uid == uid).group_by(model.positive)
+    return dict(votes.tuples())
+
+
+def _to_dict(stats):
+    habits = sorted(json.loads(stats['habits']).items(), key=lambda x: x[1], reverse=True)
+    return dict(stats, habits=habits[:HABITS_SIZE])
+
+
+def rebuild(uid):
+    """ Builds the counters of a user from the database, unless somebody else did already, and returns them (see
+    `get`). `reset` them first to rebuild them """
+    # The row exists from now on, so whatever the user does while we count is added to it. The counts are added
+    # to that at the end (the posts, comments or votes made while we count may end up counted twice)
+    try:
+        with db.atomic():
+            UserStats.insert(uid=uid).execute()
+    except IntegrityError:
+        return get(uid)  # Somebody else built it
+
+    habits = Sub.select(Sub.name, fn.COUNT(SubPost.pid)).join(SubPost, on=(SubPost.sid == Sub.sid))
+    habits = dict(habits.where(SubPost.uid == uid).group_by(Sub.sid, Sub.name).tuples())
+    post_votes = _count_votes(SubPostVote, uid)
+    comment_votes = _count_votes(SubPostCommentVote, uid)
+    comment_count = SubPostComment.select().where(SubPostComment.uid == uid).count()
+    upvotes = post_votes.get(1, 0) + comment_votes.get(1, 0)
+    downvotes = post_votes.get(0, 0) + comment_votes.get(0, 0)
+
+    query = UserStats.select(UserStats.habits).where(UserStats.uid == uid)
+    if db.for_update:
+        query = query.for_update()
+    with db.atomic():
+        try:
+            current = json.loads(query.get().habits)
+        except UserStats.DoesNotExist:
+            current = None  # It was reset in the meantime
+        if current is not None:
+            for sub, count in habits.items():
+                current[sub] = current.get(sub, 0) + count
+            UserStats.update(post_count=UserStats.post_count + sum(habits.values()),
+                             comment_count=UserStats.comment_count + comment_count,
+                             upvotes_given=UserStats.upvotes_given + upvotes,
+                             downvotes_given=UserStats.downvotes_given + downvotes,
+                             habits=json.dumps(current)).where(UserStats.uid == uid).execute()
+    return get(uid)
+
+
+def get(uid):
+    """ Returns a dict with the counters of a user. `habits` is a list of (sub name, posts) tuples with the subs
+    they posted the most in """
+    try:
+        stats = UserStats.select().where(UserStats.uid == uid).dicts().get()
+    except UserStats.DoesNotExist:
+        return rebuild(uid)
+    return _to_dict(stats)
+
+
+def add_post(uid, sub):
+    """ Counts a new post of `uid` in the sub named `sub` """
+    query = UserStats.select(UserStats.habits).where(UserStats.uid == uid)
+    if db.for_update:
+        # The habits are read and written back, so nobody else can touch the row in the meantime
+        query = query.for_update()
+    with db.atomic():
+        try:
+            habits = query.get().habits
+        except UserStats.DoesNotExist:
+            return
+        habits = json.loads(habits)
+        habits[sub] = habits.get(sub, 0) + 1
+        UserStats.update(post_count=UserStats.post_count + 1, habits=json.dumps(habits)).where(
+            UserStats.uid == uid).execute()
+
+
+def add_comment(uid):
+    UserStats.update(comment_count=UserStats.comment_count + 1).where(UserStats.uid == uid).execute()
+
+
+def add_votes(uid, upvotes, downvotes):
+    """ Adds to the upvotes and downvotes given by a user (the amounts may be negative) """
+    if upvotes or downvotes:
+        UserStats.update(upvotes_given=UserStats.upvotes_given + upvotes,
+                         downvotes_given=UserStats.downvotes_given + downvotes).where(UserStats.uid == uid).execute()
+
+
+def reset(*uids):
+    """ Drops the counters of the given users, or everybody's if no uids are given """
+    query = UserStats.delete()
+    if uids:
+        query = query.where(UserStats.uid << uids)
+    query.execute()
@@ -1,12 +1,15 @@
 """ Admin endpoints """
+import base64
+import datetime
+import json
 import time
 import re
 from peewee import fn, JOIN
 from pyotp import TOTP
-from flask import Blueprint, abort, redirect, url_for, session, render_template
+from flask import Blueprint, abort, redirect, url_for, session, render_template, request
 from flask_login import login_required, current_user
 from flask_babel import _
-from .. import misc
+from .. import misc, sitestats
 from ..forms import TOTPForm, LogOutForm, UseInviteCodeForm, AssignUserBadgeForm, EditModForm, BanDomainForm
 from ..models import UserMetadata, User, Sub, SubPost, SubPostComment, SubPostCommentVote, SubPostVote, SiteMetadata
 from ..models import UserUploads
@@ -58,14 +61,8 @@ def index():
     if not current_user.admin:
         return redirect(url_for('admin.auth'))
 
-    users = User.select().count()
-    subs = Sub.select().count()
-    posts = SubPost.select().count()
-    comms = SubPostComment.select().count()
-    ups = SubPostVote.select().where(SubPostVote.positive == 1).count()
-    downs = SubPostVote.select().where(SubPostVote.positive == 0).count()
-    ups += SubPostCommentVote.select().where(SubPostCommentVote.positive == 1).count()
-    downs += SubPostCommentVote.select().where(SubPostCommentVote.positive == 0).count()
+    totals = sitestats.get_totals()
+    daily = sitestats.get_daily()
 
     invite = UseInviteCodeForm()
     try:
@@ -81,32 +78,89 @@ def index():
     except SiteMetadata.DoesNotExist:
         ep = 'True'
 
-    return render_template('admin/admin.html', subs=subs,
-                           posts=posts, ups=ups, downs=downs, users=users,
-                           comms=comms,
+    return render_template('admin/admin.html', totals=totals, daily=daily,
                            useinvitecodeform=invite, enable_posting=(ep == 'True'))
 
 
-@bp.route("/users", defaults={'page': 1})
-@bp.route("/users/<int:page>")
+USERS_PER_PAGE = 50
+
+
+def _encode_user_cursor(user):
+    """ Returns an opaque token pointing right after `user` (a dict) in the user browser """
+    joindate = user['joindate'].isoformat() if user['joindate'] else None
+    return base64.urlsafe_b64encode(json.dumps([joindate, user['uid']]).encode()).decode()
+
+
+def _decode_user_cursor(token):
+    """ Returns the (joindate, uid) tuple stored by _encode_user_cursor, or None if the token is not valid """
+    try:
+        joindate, uid = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        return datetime.datetime.fromisoformat(joindate) if joindate else None, str(uid)
+    except (ValueError, TypeError):
+        return None
+
+
+def _add_user_counts(users):
+    """ Adds post_count and comment_count to a list of user dicts, only counting the posts and comments of
+    those users """
+    uids = [x['uid'] for x in users]
+    if not uids:
+        return users
+    posts = SubPost.select(SubPost.uid, fn.Count(SubPost.pid)).where(SubPost.uid << uids).group_by(SubPost.uid)
+    posts = dict(posts.tuples())
+    comments = SubPostComment.select(SubPostComment.uid, fn.Count(SubPostComment.cid))
+    comments = dict(comments.where(SubPostComment.uid << uids).group_by(SubPostComment.uid).tuples())
+    for user in users:
+        user['post_count'] = posts.get(user['uid'], 0)
+        user['comment_count'] = comments.get(user['uid'], 0)
+    return users
+
+
+@bp.route("/users")
 @login_required
-def users(page):
-    """ WIP: View users. """
+def users():
+    """ WIP: View users. Newest first, paginated by (joindate, uid) """
     if not current_user.is_admin():
         abort(404)
 
-    postcount = SubPost.select(SubPost.uid, fn.Count(SubPost.pid).alias('post_count')).group_by(SubPost.uid).alias(
-        'post_count')
-    commcount = SubPostComment.select(SubPostComment.uid, fn.Count(SubPostComment.cid).alias('comment_count')).group_by(
-        SubPostComment.uid).alias('j2')
+    after = _decode_user_cursor(request.args.get('after', ''))
+    base = User.select(User.name, User.status, User.uid, User.joindate)
+    users = []
+    if after is None or after[0] is not None:
+        query = base.where(User.joindate.is_null(False))
+        if after:
+            query = query.where((User.joindate < after[0]) | ((User.joindate == after[0]) & (User.uid < after[1])))
+        users = list(query.order_by(User.joindate.desc(), User.uid.desc()).limit(USERS_PER_PAGE + 1).dicts())
+    if len(users) <= USERS_PER_PAGE:
+        # Users from before we stored the join date go last
+        query = base.where(User.joindate.is_null(True))
+        if after and after[0] is None:
+            query = query.where(User.uid < after[1])
+        query = query.order_by(User.uid.desc()).limit(USERS_PER_PAGE + 1 - len(users))
+        users += list(query.dicts())
+
+    next_after = _encode_user_cursor(users[USERS_PER_PAGE - 1]) if len(users) > USERS_PER_PAGE else None
+    users = _add_user_counts(users[:USERS_PER_PAGE])
+    return render_template('admin/users.html', users=users, next_after=next_after, first_page=after is None,
+                           levels=misc.get_user_levels(x['uid'] for x in users), admin_route='admin.users')
 
-    users = User.select(User.name, User.status, User.uid, User.joindate, postcount.c.post_count.alias('post_count'),
-                        commcount.c.comment_count)
-    users = users.join(postcount, JOIN.LEFT_OUTER, on=User.uid == postcount.c.uid)
-    users = users.join(commcount, JOIN.LEFT_OUTER, on=User.uid == commcount.c.uid)
-    users = users.order_by(User.joindate.desc()).paginate(page, 50).dicts()
-    return render_template('admin/users.html', users=users, page=page,
-                           admin_route='admin.users')
+
+@bp.route("/users/<int:page>")
+@login_required
+def users_page(page):
+    """ The user browser used to be paginated by page number. Redirects those links to the same page """
+    if not current_user.is_admin():
+        abort(404)
+    if page <= 1:
+        return redirect(url_for('admin.users'))
+
+    # Same order as `users`
+    last = User.select(User.uid, User.joindate).order_by(User.joindate.is_null(), User.joindate.desc(),
+                                                         User.uid.desc())
+    last = list(last.offset((page - 1) * USERS_PER_PAGE - 1).limit(1).dicts())
+    if not last:
+        return redirect(url_for('admin.users'))
+    return redirect(url_for('admin.users', after=_encode_user_cursor(last[0])))
 
 
 @bp.route("/userbadges")
@@ -129,19 +183,12 @@ def view():
     if current_user.is_admin():
         admins = UserMetadata.select().where(UserMetadata.key == 'admin')
 
-        postcount = SubPost.select(SubPost.uid, fn.Count(SubPost.pid).alias('post_count')).group_by(SubPost.uid).alias(
-            'post_count')
-        commcount = SubPostComment.select(SubPostComment.uid,
-                                          fn.Count(SubPostComment.cid).alias('comment_count')).group_by(
-            SubPostComment.uid).alias('j2')
-
-        users = User.select(User.name, User.status, User.uid, User.joindate, postcount.c.post_count.alias('post_count'),
-                            commcount.c.comment_count)
-        users = users.join(postcount, JOIN.LEFT_OUTER, on=User.uid == postcount.c.uid)
-        users = users.join(commcount, JOIN.LEFT_OUTER, on=User.uid == commcount.c.uid)
-        users = users.where(User.uid << [x.uid for x in admins]).order_by(User.joindate.asc()).dicts()
+        users = User.select(User.name, User.status, User.uid, User.joindate)
+        users = users.where(User.uid << [x.uid for x in admins]).order_by(User.joindate.asc())
+        users = _add_user_counts(list(users.dicts()))
 
-        return render_template('admin/users.html', users=users, admin_route='admin.view')
+        return render_template('admin/users.html', users=users, levels=misc.get_user_levels(x['uid'] for x in users),
+                               admin_route='admin.view')
     else:
         abort(404)
 
@@ -149,23 +196,24 @@ def view():
 @bp.route("/usersearch/<term>")
 @login_required
 def users_search(term):
-    """ WIP: Search users. """
+    """ WIP: Search users. Matches the start of the name, so it can use the user_name_lower index """
     if current_user.is_admin():
-        term = re.sub(r'[^A-Za-z0-9.\-_]+', '', term)
-
-        postcount = SubPost.select(SubPost.uid, fn.Count(SubPost.pid).alias('post_count')).group_by(SubPost.uid).alias(
-            'post_count')
-        commcount = SubPostComment.select(SubPostComment.uid,
-                                          fn.Count(SubPostComment.cid).alias('comment_count')).group_by(
-            SubPostComment.uid).alias('j2')
-
-        users = User.select(User.name, User.status, User.uid, User.joindate, postcount.c.post_count,
-                            commcount.c.comment_count)
-        users = users.join(postcount, JOIN.LEFT_OUTER, on=User.uid == postcount.c.uid)
-        users = users.join(commcount, JOIN.LEFT_OUTER, on=User.uid == commcount.c.uid)
-        users = users.where(User.name.contains(term)).order_by(User.joindate.desc()).dicts()
-
-        return render_template('admin/users.html', users=users, term=term,
+        term = re.sub(r'[^A-Za-z0-9.\-_]+', '', term).lower()
+        if not term:
+            # Would match everybody
+            return redirect(url_for('admin.users'))
+        after = request.args.get('after', '').lower()
+
+        users = User.select(User.name, User.status, User.uid, User.joindate)
+        users = users.where(fn.Lower(User.name) % (term.replace('_', '\\_') + '%'))
+        if after:
+            users = users.where(fn.Lower(User.name) > after)
+        users = list(users.order_by(fn.Lower(User.name)).limit(USERS_PER_PAGE + 1).dicts())
+
+        next_after = users[USERS_PER_PAGE - 1]['name'].lower() if len(users) > USERS_PER_PAGE else None
+        users = _add_user_counts(users[:USERS_PER_PAGE])
+        return render_template('admin/users.html', users=users, term=term, next_after=next_after,
+                               first_page=not after, levels=misc.get_user_levels(x['uid'] for x in users),
                                admin_route='admin.users_search')
     else:
         abort(404)
@@ -215,7 +263,7 @@ def post_voting(page, term):
     """ WIP: View post voting habits """
     if current_user.is_admin():
         try:
-            user = User.get(fn.Lower(User.name) == term.lower())
+            user = User.get(User.uid == misc.get_uid(term))
             msg = []
             votes = SubPostVote.select(SubPostVote.positive, SubPostVote.pid, User.name, SubPostVote.datetime,
                                        SubPostVote.pid)
@@ -240,7 +288,7 @@ def comment_voting(page, term):
     """ WIP: View comment voting habits """
     if current_user.is_admin():
         try:
-            user = User.get(fn.Lower(User.name) == term.lower())
+            user = User.get(User.uid == misc.get_uid(term))
             msg = []
             votes = SubPostCommentVote.select(SubPostCommentVote.positive, SubPostCommentVote.cid, SubPostComment.uid,
                                               User.name, SubPostCommentVote.datetime, SubPost.pid,
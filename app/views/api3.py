@@ -7,10 +7,10 @@ import requests
 import bcrypt
 from bs4 import BeautifulSoup
 from flask import Blueprint, jsonify, request, url_for
-from peewee import JOIN, fn
+from peewee import JOIN
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, create_refresh_token, get_jwt_identity
 from flask_jwt_extended import jwt_refresh_token_required, jwt_optional
-from .. import misc
+from .. import misc, ranking, search, sitestats, subindex, thumbnails, unread, userstats, votebuffer
 from ..socketio import socketio
 from ..models import Sub, User, SubPost, SubPostComment, SubMetadata, SubPostCommentVote, SubPostVote, SubSubscriber
 from ..models import SiteMetadata, UserMetadata, Message
@@ -43,7 +43,7 @@ def login():
         return jsonify(msg="Missing password parameter"), 400
 
     try:
-        user = User.get(fn.Lower(User.name) == username.lower())
+        user = User.get(User.uid == misc.get_uid(username))
     except User.DoesNotExist:
         return jsonify(msg="Bad username or password"), 401
     
@@ -87,7 +87,7 @@ def fresh_login():
     username = request.json.get('username', None)
     password = request.json.get('password', None)
     try:
-        user = User.get(fn.Lower(User.name) == username.lower())
+        user = User.get(User.uid == misc.get_uid(username))
     except User.DoesNotExist:
         return jsonify(msg="Bad username or password"), 401
 
@@ -107,21 +107,28 @@ def fresh_login():
 @jwt_optional
 def get_post_list(target):
     """ Same as v2, but `content` is returned as parsed markdown and the `sort` can be `default`
-    when `target` is a sub """
+    when `target` is a sub. Instead of `page`, the `after` token returned with every page can be passed
+    to get the next one. """
 
     if target not in ('all', 'home'):
         sort = request.args.get('sort', default='default')
     else:
         sort = request.args.get('sort', default='new')
     page = request.args.get('page', default=1, type=int)
+    after = request.args.get('after', default=None)
 
     if sort not in ('hot', 'top', 'new', 'default'):
         return jsonify(msg="Invalid sort"), 400
     if page < 1:
         return jsonify(msg="Invalid page number"), 400
+    if after:
+        try:
+            after = misc.decode_post_cursor(after)
+        except ValueError:
+            return jsonify(msg="Invalid cursor"), 400
 
     uid = get_jwt_identity()
-    base_query = SubPost.select(SubPost.nsfw, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted, SubPost.score,
+    base_query = SubPost.select(SubPost.nsfw, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted, SubPost.score, SubPost.hot,
                                 SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'), SubPost.flair, SubPost.edited,
                                 SubPost.comments, SubPost.ptype, User.status.alias('userstatus'), User.uid, SubPost.upvotes, *([SubPost.downvotes, SubPostVote.positive] if uid else [SubPost.downvotes]))
     if uid:
@@ -150,7 +157,7 @@ def get_post_list(target):
 
     else:
         try:
-            sub = Sub.get(fn.Lower(Sub.name) == target.lower())
+            sub = Sub.get(Sub.sid == misc.get_sid(target))
         except Sub.DoesNotExist:
             return jsonify(msg="Target does not exist"), 404
 
@@ -170,9 +177,17 @@ def get_post_list(target):
         base_query = base_query.where(Sub.sid == sub.sid)
 
     base_query = base_query.where(SubPost.deleted == 0)
-    posts = misc.getPostList(base_query, sort, page).dicts()
+    # We fetch one extra post to know if there's another page instead of counting all of them
+    if after:
+        posts = list(misc.getPostListAfter(base_query, sort, after).dicts())
+    else:
+        posts = list(misc.getPostList(base_query, sort, page).limit(26).dicts())
+    continues = len(posts) > 25
+    posts = posts[:25]
+    next_after = misc.encode_post_cursor(posts[-1], sort) if continues else None
+    # After the cursor, which points into the scores we have in the database
+    votebuffer.merge('post', posts, 'pid')
 
-    cnt = base_query.count() - page * 25
     postList = []
     for post in posts:
         if post['userstatus'] == 10:  # account deleted
@@ -180,10 +195,57 @@ def get_post_list(target):
         post['archived'] = (datetime.datetime.utcnow() - post['posted'].replace(tzinfo=None)) > datetime.timedelta(days=60)
         del post['userstatus']
         del post['uid']
+        del post['hot']
         post['content'] = misc.our_markdown(post['content']) if post['ptype'] != 1 else ''
         postList.append(post)
 
-    return jsonify(posts=postList, sort=sort, continues=True if cnt > 0 else False)
+    return jsonify(posts=postList, sort=sort, continues=continues, after=next_after)
+
+
+@API.route('/search', methods=['GET'])
+@jwt_optional
+def search_posts():
+    """ Returns the posts whose title or content match the `q` parameter, the most relevant first.
+    Like in get_post_list, the `after` token returned with every page can be passed to get the next one. """
+    query = request.args.get('q', default='')
+    after = request.args.get('after', default=None)
+    if not query.strip():
+        return jsonify(msg="Missing q parameter"), 400
+    if after:
+        try:
+            after = misc.decode_post_cursor(after)
+        except ValueError:
+            return jsonify(msg="Invalid cursor"), 400
+
+    uid = get_jwt_identity()
+    base_query = SubPost.select(SubPost.nsfw, SubPost.content, SubPost.pid, SubPost.title, SubPost.posted, SubPost.score,
+                                SubPost.thumbnail, SubPost.link, User.name.alias('user'), Sub.name.alias('sub'), SubPost.flair, SubPost.edited,
+                                SubPost.comments, SubPost.ptype, User.status.alias('userstatus'), User.uid, SubPost.upvotes, *([SubPost.downvotes, SubPostVote.positive] if uid else [SubPost.downvotes]))
+    if uid:
+        base_query = base_query.join(SubPostVote, JOIN.LEFT_OUTER, on=((SubPostVote.pid == SubPost.pid) & (SubPostVote.uid == uid))).switch(SubPost)
+    base_query = base_query.join(User, JOIN.LEFT_OUTER).switch(SubPost).join(Sub, JOIN.LEFT_OUTER)
+    base_query = base_query.where(SubPost.deleted == 0)
+    if uid:
+        blocked = SubSubscriber.select(SubSubscriber.sid).where((SubSubscriber.uid == uid) & (SubSubscriber.status == 2))
+        base_query = base_query.where(SubPost.sid.not_in([x.sid_id for x in blocked]))
+
+    # We fetch one extra post to know if there's another page
+    posts = misc.getSearchPostList(base_query, query, after=after, limit=26)
+    continues = len(posts) > 25
+    posts = posts[:25]
+    next_after = misc.encode_post_cursor(posts[-1], 'relevance') if continues else None
+
+    postList = []
+    for post in posts:
+        if post['userstatus'] == 10:  # account deleted
+            post['user'] = '[Deleted]'
+        post['archived'] = (datetime.datetime.utcnow() - post['posted'].replace(tzinfo=None)) > datetime.timedelta(days=60)
+        del post['userstatus']
+        del post['uid']
+        post['content'] = misc.our_markdown(post['content']) if post['ptype'] != 1 else ''
+        postList.append(post)
+
+    return jsonify(posts=postList, continues=continues, after=next_after)
 
 
 @API.route('/post/<sub>/<int:pid>', methods=['GET'])
@@ -199,12 +261,11 @@ def get_post(sub, pid):
         base_query = base_query.join(SubPostVote, JOIN.LEFT_OUTER, on=((SubPostVote.pid == SubPost.pid) & (SubPostVote.uid == uid))).switch(SubPost)
     base_query = base_query.join(User, JOIN.LEFT_OUTER).switch(SubPost).join(Sub, JOIN.LEFT_OUTER)
 
-    post = base_query.where((SubPost.pid == pid) & (fn.Lower(Sub.name) == sub.lower())).dicts()
-
-    if not post.count():
+    try:
+        post = base_query.where((SubPost.pid == pid) & (SubPost.sid == misc.get_sid(sub))).dicts().get()
+    except (SubPost.DoesNotExist, Sub.DoesNotExist):
         return jsonify(msg="Post does not exist"), 404
 
-    post = post[0]
     post['deleted'] = True if post['deleted'] != 0 else False
 
     if post['deleted']:  # Clear data for deleted posts
@@ -251,9 +312,9 @@ def edit_post(sub, pid):
 
     try:
         post = SubPost.select().join(Sub, JOIN.LEFT_OUTER).where(
-            (SubPost.pid == pid) & (fn.Lower(Sub.name) == sub.lower()))
+            (SubPost.pid == pid) & (SubPost.sid == misc.get_sid(sub)))
         post = post.where(SubPost.deleted == 0).get()
-    except SubPost.DoesNotExist:
+    except (SubPost.DoesNotExist, Sub.DoesNotExist):
         return jsonify(msg="Post does not exist"), 404
 
     if post.uid_id != uid:
@@ -270,6 +331,7 @@ def edit_post(sub, pid):
     if (datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)).seconds > 300:
         post.edited = datetime.datetime.utcnow()
     post.save()
+    search.index_post(post)
     return get_post(sub, pid)
 
 
@@ -279,9 +341,9 @@ def delete_post(sub, pid):
     uid = get_jwt_identity()
     try:
         post = SubPost.select().join(Sub, JOIN.LEFT_OUTER).where(
-            (SubPost.pid == pid) & (fn.Lower(Sub.name) == sub.lower()))
+            (SubPost.pid == pid) & (SubPost.sid == misc.get_sid(sub)))
         post = post.where(SubPost.deleted == 0).get()
-    except SubPost.DoesNotExist:
+    except (SubPost.DoesNotExist, Sub.DoesNotExist):
         return jsonify(msg="Post does not exist"), 404
 
     # TODO: Implement admin logic in the api
@@ -318,6 +380,8 @@ def delete_post(sub, pid):
         pass
     post.save()
     Sub.update(posts=Sub.posts - 1).where(Sub.sid == post.sid).execute()
+    ranking.remove_post(post.pid, post.sid_id)
+    search.remove_post(post.pid)
     return jsonify(), 200
 
 
@@ -362,8 +426,8 @@ def get_post_comments(sub, pid):
     except SubPost.DoesNotExist:
         return jsonify(msg="Post does not exist"), 404
 
-    # 1 - Fetch all comments (only cid and parentcid)
-    comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == post.pid).order_by(SubPostComment.score.desc()).dicts()
+    # 1 - Fetch all the comments we'll show (only cid and parentcid)
+    comments = misc.get_comment_subtree(post.pid)
     if not comments.count():
         return jsonify(comments=[])
 
@@ -419,15 +483,20 @@ def create_comment(sub, pid):
             return jsonify(msg="Parent comment does not exist"), 404
     else:
         parentcid = None
+        parent = None
 
+    cid = uuid.uuid4()
+    path, depth = misc.get_comment_path(cid, parent)
     comment = SubPostComment.create(pid=pid, uid=uid,
                                     content=content,
                                     parentcid=parentcid,
                                     time=datetime.datetime.utcnow(),
-                                    cid=uuid.uuid4(), score=0, upvotes=0, downvotes=0)
+                                    cid=cid, score=0, upvotes=0, downvotes=0, path=path, depth=depth)
 
     SubPost.update(comments=SubPost.comments + 1).where(SubPost.pid == post.pid).execute()
     comment.save()
+    userstats.add_comment(uid)
+    sitestats.incr(comments=1)
 
     socketio.emit('threadcomments', {'pid': post.pid, 'comments': post.comments + 1},
                   namespace='/snt', room=post.pid)
@@ -534,8 +603,11 @@ def delete_comment(sub, pid, cid):
     comment.status = 1
     comment.save()
 
+    receivers = [x.receivedby_id for x in Message.select(Message.receivedby).where(Message.mlink == cid)]
     q = Message.delete().where(Message.mlink == cid)
     q.execute()
+    if receivers:
+        unread.reset(*receivers)
     return jsonify(), 200
 
 
@@ -568,6 +640,7 @@ def get_post_comment_children(sub, pid, cid):
         return jsonify(msg='Post does not exist'), 404
     if cid == 'null':
         cid = '0'
+    root = None
     if cid != '0':
         try:
             root = SubPostComment.get(SubPostComment.cid == cid)
@@ -576,7 +649,8 @@ def get_post_comment_children(sub, pid, cid):
         except SubPostComment.DoesNotExist:
             return jsonify(msg='Post does not exist'), 404
 
-    comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == pid).order_by(SubPostComment.score.desc()).dicts()
+    # get_comment_tree includes the parent of the root comment for context
+    comments = misc.get_comment_subtree(pid, root, context=True)
     if not comments.count():
         return jsonify(comments=[])
 
@@ -671,7 +745,7 @@ def create_post():
         pass
 
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(msg="Sub does not exist"), 404
 
@@ -692,7 +766,8 @@ def create_post():
     if len(title) > 350:
         return jsonify(msg='Post title is too long'), 400
 
-    if misc.get_user_level(uid)[0] < 7:
+    level = misc.get_user_level(uid)[0]
+    if level < 7:
         today = datetime.datetime.utcnow() - datetime.timedelta(days=1)
         lposts = SubPost.select().where(SubPost.uid == uid).where(SubPost.sid == sub.sid).where(SubPost.posted > today).count()
         tposts = SubPost.select().where(SubPost.uid == uid).where(SubPost.posted > today).count()
@@ -724,21 +799,30 @@ def create_post():
         if len(content) > 16384:
             return jsonify(msg='Post content is too long'), 400
 
-    if misc.get_user_level(user.uid)[0] <= 4:
+    if level <= 4:
         check_challenge()
 
+    posted = datetime.datetime.utcnow()
+    domain = misc.get_link_domain(link) if ptype == 'link' else None
     post = SubPost.create(sid=sub.sid,
                           uid=uid,
                           title=title.strip(misc.WHITESPACE),
                           content=content,
                           link=link if ptype == 'link' else None,
-                          posted=datetime.datetime.utcnow(),
+                          domain=domain,
+                          base_domain=misc.get_base_domain(domain),
+                          posted=posted,
                           score=1, upvotes=1, downvotes=0, deleted=0, comments=0,
+                          hot=misc.get_hot_score(1, posted),
                           ptype=post_type,
                           nsfw=nsfw if not subdata.get('nsfw') == '1' else 1,
-                          thumbnail=misc.get_thumbnail(link) if ptype == 'link' else '')
+                          thumbnail='')
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    ranking.add_post(post.pid, sub.sid, post.score, post.hot)
+    if ptype == 'link':
+        thumbnails.enqueue(post.pid, link)
+    search.index_post(post)
     addr = url_for('sub.view_post', sub=sub.name, pid=post.pid)
     posts = misc.getPostList(misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), 'new', 1).dicts()
     socketio.emit('thread',
@@ -749,6 +833,10 @@ def create_post():
 
     SubPostVote.create(uid=uid, pid=post.pid, positive=True)
     User.update(given=User.given + 1).where(User.uid == uid).execute()
+    userstats.add_post(uid, sub.name)
+    userstats.add_votes(uid, 1, 0)
+    sitestats.incr(posts=1, upvotes=1)
+    misc.invalidate_user_cache(uid)
 
     misc.workWithMentions(content, None, post, sub, c_user=user)
     misc.workWithMentions(title, None, post, sub, c_user=user)
@@ -761,14 +849,14 @@ def create_post():
 
 @API.route('/sub', methods=['GET'])
 def search_sub():
+    """ Sub name autocomplete. Returns up to `limit` (default 10, max 20) subs whose name starts with or
+    contains `query`, the most subscribed first """
     query = request.args.get('query', '')
-    if len(query) < 3 or not misc.allowedNames.match(query):
+    limit = request.args.get('limit', default=10, type=int)
+    if len(query) < 3 or not misc.allowedNames.match(query) or limit < 1:
         return jsonify(results=[])
-    
-    query = '%' + query + '%'
-    subs = Sub.select(Sub.name).where(Sub.name ** query).limit(10).dicts()
 
-    return jsonify(results=list(subs))
+    return jsonify(results=[{'name': x} for x in subindex.complete(query, limit)])
 
 
 @API.route('/user/settings', methods=['GET'])
@@ -819,6 +907,7 @@ def set_settings():
         qrys.append(UserMetadata.update(value=value).where((UserMetadata.key == sett) & (UserMetadata.uid == uid)))
 
     [x.execute() for x in qrys]
+    misc.invalidate_user_cache(uid)
     return jsonify()
 
 
@@ -830,7 +919,8 @@ def grab_title():
         return jsonify(msg='url parameter required'), 400
 
     try:
-        req = misc.safeRequest(url)
+        req = misc.safeRequest(url, content_types=('text/html', 'application/xhtml+xml'),
+                               stop_when=misc.html_head_received)
     except (requests.exceptions.RequestException, ValueError):
         return jsonify(msg="Couldn't fetch title"), 400
 
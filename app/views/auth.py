@@ -3,11 +3,10 @@ from urllib.parse import urlparse
 from datetime import datetime
 import uuid
 import bcrypt
-from peewee import fn
 from flask import Blueprint, request, redirect, abort, url_for, session
 from flask_login import current_user, login_user
 from flask_babel import _
-from .. import misc, config
+from .. import misc, config, sitestats
 from ..forms import LoginForm, RegistrationForm
 from ..misc import engine
 from ..models import User, UserMetadata, InviteCode, SubSubscriber, rconn
@@ -67,7 +66,7 @@ def register():
             {'error': _("Username has invalid characters."), 'regform': form})
     # check if user or email are in use
     try:
-        User.get(fn.Lower(User.name) == form.username.data.lower())
+        User.get(User.uid == misc.get_uid(form.username.data))
         return engine.get_template('user/register.html').render(
             {'error': _("Username is not available."), 'regform': form})
     except User.DoesNotExist:
@@ -109,6 +108,7 @@ def register():
 
     user = User.create(uid=str(uuid.uuid4()), name=form.username.data, crypto=1, password=password,
                        email=form.email.data, joindate=datetime.utcnow())
+    sitestats.incr(users=1)
     if misc.enableInviteCode():
         UserMetadata.create(uid=user.uid, key='invitecode', value=form.invitecode.data)
     # defaults
@@ -138,7 +138,7 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         try:
-            user = User.get(fn.Lower(User.name) == form.username.data.lower())
+            user = User.get(User.uid == misc.get_uid(form.username.data))
         except User.DoesNotExist:
             return engine.get_template('user/login.html').render(
                 {'error': _("Invalid username or password."), 'loginform': form})
@@ -14,11 +14,11 @@ import random
 from PIL import Image
 from bs4 import BeautifulSoup
 from flask import Blueprint, redirect, url_for, session, abort, jsonify
-from flask import render_template, request
+from flask import render_template, request, flash
 from flask_login import login_user, login_required, logout_user, current_user
 from flask_babel import _
 from ..config import config
-from .. import forms, misc, caching
+from .. import forms, misc, caching, ranking, search, sitestats, unread, userstats, voteundo
 from ..socketio import socketio
 from ..forms import LogOutForm, CreateSubFlair, DummyForm
 from ..forms import CreateSubForm, EditSubForm, EditUserForm, EditSubCSSForm, ChangePasswordForm
@@ -33,7 +33,7 @@ from ..misc import cache, sendMail, allowedNames, get_errors, engine
 from ..models import SubPost, SubPostComment, Sub, Message, User, UserIgnores, SubLog, SiteLog, SubMetadata, UserSaved
 from ..models import SubMod, SubBan, SubPostCommentHistory, InviteCode
 from ..models import SubStylesheet, SubSubscriber, SubUploads, UserUploads, SiteMetadata, SubPostMetadata, SubPostReport
-from ..models import SubPostVote, SubPostCommentVote, UserMetadata, SubFlair, SubPostPollOption, SubPostPollVote, SubPostCommentReport
+from ..models import UserMetadata, SubFlair, SubPostPollOption, SubPostPollVote, SubPostCommentReport
 from peewee import fn, JOIN
 
 do = Blueprint('do', __name__)
@@ -102,6 +102,8 @@ def delete_user():
         
         usr.status = 10
         usr.save()
+        misc.invalidate_user_cache(usr.uid)
+        misc.invalidate_sub_cache(*misc.get_modded_sids(usr.uid))
         logout_user()
 
         return jsonify(status='ok')
@@ -116,7 +118,7 @@ def edit_user():
     if form.validate():
         if form.subtheme.data != '':
             try:
-                sub = Sub.get(fn.Lower(Sub.name) == form.subtheme.data.lower())
+                sub = Sub.get(Sub.sid == misc.get_sid(form.subtheme.data))
             except Sub.DoesNotExist:
                 return jsonify(status='error', error=[_('Sub does not exist')])
 
@@ -124,6 +126,7 @@ def edit_user():
         usr.email = form.email.data
         usr.language = form.language.data
         usr.save()
+        misc.invalidate_user_cache(usr.uid)
         current_user.update_prefs('labrat', form.experimental.data)
         current_user.update_prefs('nostyles', form.disable_sub_style.data)
         current_user.update_prefs('nsfw', form.show_nsfw.data)
@@ -192,6 +195,8 @@ def delete_post():
 
         post.deleted = deletion
         post.save()
+        ranking.remove_post(post.pid, post.sid_id)
+        search.remove_post(post.pid)
 
         return jsonify(status='ok')
     return jsonify(status='ok', error=get_errors(form))
@@ -202,7 +207,7 @@ def delete_post():
 def edit_sub_css(sub):
     """ Edit sub endpoint """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_("Sub does not exist")])
 
@@ -219,6 +224,7 @@ def edit_sub_css(sub):
         styles.content = dcss[1]
         styles.source = form.css.data
         styles.save()
+        misc.invalidate_sub_cache(sub.sid)
         misc.create_sublog(misc.LOG_TYPE_SUB_CSS_CHANGE, current_user.uid, sub.sid)
 
         return json.dumps({'status': 'ok',
@@ -231,7 +237,7 @@ def edit_sub_css(sub):
 def edit_sub(sub):
     """ Edit sub endpoint """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_("Sub does not exist")])
     if current_user.is_mod(sub.sid, 1) or current_user.is_admin():
@@ -249,6 +255,7 @@ def edit_sub(sub):
 
             if form.subsort.data != "None":
                 sub.update_metadata('sort', form.subsort.data)
+            misc.invalidate_sub_cache(sub.sid)
 
             misc.create_sublog(misc.LOG_TYPE_SUB_SETTINGS, current_user.uid, sub.sid)
 
@@ -268,7 +275,7 @@ def edit_sub(sub):
 def assign_post_flair(sub, pid, fl):
     """ Assign a post's flair """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_("Sub does not exist")])
 
@@ -299,7 +306,7 @@ def assign_post_flair(sub, pid, fl):
 def remove_post_flair(sub, pid):
     """ Deletes a post's flair """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_("Sub does not exist")])
 
@@ -329,12 +336,12 @@ def edit_mod():
     form = EditModForm()
 
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == form.sub.data.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(form.sub.data))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_("Sub does not exist")])
     
     try:
-        user = User.get(fn.Lower(User.name) == form.user.data.lower())
+        user = User.get(User.uid == misc.get_uid(form.user.data))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_("User does not exist")])
 
@@ -346,6 +353,7 @@ def edit_mod():
             sm.save()
         except SubMod.DoesNotExist:
             SubMod.create(sid=sub.sid, uid=user.uid, power_level=0)
+        misc.invalidate_sub_cache(sub.sid)
 
         misc.create_sublog(misc.LOG_TYPE_SUB_TRANSFER, current_user.uid, sub.sid,
                            comment=user.name, admin=True)
@@ -370,7 +378,7 @@ def assign_userbadge():
         return jsonify(status='error', error=[_("Badge does not exist")])
 
     try:
-        user = User.get(fn.Lower(User.name) == form.user.data.lower())
+        user = User.get(User.uid == misc.get_uid(form.user.data))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_("User does not exist")])
 
@@ -378,6 +386,7 @@ def assign_userbadge():
 
         UserMetadata.create(uid=user.uid, key='badge',
                             value=form.badge.data)
+        misc.update_user_xp(user.uid)
 
         # TODO log it, create new log type and save to sitelog ??
 
@@ -406,6 +415,7 @@ def subscribe_to_sub(sid):
         SubSubscriber.create(time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=1)
         sub.subscribers += 1
         sub.save()
+        misc.invalidate_user_cache(current_user.uid)
         return jsonify(status='ok')
     return jsonify(status='error', error=get_errors(form))
 
@@ -429,6 +439,7 @@ def unsubscribe_from_sub(sid):
 
         sub.subscribers -= 1
         sub.save()
+        misc.invalidate_user_cache(current_user.uid)
         return jsonify(status='ok')
     return jsonify(status='error', error=get_errors(form))
 
@@ -454,6 +465,7 @@ def block_sub(sid):
             ss.delete_instance()
 
         SubSubscriber.create(time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=2)
+        misc.invalidate_user_cache(current_user.uid)
         return jsonify(status='ok')
     return jsonify(status='error', error=get_errors(form))
 
@@ -474,6 +486,7 @@ def unblock_sub(sid):
     if form.validate():
         ss = SubSubscriber.get((SubSubscriber.uid == current_user.uid) & (SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 2))
         ss.delete_instance()
+        misc.invalidate_user_cache(current_user.uid)
         return jsonify(status='ok')
     return jsonify(status='error', error=get_errors(form))
 
@@ -548,6 +561,7 @@ def edit_txtpost(pid):
         if (datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)).seconds > 300:
             post.edited = datetime.datetime.utcnow()
         post.save()
+        search.index_post(post)
         return jsonify(status='ok')
     return json.dumps({'status': 'error', 'error': get_errors(form)})
 
@@ -560,7 +574,8 @@ def grab_title():
     if not url:
         abort(400)
     try:
-        req = misc.safeRequest(url)
+        req = misc.safeRequest(url, content_types=('text/html', 'application/xhtml+xml'),
+                               stop_when=misc.html_head_received)
     except (requests.exceptions.RequestException, ValueError):
         return jsonify(status='error', error=[_('Couldn\'t get title')])
 
@@ -612,14 +627,18 @@ def create_comment(pid):
             if (parent.status is not None and parent.status != 0) or parent.pid.pid != post.pid:
                 return jsonify(status='error', error=[_("Parent comment does not exist")]), 400
 
+        cid = uuid.uuid4()
+        path, depth = misc.get_comment_path(cid, parent if form.parent.data != '0' else None)
         comment = SubPostComment.create(pid=pid, uid=current_user.uid,
                                         content=form.comment.data.encode(),
                                         parentcid=form.parent.data if form.parent.data != '0' else None,
                                         time=datetime.datetime.utcnow(),
-                                        cid=uuid.uuid4(), score=0, upvotes=0, downvotes=0)
+                                        cid=cid, score=0, upvotes=0, downvotes=0, path=path, depth=depth)
         
         SubPost.update(comments=SubPost.comments + 1).where(SubPost.pid == post.pid).execute()
         comment.save()
+        userstats.add_comment(current_user.uid)
+        sitestats.incr(comments=1)
 
         socketio.emit('threadcomments',
                       {'pid': post.pid,
@@ -672,7 +691,7 @@ def create_sendmsg():
     form = CreateUserMessageForm()
     if form.validate():
         try:
-            user = User.get(fn.Lower(User.name) == form.to.data.lower())
+            user = User.get(User.uid == misc.get_uid(form.to.data))
         except:
             return json.dumps({'status': 'error', 'error': [_('User does not exist')]})
         misc.create_message(mfrom=current_user.uid,
@@ -695,7 +714,7 @@ def create_sendmsg():
 def ban_user_sub(sub):
     """ Ban user from sub endpoint """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
         
@@ -704,7 +723,7 @@ def ban_user_sub(sub):
     form = BanUserSubForm()
     if form.validate():
         try:
-            user = User.get(fn.Lower(User.name) == form.user.data.lower())
+            user = User.get(User.uid == misc.get_uid(form.user.data))
         except User.DoesNotExist:
             return jsonify(status='error', error=[_('User does not exist')])
 
@@ -759,7 +778,7 @@ def ban_user_sub(sub):
 def inv_mod(sub):
     """ User PM for Mod2 invite endpoint """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
 
@@ -773,7 +792,7 @@ def inv_mod(sub):
         form = EditMod2Form()
         if form.validate():
             try:
-                user = User.get(fn.Lower(User.name) == form.user.data.lower())
+                user = User.get(User.uid == misc.get_uid(form.user.data))
             except User.DoesNotExist:
                 return jsonify(status='error', error=[_('User does not exist')])
 
@@ -826,11 +845,11 @@ def inv_mod(sub):
 @login_required
 def remove_sub_ban(sub, user):
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_('User does not exist')])
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
     form = DummyForm()
@@ -874,11 +893,11 @@ def remove_sub_ban(sub, user):
 def remove_mod2(sub, user):
     """ Remove Mod2 """
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_('User does not exist')])
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
     form = DummyForm()
@@ -892,6 +911,7 @@ def remove_mod2(sub, user):
             
             mod.delete_instance()
             SubMetadata.create(sid=sub.sid, key='xmod2', value=user.uid).save()
+            misc.invalidate_sub_cache(sub.sid)
 
             misc.create_sublog(misc.LOG_TYPE_SUB_MOD_REMOVE, current_user.uid, sub.sid, target=user.uid,
                                admin=True if (not isTopMod and current_user.is_admin()) else False)
@@ -907,11 +927,11 @@ def remove_mod2(sub, user):
 def revoke_mod2inv(sub, user):
     """ revoke Mod2 inv """
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_('User does not exist')])
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
     form = DummyForm()
@@ -938,11 +958,11 @@ def revoke_mod2inv(sub, user):
 def accept_modinv(sub, user):
     """ Accept mod invite """
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         return jsonify(status='error', error=[_('User does not exist')])
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
     form = DummyForm()
@@ -959,11 +979,13 @@ def accept_modinv(sub, user):
         modi.invite = False
         modi.save()
         SubMetadata.delete().where((SubMetadata.sid == sub.sid) & (SubMetadata.key == 'xmod2') & (SubMetadata.value == user.uid)).execute()
+        misc.invalidate_sub_cache(sub.sid)
 
         misc.create_sublog(misc.LOG_TYPE_SUB_MOD_ACCEPT, current_user.uid, sub.sid, target=user.uid)
 
         if not current_user.has_subscribed(sub.name):
             SubSubscriber.create(uid=current_user.uid, sid=sub.sid, status=1)
+            misc.invalidate_user_cache(current_user.uid)
         return jsonify(status='ok')
     return json.dumps({'status': 'error', 'error': get_errors(form)})
 
@@ -973,7 +995,7 @@ def accept_modinv(sub, user):
 def refuse_mod2inv(sub):
     """ refuse Mod2 """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
 
@@ -1000,10 +1022,12 @@ def read_pm(mid):
         return jsonify(status='error', error=[_('Message not found')])
 
     if current_user.uid == message.receivedby_id:
-        if message.read is not None:
+        # Only the request that actually marks it as read updates the counter
+        updated = Message.update(read=datetime.datetime.utcnow()).where(
+            (Message.mid == mid) & Message.read.is_null(True)).execute()
+        if not updated:
             return jsonify(status='ok')
-        message.read = datetime.datetime.utcnow()
-        message.save()
+        unread.incr(current_user.uid, message.mtype, -1)
         socketio.emit('notification',
                       {'count': current_user.notifications},
                       namespace='/snt',
@@ -1019,7 +1043,8 @@ def readall_msgs(boxid):
     """ Mark all messages in a box as read """
     now = datetime.datetime.utcnow()
     q = Message.update(read=now).where(Message.read.is_null()).where(Message.receivedby == current_user.uid)
-    q.where(Message.mtype == boxid).execute()
+    count = q.where(Message.mtype == boxid).execute()
+    unread.incr(current_user.uid, boxid, -count)
     socketio.emit('notification',
                   {'count': current_user.notifications},
                   namespace='/snt',
@@ -1036,8 +1061,10 @@ def delete_pm(mid):
         if message.receivedby_id != current_user.uid:
             return jsonify(status='error', error=_("Message does not exist"))
         
-        message.mtype = 6
-        message.save()
+        moved = Message.update(mtype=6).where((Message.mid == mid) & (Message.mtype == message.mtype)).execute()
+        if moved and message.read is None:
+            unread.incr(current_user.uid, message.mtype, -1)
+            unread.incr(current_user.uid, 6)
         return jsonify(status='ok')
     except Message.DoesNotExist:
         return jsonify(status='error', error=_("Message does not exist"))
@@ -1070,6 +1097,7 @@ def edit_title():
 
         post.title = form.reason.data
         post.save()
+        search.index_post(post)
         socketio.emit('threadtitle', {'pid': post.pid, 'title': form.reason.data},
                       namespace='/snt', room=post.pid)
 
@@ -1086,8 +1114,10 @@ def save_pm(mid):
         if message.receivedby_id != current_user.uid:
             return jsonify(status='error', error=_("Message does not exist"))
         
-        message.mtype = 9
-        message.save()
+        moved = Message.update(mtype=9).where((Message.mid == mid) & (Message.mtype == message.mtype)).execute()
+        if moved and message.read is None:
+            unread.incr(current_user.uid, message.mtype, -1)
+            unread.incr(current_user.uid, 9)
         return jsonify(status='ok')
     except Message.DoesNotExist:
         return jsonify(status='error', error=_("Message does not exist"))
@@ -1163,6 +1193,7 @@ def ban_domain():
         except SiteMetadata.DoesNotExist:
             sm = SiteMetadata.create(key='banned_domain', value=form.domain.data)
             sm.save()
+            misc.invalidate_domain_bans()
             misc.create_sitelog(misc.LOG_TYPE_DOMAIN_BAN, current_user.uid, comment=form.domain.data)
             return jsonify(status='ok')
 
@@ -1180,6 +1211,7 @@ def remove_banned_domain(domain):
         sm.delete_instance()
     except:
         return jsonify(status='error', error=_('Domain is not banned'))
+    misc.invalidate_domain_bans()
 
     misc.create_sitelog(misc.LOG_TYPE_DOMAIN_UNBAN, current_user.uid, comment=domain)
 
@@ -1326,6 +1358,7 @@ def toggle_sticky(post):
                     link=url_for('sub.view_post', sub=post.sid.name, pid=post.pid))
 
         cache.delete_memoized(misc.getStickyPid, post.sid_id)
+        misc.invalidate_sub_cache(post.sid_id)
     return jsonify(status='ok')
 
 
@@ -1357,6 +1390,7 @@ def toggle_wikipost(post):
             #        link=url_for('sub.view_post', sub=post.sid.name, pid=post.pid))
 
         cache.delete_memoized(misc.getWikiPid, post.sid_id)
+        misc.invalidate_sub_cache(post.sid_id)
     return jsonify(status='ok')
 
 
@@ -1365,7 +1399,7 @@ def toggle_wikipost(post):
 def delete_flair(sub):
     """ Removes a flair (from edit flair page) """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         return jsonify(status='error', error=[_('Sub does not exist')])
 
@@ -1389,7 +1423,7 @@ def delete_flair(sub):
 def create_flair(sub):
     """ Creates a new flair (from edit flair page) """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -1562,8 +1596,11 @@ def delete_comment():
         comment.status = 1
         comment.save()
 
+        receivers = [x.receivedby_id for x in Message.select(Message.receivedby).where(Message.mlink == form.cid.data)]
         q = Message.delete().where(Message.mlink == form.cid.data)
         q.execute()
+        if receivers:
+            unread.reset(*receivers)
         return jsonify(status='ok')
     return json.dumps({'status': 'error', 'error': get_errors(form)})
 
@@ -1604,6 +1641,7 @@ def get_sibling(pid, cid, lim):
 
     if cid == 'null':
         cid = '0'
+    root = None
     if cid != '0':
         try:
             root = SubPostComment.get(SubPostComment.cid == cid)
@@ -1612,7 +1650,7 @@ def get_sibling(pid, cid, lim):
         except SubPostComment.DoesNotExist:
             return jsonify(status='ok', posts=[])
 
-    comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == pid).order_by(SubPostComment.score.desc()).dicts()
+    comments = misc.get_comment_subtree(pid, root)
     if not comments.count():
         return engine.get_template('sub/postcomments.html').render({'post': post, 'comments': [], 'subInfo': {}, 'highlight': ''})
 
@@ -1638,7 +1676,7 @@ def preview():
     form = DummyForm()
     if form.validate():
         if request.json.get('text'):
-            return jsonify(status='ok', text=misc.our_markdown(request.json.get('text')))
+            return jsonify(status='ok', text=misc.render_markdown(request.json.get('text')))
         else:
             return jsonify(status='error', error=_('Missing text'))
     return json.dumps({'status': 'error', 'error': get_errors(form)})
@@ -1686,7 +1724,7 @@ def ignore_user(uid):
 @login_required
 def sub_upload(sub):
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -1757,20 +1795,7 @@ def sub_upload(sub):
                                                            'error': _('Not enough available space to upload file.'), 'files': ufiles})
     # THUMBNAIL
     ufile.seek(0)
-    im = Image.open(ufile).convert('RGB')
-    x, y = im.size
-    while y > x:
-        slice_height = min(y - x, 10)
-        bottom = im.crop((0, y - slice_height, x, y))
-        top = im.crop((0, 0, x, slice_height))
-
-        if misc._image_entropy(bottom) < misc._image_entropy(top):
-            im = im.crop((0, 0, x, y - slice_height))
-        else:
-            im = im.crop((0, slice_height, x, y))
-
-        x, y = im.size
-
+    im = misc.smart_crop(Image.open(ufile).convert('RGB'))
     im.thumbnail((70, 70), Image.ANTIALIAS)
 
     im.seek(0)
@@ -1790,7 +1815,7 @@ def sub_upload(sub):
 @login_required
 def sub_upload_delete(sub, name):
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         jsonify(status='error')  # descriptive errors where?
     form = DummyForm()
@@ -1861,12 +1886,14 @@ def ban_user(username):
         abort(403)
 
     try:
-        user = User.get(fn.Lower(User.name) == username.lower())
+        user = User.get(User.uid == misc.get_uid(username))
     except User.DoesNotExist:
         abort(404)
 
     user.status = 5
     user.save()
+    misc.invalidate_user_cache(user.uid)
+    misc.invalidate_sub_cache(*misc.get_modded_sids(user.uid))
     misc.create_sitelog(misc.LOG_TYPE_USER_BAN, uid=current_user.uid, comment=user.name)
     return redirect(url_for('user.view', user=username))
 
@@ -1898,6 +1925,7 @@ def edit_top_bar():
         except SubSubscriber.DoesNotExist:
             pass  # TODO: Add these as status=4 SubSubscriber (after implementing some way to delete those)
 
+    misc.invalidate_user_cache(current_user.uid)
     return jsonify(status='ok')
 
 
@@ -1915,61 +1943,9 @@ def admin_undo_votes(uid):
     form = DummyForm()
     if not form.validate():
         return redirect(url_for('user.view', user=user.name))
-    
 
-    post_v = SubPostVote.select().where(SubPostVote.uid == user.uid)
-    comm_v = SubPostCommentVote.select().where(SubPostCommentVote.uid == user.uid)
-    usr = {}
-
-    for v in post_v:
-        try:
-            post = SubPost.select(SubPost.pid, SubPost.upvotes, SubPost.downvotes, SubPost.uid, SubPost.score).where(SubPost.pid == v.pid_id).get()
-        except SubPost.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        # Not removing self-votes
-        if post.uid_id == user.uid:
-            continue
-        if not usr.get(post.uid_id):
-            usr[post.uid_id] = User.select(User.uid, User.score).where(User.uid == post.uid_id).get()
-        tgus = usr[post.uid_id]
-        post.score -= 1 if v.positive else -1
-        tgus.score -= 1 if v.positive else -1
-        user.given -= 1 if v.positive else -1
-        if post.upvotes is not None and post.downvotes is not None:
-            if v.positive:
-                post.upvotes -= 1
-            else:
-                post.downvotes -= 1
-        post.save()
-        tgus.save()
-        v.delete_instance()
-    for v in comm_v:
-        try:
-            comm = SubPostComment.select(SubPostComment.cid, SubPostComment.upvotes, SubPostComment.downvotes, SubPostComment.score, SubPostComment.uid).where(SubPostComment.cid == v.cid).get()
-        except SubPostComment.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        if not usr.get(comm.uid_id):
-            usr[comm.uid_id] = User.select(User.uid, User.score).where(User.uid == comm.uid_id).get()
-        tgus = usr[comm.uid_id]
-        if not comm.score:
-            comm.score = 0
-        else:
-            comm.score -= 1 if v.positive else -1
-        tgus.score -= 1 if v.positive else -1
-        user.given -= 1 if v.positive else -1
-        if comm.upvotes is not None and comm.downvotes is not None:
-            if v.positive:
-                comm.upvotes -= 1
-            else:
-                comm.downvotes -= 1
-        comm.save()
-        tgus.save()
-        v.delete_instance()
-    user.save()
+    if not voteundo.enqueue(user.uid):
+        flash(_('The votes of this user are already being removed'), 'voteundo')
     return redirect(url_for('user.view', user=user.name))
 
 
@@ -3,7 +3,7 @@ import re
 from feedgen.feed import FeedGenerator
 from flask import Blueprint, request, url_for, Response, abort, render_template, redirect
 from flask_login import login_required, current_user
-from .. import misc
+from .. import misc, subindex
 from ..misc import engine
 from ..models import SubPost, UserUploads, Sub
 
@@ -20,7 +20,7 @@ def index():
 @bp.route("/hot/<int:page>")
 def hot(page):
     """ /hot for subscriptions """
-    posts = list(misc.getPostList(misc.postListQueryHome(), 'hot', page).dicts())
+    posts = misc.getRankedPostList(misc.postListQueryHome(), 'hot', page, misc.getHomeSids())
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.hot', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -31,7 +31,7 @@ def hot(page):
 @bp.route("/new/<int:page>")
 def new(page):
     """ /new for subscriptions """
-    posts = misc.getPostList(misc.postListQueryHome(), 'new', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryHome(), 'new', page, misc.getHomeSids())
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.new', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -42,7 +42,7 @@ def new(page):
 @bp.route("/top/<int:page>")
 def top(page):
     """ /top for subscriptions """
-    posts = misc.getPostList(misc.postListQueryHome(), 'top', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryHome(), 'top', page, misc.getHomeSids())
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.top', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -66,7 +66,7 @@ def all_new_rss():
 @bp.route("/all/new/<int:page>")
 def all_new(page):
     """ The index page, all posts sorted as most recent posted first """
-    posts = list(misc.getPostList(misc.postListQueryBase(), 'new', page).dicts())
+    posts = misc.getRankedPostList(misc.postListQueryBase(), 'new', page)
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.all_new', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -79,17 +79,23 @@ def all_new_more(pid=None):
     """ Returns more posts for /all/new (used for infinite scroll) """
     if not pid:
         abort(404)
-    posts = misc.getPostList(misc.postListQueryBase().where(SubPost.pid < pid), 'new', 1).dicts()
+    posts = list(misc.getPostListAfter(misc.postListQueryBase(), 'new', (pid, pid)).dicts())[:25]
     return engine.get_template('shared/post.html').render({'posts': posts, 'sub': False})
 
 
 @bp.route("/domain/<domain>", defaults={'page': 1})
 @bp.route("/domain/<domain>/<int:page>")
 def all_domain_new(domain, page):
-    """ The index page, all posts sorted as most recent posted first """
-    domain = re.sub(r'[^A-Za-z0-9.\-_]+', '', domain)
-    posts = misc.getPostList(misc.postListQueryBase(noAllFilter=True).where(SubPost.link % ('%://' + domain + '/%')),
-                             'new', page).dicts()
+    """ The index page, all posts linking to `domain` sorted as most recent posted first. If `domain` is a
+    registrable domain (like example.com or example.co.uk) its subdomains are included too """
+    domain = re.sub(r'[^A-Za-z0-9.\-_]+', '', domain).lower()
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    if misc.get_base_domain(domain) == domain:
+        query = misc.postListQueryBase(noAllFilter=True).where(SubPost.base_domain == domain)
+    else:
+        query = misc.postListQueryBase(noAllFilter=True).where(SubPost.domain == domain)
+    posts = misc.getPostList(query, 'new', page).dicts()
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.all_domain_new', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -99,10 +105,9 @@ def all_domain_new(domain, page):
 @bp.route("/search/<term>", defaults={'page': 1})
 @bp.route("/search/<term>/<int:page>")
 def search(page, term):
-    """ The index page, with basic title search """
+    """ The index page, with the posts matching the search terms (in their title or content) """
     term = re.sub(r'[^A-Za-z0-9.,\-_\'" ]+', '', term)
-    posts = misc.getPostList(misc.postListQueryBase().where(SubPost.title ** ('%' + term + '%')),
-                             'new', page).dicts()
+    posts = misc.getSearchPostList(misc.postListQueryBase(), term, page)
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.search', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -113,7 +118,7 @@ def search(page, term):
 @bp.route("/all/top/<int:page>")
 def all_top(page):
     """ The index page, all posts sorted as most recent posted first """
-    posts = misc.getPostList(misc.postListQueryBase(), 'top', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryBase(), 'top', page)
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.all_top', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
                                                      'changeLog': misc.getChangelog(), 'ann': misc.getAnnouncement(),
@@ -125,7 +130,7 @@ def all_top(page):
 @bp.route("/all/hot/<int:page>")
 def all_hot(page):
     """ The index page, all posts sorted as most recent posted first """
-    posts = misc.getPostList(misc.postListQueryBase(), 'hot', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryBase(), 'hot', page)
 
     return engine.get_template('index.html').render({'posts': posts, 'sort_type': 'home.all_hot', 'page': page,
                                                      'subOfTheDay': misc.getSubOfTheDay(),
@@ -173,6 +178,11 @@ def view_subs(page, sort):
     return render_template('subs.html', page=page, subs=c, nav='home.view_subs', sort=sort, cp_uri=cp_uri)
 
 
+# subs_search sort -> (SubIndex.search sort, descending)
+SUB_INDEX_SORTS = {'name_asc': ('name', False), 'name_desc': ('name', True), 'posts_asc': ('posts', False),
+                   'posts_desc': ('posts', True), 'subs_asc': ('subscribers', False), 'subs_desc': ('subscribers', True)}
+
+
 @bp.route("/subs/search/<term>", defaults={'page': 1, 'sort': 'name_asc'})
 @bp.route("/subs/search/<term>/<sort>", defaults={'page': 1})
 @bp.route("/subs/search/<term>/<int:page>", defaults={'sort': 'name_asc'})
@@ -182,7 +192,10 @@ def subs_search(page, term, sort):
     term = re.sub(r'[^A-Za-z0-9\-_]+', '', term)
     c = Sub.select(Sub.sid, Sub.name, Sub.title, Sub.nsfw, Sub.creation, Sub.subscribers, Sub.posts)
 
-    c = c.where(Sub.name.contains(term))
+    if term:
+        # The index sorts and paginates the matches, so we only load the subs of this page
+        index_sort, desc = SUB_INDEX_SORTS.get(sort, ('name', False))
+        c = c.where(Sub.name << subindex.search(term, index_sort, desc, page))
 
     # sorts...
     if sort == 'name_desc':
@@ -199,6 +212,6 @@ def subs_search(page, term, sort):
         c = c.order_by(Sub.subscribers.asc())
     else:
         return redirect(url_for('home.view_subs', page=page, sort='name_asc'))
-    c = c.paginate(page, 50).dicts()
+    c = (c if term else c.paginate(page, 50)).dicts()
     cp_uri = '/subs/search/' + term + '/' + str(page)
     return render_template('subs.html', page=page, subs=c, nav='home.subs_search', term=term, sort=sort, cp_uri=cp_uri)
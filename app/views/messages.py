@@ -3,7 +3,7 @@ from datetime import datetime
 from flask import Blueprint, redirect, url_for, render_template
 from flask_login import login_required, current_user
 from flask_babel import _
-from .. import misc
+from .. import misc, unread
 from ..models import Message
 from ..socketio import socketio
 
@@ -43,8 +43,9 @@ def view_messages(page):
 @login_required
 def view_mentions(page):
     """ View user name mentions """
-    Message.update(read=datetime.utcnow()).where(
+    count = Message.update(read=datetime.utcnow()).where(
         (Message.read.is_null(True)) & (Message.mtype == 8) & (Message.receivedby == current_user.uid)).execute()
+    unread.incr(current_user.uid, 8, -count)
 
     msgs = misc.getMentionsIndex(page)
     return render_template('messages/messages.html', page=page,
@@ -75,8 +76,9 @@ def view_ignores():
 @login_required
 def view_messages_postreplies(page):
     """ WIP: View user's post replies """
-    Message.update(read=datetime.utcnow()).where(
+    count = Message.update(read=datetime.utcnow()).where(
         (Message.read.is_null(True)) & (Message.mtype == 4) & (Message.receivedby == current_user.uid)).execute()
+    unread.incr(current_user.uid, 4, -count)
 
     socketio.emit('notification',
                   {'count': current_user.notifications},
@@ -93,8 +95,9 @@ def view_messages_postreplies(page):
 @login_required
 def view_messages_comreplies(page):
     """ WIP: View user's comments replies """
-    Message.update(read=datetime.utcnow()).where(
+    count = Message.update(read=datetime.utcnow()).where(
         (Message.read.is_null(True)) & (Message.mtype == 5) & (Message.receivedby == current_user.uid)).execute()
+    unread.incr(current_user.uid, 5, -count)
     socketio.emit('notification',
                   {'count': current_user.notifications},
                   namespace='/snt',
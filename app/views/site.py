@@ -60,8 +60,8 @@ def view_multisub_new(sublist, page=1):
     if len(names) > 20:
         names = names[20:]
 
-    subs = Sub.select(Sub.sid, Sub.name, Sub.title).where(Sub.name << names)
-    sids = [x.sid for x in subs]
+    sids = misc.get_sids(names)
+    subs = Sub.select(Sub.sid, Sub.name, Sub.title).where(Sub.sid << sids)
 
     posts = misc.getPostList(misc.postListQueryBase().where(Sub.sid << sids),
                              'new', page).dicts()
@@ -23,7 +23,7 @@ def view_sub(sub):
         return redirect(url_for('home.all_hot', page=1))
 
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -46,7 +46,7 @@ def view_sub(sub):
 def edit_sub_css(sub):
     """ Here we can edit sub info and settings """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -69,7 +69,7 @@ def edit_sub_css(sub):
 def edit_sub_flairs(sub):
     """ Here we manage the sub's flairs. """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -89,7 +89,7 @@ def edit_sub_flairs(sub):
 def edit_sub(sub):
     """ Here we can edit sub info and settings """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -111,7 +111,7 @@ def edit_sub(sub):
 def view_sublog(sub, page):
     """ Here we can see a log of mod/admin activity in the sub """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -124,7 +124,7 @@ def view_sublog(sub, page):
 def edit_sub_mods(sub):
     """ Here we can edit moderators for a sub """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -143,7 +143,7 @@ def edit_sub_mods(sub):
 def sub_new_rss(sub):
     """ RSS feed for /sub/new """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -167,12 +167,12 @@ def view_sub_new(sub, page):
         return redirect(url_for('home.all_new', page=1))
 
     try:
-        sub = Sub.select().where(fn.Lower(Sub.name) == sub.lower()).dicts().get()
+        sub = Sub.select().where(Sub.sid == misc.get_sid(sub)).dicts().get()
     except Sub.DoesNotExist:
         abort(404)
 
-    posts = misc.getPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
-                             'new', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
+                                   'new', page, sub['sid'])
 
     try:
         vm = SubMetadata.select().where(SubMetadata.sid == sub['sid']).where(SubMetadata.key == 'videomode').get().value
@@ -195,7 +195,7 @@ def view_sub_new(sub, page):
 def view_sub_bans(sub):
     """ See banned users for the sub """
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(sub))
     except Sub.DoesNotExist:
         abort(404)
 
@@ -225,12 +225,12 @@ def view_sub_top(sub, page):
         return redirect(url_for('home.all_top', page=1))
 
     try:
-        sub = Sub.select().where(fn.Lower(Sub.name) == sub.lower()).dicts().get()
+        sub = Sub.select().where(Sub.sid == misc.get_sid(sub)).dicts().get()
     except Sub.DoesNotExist:
         abort(404)
 
-    posts = misc.getPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
-                             'top', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
+                                   'top', page, sub['sid'])
 
     try:
         vm = SubMetadata.select().where(SubMetadata.sid == sub['sid']).where(SubMetadata.key == 'videomode').get().value
@@ -256,12 +256,12 @@ def view_sub_hot(sub, page):
     if sub.lower() == "all":
         return redirect(url_for('home.all_hot', page=1))
     try:
-        sub = Sub.select().where(fn.Lower(Sub.name) == sub.lower()).dicts().get()
+        sub = Sub.select().where(Sub.sid == misc.get_sid(sub)).dicts().get()
     except Sub.DoesNotExist:
         abort(404)
 
-    posts = misc.getPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
-                             'hot', page).dicts()
+    posts = misc.getRankedPostList(misc.postListQueryBase(noAllFilter=True).where(Sub.sid == sub['sid']),
+                                   'hot', page, sub['sid'])
     try:
         vm = SubMetadata.select().where(SubMetadata.sid == sub['sid']).where(SubMetadata.key == 'videomode').get().value
     except SubMetadata.DoesNotExist:
@@ -289,7 +289,7 @@ def view_post(sub, pid, comments=False, highlight=None):
     if post['sub'].lower() != sub.lower():
         abort(404)
     
-    sub = Sub.select().where(fn.Lower(Sub.name) == sub.lower()).dicts().get()
+    sub = Sub.select().where(Sub.sid == misc.get_sid(sub)).dicts().get()
     subInfo = misc.getSubData(sub['sid'])
 
     try:
@@ -299,7 +299,7 @@ def view_post(sub, pid, comments=False, highlight=None):
         is_saved = False
 
     if not comments:
-        comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == post['pid']).order_by(SubPostComment.score.desc()).dicts()
+        comments = misc.get_comment_subtree(post['pid'])
         if not comments.count():
             comments = []
         else:
@@ -346,13 +346,14 @@ def view_perm(sub, pid, cid):
     """ Permalink to comment """
     # We get the comment...
     try:
-        the_comment = SubPostComment.select().where(SubPostComment.cid == cid).dicts()[0]
-    except (SubPostComment.DoesNotExist, IndexError):
+        the_comment = SubPostComment.get(SubPostComment.cid == cid)
+    except SubPostComment.DoesNotExist:
         abort(404)
-    
-    comments = SubPostComment.select(SubPostComment.cid, SubPostComment.parentcid).where(SubPostComment.pid == pid).order_by(SubPostComment.score.desc()).dicts()
+
+    # ...and only the branch it's in
+    comments = misc.get_comment_subtree(pid, the_comment, context=True)
     if not comments.count():
-        comments = []
+        comment_tree = []
     else:
         comment_tree = misc.get_comment_tree(comments, cid, uid=current_user.uid)
     return view_post(sub, pid, comment_tree, cid)
@@ -1,11 +1,10 @@
 """ Generic sub actions (creating subs, creating posts, etc) """
 import uuid
 from datetime import datetime, timedelta, timezone
-from peewee import fn
 from flask import Blueprint, abort, request, render_template, redirect, url_for
 from flask_login import login_required, current_user
 from flask_babel import _, lazy_gettext as _l
-from .. import misc
+from .. import misc, ranking, search, sitestats, subindex, thumbnails, userstats
 from ..config import config
 from ..misc import engine
 from ..socketio import socketio
@@ -18,7 +17,7 @@ bp = Blueprint('subs', __name__)
 
 def post_over_limit():
     captcha = None
-    if misc.get_user_level(current_user.uid)[0] <= 4:
+    if current_user.get_user_level()[0] <= 4:
         captcha = misc.create_captcha()
     form = CreateSubPostForm()
     return engine.get_template('sub/createpost.html').render({'error': _('Wait a bit before posting.'), 'form': form, 'sub': None, 'captcha': captcha})
@@ -32,7 +31,7 @@ def submit(ptype, sub):
         abort(404)
 
     captcha = None
-    if misc.get_user_level(current_user.uid)[0] <= 4:
+    if current_user.get_user_level()[0] <= 4:
         captcha = misc.create_captcha()
 
     form = CreateSubPostForm()
@@ -44,7 +43,7 @@ def submit(ptype, sub):
     if sub != '':
         form.sub.data = sub
         try:
-            sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+            sub = Sub.get(Sub.sid == misc.get_sid(sub))
             subdata = misc.getSubData(sub.sid)
             if subdata.get('allow_polls', False):
                 form.ptype.choices.append(('poll', _l('Poll')))
@@ -70,7 +69,7 @@ def create_post(ptype, sub):
         abort(404)
 
     captcha = None
-    if misc.get_user_level(current_user.uid)[0] <= 4:
+    if current_user.get_user_level()[0] <= 4:
         captcha = misc.create_captcha()
 
     form = CreateSubPostForm()
@@ -82,7 +81,7 @@ def create_post(ptype, sub):
 
     if form.sub.data:
         try:
-            sub = Sub.get(fn.Lower(Sub.name) == form.sub.data.lower())
+            sub = Sub.get(Sub.sid == misc.get_sid(form.sub.data))
             subdata = misc.getSubData(sub.sid)
             if subdata.get('allow_polls', False):
                 form.ptype.choices.append(('poll', _l('Poll')))
@@ -95,7 +94,7 @@ def create_post(ptype, sub):
 
         return engine.get_template('sub/createpost.html').render({'error': misc.get_errors(form, True), 'form': form, 'sub': sub, 'captcha': captcha}), 400
 
-    if misc.get_user_level(current_user.uid)[0] <= 4:
+    if current_user.get_user_level()[0] <= 4:
         if not misc.validate_captcha(form.ctok.data, form.captcha.data):
             return engine.get_template('sub/createpost.html').render(
                 {'error': _("Invalid captcha."), 'form': form, 'sub': sub, 'captcha': captcha}), 400
@@ -112,7 +111,7 @@ def create_post(ptype, sub):
             pass
 
     try:
-        sub = Sub.get(fn.Lower(Sub.name) == form.sub.data.lower())
+        sub = Sub.get(Sub.sid == misc.get_sid(form.sub.data))
     except Sub.DoesNotExist:
         return engine.get_template('sub/createpost.html').render(
             {'error': _("Sub does not exist."), 'form': form, 'sub': sub, 'captcha': captcha}), 400
@@ -132,7 +131,7 @@ def create_post(ptype, sub):
         return engine.get_template('sub/createpost.html').render(
             {'error': _("Only mods can post on this sub."), 'form': form, 'sub': sub, 'captcha': captcha}), 400
 
-    if misc.get_user_level(current_user.uid)[0] < 7:
+    if current_user.get_user_level()[0] < 7:
         today = datetime.utcnow() - timedelta(days=1)
         lposts = SubPost.select().where(SubPost.uid == current_user.uid).where(SubPost.sid == sub.sid).where(
             SubPost.posted > today).count()
@@ -147,7 +146,6 @@ def create_post(ptype, sub):
              'captcha': captcha}), 400
 
     fileid = False
-    img = ''
     if form.ptype.data in ('link', 'upload'):
         # TODO: Make a different ptype for uploads?
         ptype = 1
@@ -177,7 +175,6 @@ def create_post(ptype, sub):
         if misc.is_domain_banned(form.link.data.lower()):
             return engine.get_template('sub/createpost.html').render(
                 {'error': _("This domain is banned."), 'form': form, 'sub': sub, 'captcha': captcha}), 400
-        img = misc.get_thumbnail(form.link.data)
     elif form.ptype.data == 'poll':
         ptype = 3
         # Check if this sub allows polls...
@@ -216,18 +213,23 @@ def create_post(ptype, sub):
         return engine.get_template('sub/createpost.html').render(
             {'error': _("Invalid post type"), 'form': form, 'sub': sub, 'captcha': captcha}), 400
 
+    posted = datetime.utcnow()
+    domain = misc.get_link_domain(form.link.data) if ptype == 1 else None
     post = SubPost.create(sid=sub.sid,
                           uid=current_user.uid,
                           title=form.title.data,
                           content=form.content.data if ptype != 1 else '',
                           link=form.link.data if ptype == 1 else None,
-                          posted=datetime.utcnow(),
+                          domain=domain,
+                          base_domain=misc.get_base_domain(domain),
+                          posted=posted,
                           score=1, upvotes=1, downvotes=0,
+                          hot=misc.get_hot_score(1, posted),
                           deleted=0,
                           comments=0,
                           ptype=ptype,
                           nsfw=form.nsfw.data if not sub.nsfw else 1,
-                          thumbnail=img)
+                          thumbnail='')
 
     if ptype == 3:
         # Create SubPostPollOption objects...
@@ -242,6 +244,7 @@ def create_post(ptype, sub):
                                    value=int(closetime.replace(tzinfo=timezone.utc).timestamp()))
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    ranking.add_post(post.pid, sub.sid, post.score, post.hot)
     addr = url_for('sub.view_post', sub=sub.name, pid=post.pid)
     posts = misc.getPostList(misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), 'new', 1).dicts()
     socketio.emit('thread',
@@ -255,14 +258,23 @@ def create_post(ptype, sub):
     # does not appear highlighted to everybody.
     SubPostVote.create(uid=current_user.uid, pid=post.pid, positive=True)
     User.update(given=User.given + 1).where(User.uid == current_user.uid).execute()
+    userstats.add_post(current_user.uid, sub.name)
+    userstats.add_votes(current_user.uid, 1, 0)
+    sitestats.incr(posts=1, upvotes=1)
+    misc.invalidate_user_cache(current_user.uid)
     # We send a yourvote message so that the upvote arrow *does* appear highlighted to the creator.
     socketio.emit('yourvote', {'pid': post.pid, 'status': 1, 'score': post.score}, namespace='/snt',
                   room='user' + current_user.uid)
 
     if fileid:
-        UserUploads.create(pid=post.pid, uid=current_user.uid, fileid=fileid, thumbnail=img if img else '',
+        UserUploads.create(pid=post.pid, uid=current_user.uid, fileid=fileid, thumbnail='',
                            status=0)
 
+    if ptype == 1:
+        # The thumbnail is fetched in the background and pushed to the clients when it's ready
+        thumbnails.enqueue(post.pid, post.link)
+    search.index_post(post)
+
     misc.workWithMentions(form.content.data, None, post, sub)
     misc.workWithMentions(form.title.data, None, post, sub)
     return redirect(addr)
@@ -292,13 +304,13 @@ def create_sub():
         return engine.get_template('sub/create.html').render({'error': _('Invalid sub name'), 'csubform': form})
 
     try:
-        Sub.get(fn.Lower(Sub.name) == form.subname.data.lower())
+        Sub.get(Sub.sid == misc.get_sid(form.subname.data))
         return engine.get_template('sub/create.html').render(
             {'error': _('Sub is already registered'), 'csubform': form})
     except Sub.DoesNotExist:
         pass
 
-    level = misc.get_user_level(current_user.uid)[0]
+    level = current_user.get_user_level()[0]
     if not config.app.testing and config.site.sub_creation_min_level != 0:
         if (level <= 1) and (not current_user.admin):
             return engine.get_template('sub/create.html').render(
@@ -323,10 +335,13 @@ def create_sub():
     SubMetadata.create(sid=sub.sid, key='mod', value=current_user.uid)
     SubMod.create(sid=sub.sid, uid=current_user.uid, power_level=0)
     SubStylesheet.create(sid=sub.sid, content='', source='/* CSS here */')
+    subindex.add_sub(sub.name, sub.subscribers)
+    sitestats.incr(subs=1)
 
     # admin/site log
     misc.create_sublog(misc.LOG_TYPE_SUB_CREATE, uid=current_user.uid, sid=sub.sid, admin=True)
 
     SubSubscriber.create(uid=current_user.uid, sid=sub.sid, status=1)
+    misc.invalidate_user_cache(current_user.uid)
 
     return redirect(url_for('sub.view_sub', sub=form.subname.data))
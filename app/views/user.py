@@ -1,14 +1,13 @@
 """ Profile and settings endpoints """
 import time
-from peewee import fn, JOIN
 from flask import Blueprint, render_template, abort, redirect, url_for
 from flask_login import login_required, current_user
 from flask_babel import _, Locale
-from .. import misc, config
+from .. import misc, config, userstats, votebuffer
 from ..misc import engine
 from ..forms import EditUserForm, CreateUserMessageForm, ChangePasswordForm, DeleteAccountForm, PasswordRecoveryForm
 from ..forms import PasswordResetForm
-from ..models import User, Sub, SubMod, SubPost, SubPostComment, UserSaved, InviteCode, UserMetadata
+from ..models import User, Sub, SubMod, SubPost, UserSaved, InviteCode, UserMetadata
 
 bp = Blueprint('user', __name__)
 
@@ -17,7 +16,7 @@ bp = Blueprint('user', __name__)
 def view(user):
     """ WIP: View user's profile, posts, comments, badges, etc """
     try:
-        user = User.get(fn.lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         abort(404)
 
@@ -29,14 +28,11 @@ def view(user):
     owns = [x.sub.name for x in modsquery if x.power_level == 0]
     mods = [x.sub.name for x in modsquery if 1 <= x.power_level <= 2]
     badges = misc.getUserBadges(user.uid)
-    pcount = SubPost.select().where(SubPost.uid == user.uid).count()
-    ccount = SubPostComment.select().where(SubPostComment.uid == user.uid).count()
+    stats = userstats.get(user.uid)
 
-    habit = Sub.select(Sub.name, fn.Count(SubPost.pid).alias('count')).join(SubPost, JOIN.LEFT_OUTER,
-                                                                            on=(SubPost.sid == Sub.sid))
-    habit = habit.where(SubPost.uid == user.uid).group_by(Sub.sid).order_by(fn.Count(SubPost.pid).desc()).limit(10)
-
-    level, xp = misc.get_user_level(user.uid)
+    # The user was just loaded, only the xp still waiting in the vote buffer has to be added
+    xp = votebuffer.merge('user', [{'uid': user.uid, 'xp': user.xp}], 'uid')[0]['xp']
+    level, xp = misc.get_level(xp)
 
     if xp > 0:
         currlv = (level ** 2) * 10
@@ -47,11 +43,13 @@ def view(user):
     else:
         progress = 0
 
-    givenScore = misc.getUserGivenScore(user.uid)
+    pos, neg = stats['upvotes_given'], stats['downvotes_given']
+    givenScore = (pos, neg, pos - neg)
 
     return engine.get_template('user/profile.html').render(
-        {'user': user, 'level': level, 'progress': progress, 'postCount': pcount, 'commentCount': ccount,
-         'givenScore': givenScore, 'badges': badges, 'owns': owns, 'mods': mods, 'habits': habit,
+        {'user': user, 'level': level, 'progress': progress, 'postCount': stats['post_count'],
+         'commentCount': stats['comment_count'], 'givenScore': givenScore, 'badges': badges, 'owns': owns,
+         'mods': mods, 'habits': stats['habits'],
          'msgform': CreateUserMessageForm()})
     # return render_template('../html/user/profile.html', user=user, badges=badges, habit=habit,
     #                        msgform=CreateUserMessageForm(), pcount=pcount,
@@ -63,7 +61,7 @@ def view(user):
 def view_user_posts(user, page):
     """ WIP: View user's recent posts """
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         abort(404)
     if user.status == 10:
@@ -101,7 +99,7 @@ def view_user_savedposts(user, page):
 def view_user_comments(user, page):
     """ WIP: View user's recent comments """
     try:
-        user = User.get(fn.Lower(User.name) == user.lower())
+        user = User.get(User.uid == misc.get_uid(user))
     except User.DoesNotExist:
         abort(404)
     if user.status == 10:
@@ -0,0 +1,150 @@
+""" Write-behind buffer for the vote counters.
+
+When `votes.write_behind` is enabled, cast_vote still stores every vote in the database right away, but the
+counters that every vote on a popular post fights over (the post or comment's score, upvotes and downvotes and
+the score, xp and given of the users) are added to redis hashes instead. The worker (see scripts/votebuffer.py)
+moves them to the database in batches every `votes.flush_interval` seconds.
+
+Until they're flushed, the pending changes have to be added to whatever we read from the database; `merge`
+does that for lists of dicts.
+
+`flush` moves a batch of changes to the FLUSHING_KEY hash and only deletes it once they're committed. If the
+worker dies before that, the same batch is flushed again when it comes back (so only one worker may run at
+a time).
+"""
+import logging
+import time
+from .config import config
+from .models import rconn, db, SubPost, SubPostComment, User
+
+DIRTY_KEY = 'votebuffer/dirty'
+# The batch being flushed. Fields are '<kind>:<ident>/<field>'
+FLUSHING_KEY = 'votebuffer/flushing'
+FIELDS = {'post': ('score', 'upvotes', 'downvotes'),
+          'comment': ('score', 'upvotes', 'downvotes'),
+          'user': ('score', 'xp', 'given')}
+# Targets flushed per transaction
+FLUSH_BATCH = 500
+
+# Moves up to ARGV[1] dirty targets to the flushing hash and returns it. If a previous flush left a batch there,
+# that one is returned again instead. Reading and deleting every target's hash in one go means no increment
+# can land in between
+_take = rconn.register_script("""
+if redis.call('exists', KEYS[2]) == 1 then
+    return redis.call('hgetall', KEYS[2])
+end
+for _, member in ipairs(redis.call('spop', KEYS[1], ARGV[1])) do
+    local kind, ident = member:match('^([^:]+):(.*)$')
+    local key = 'votebuffer/' .. kind .. '/' .. ident
+    local values = redis.call('hgetall', key)
+    redis.call('del', key)
+    for i = 1, #values, 2 do
+        redis.call('hincrby', KEYS[2], member .. '/' .. values[i], values[i + 1])
+    end
+end
+return redis.call('hgetall', KEYS[2])
+""")
+
+
+def enabled():
+    return bool(config.votes.write_behind)
+
+
+def _key(kind, ident):
+    return 'votebuffer/{0}/{1}'.format(kind, ident)
+
+
+def add(target_type, pcid, score, upvotes, downvotes, author, voter, given):
+    """ Buffers the counter changes of a vote. `target_type` is 'post' or 'comment'.
+    Returns the pending score of the target and of its author, including this vote. """
+    target = _key(target_type, pcid)
+    p = rconn.pipeline()
+    p.hincrby(target, 'score', score)
+    p.hincrby(target, 'upvotes', upvotes)
+    p.hincrby(target, 'downvotes', downvotes)
+    p.hincrby(_key('user', voter), 'given', given)
+    p.sadd(DIRTY_KEY, '{0}:{1}'.format(target_type, pcid), 'user:' + voter)
+    # Posts and comments of deleted accounts may have no author
+    if author:
+        p.hincrby(_key('user', author), 'score', score)
+        p.hincrby(_key('user', author), 'xp', score)
+        p.sadd(DIRTY_KEY, 'user:' + author)
+    result = p.execute()
+    return result[0], result[5] if author else 0
+
+
+def get_pending(kind, idents):
+    """ Returns an ident -> {field: delta} dict with the pending changes of the given posts, comments or users.
+    Idents without pending changes are left out. """
+    if not enabled() or not idents:
+        return {}
+    idents = list(idents)
+    p = rconn.pipeline(transaction=False)
+    for ident in idents:
+        p.hgetall(_key(kind, ident))
+    pending = {}
+    for ident, values in zip(idents, p.execute()):
+        if values:
+            pending[ident] = {k.decode(): int(v) for k, v in values.items()}
+    return pending
+
+
+def merge(kind, rows, key):
+    """ Adds the pending changes to a list of dicts in place, `key` being the name of their pid, cid or uid
+    field. Only the counters present in the dicts are touched. Returns the list. """
+    pending = get_pending(kind, set(x[key] for x in rows))
+    for row in rows:
+        for field, delta in pending.get(row[key], {}).items():
+            if row.get(field) is not None:
+                row[field] += delta
+    return rows
+
+
+def _apply(kind, ident, deltas):
+    if kind == 'user':
+        User.update(score=User.score + deltas.get('score', 0), xp=User.xp + deltas.get('xp', 0),
+                    given=User.given + deltas.get('given', 0)).where(User.uid == ident).execute()
+        return
+    model = SubPost if kind == 'post' else SubPostComment
+    fields = dict(score=model.score + deltas.get('score', 0), upvotes=model.upvotes + deltas.get('upvotes', 0),
+                  downvotes=model.downvotes + deltas.get('downvotes', 0))
+    if kind == 'post':
+        fields['hot'] = SubPost.hot + deltas.get('score', 0) * 20
+    model.update(**fields).where(model._meta.primary_key == (int(ident) if kind == 'post' else ident)).execute()
+
+
+def flush():
+    """ Moves one batch of pending changes to the database. Returns the uids of the users whose counters
+    changed, or None if there was nothing to flush. """
+    values = _take(keys=[DIRTY_KEY, FLUSHING_KEY], args=[FLUSH_BATCH])
+    if not values:
+        return None
+    taken = {}
+    for i in range(0, len(values), 2):
+        member, field = values[i].decode().rsplit('/', 1)
+        kind, ident = member.split(':', 1)
+        taken.setdefault((kind, ident), {})[field] = int(values[i + 1])
+
+    with db.atomic():
+        for (kind, ident), deltas in taken.items():
+            if any(deltas.values()):
+                _apply(kind, ident, deltas)
+    # If this fails (or we die before getting here) the batch is flushed again
+    rconn.delete(FLUSHING_KEY)
+    return [ident for kind, ident in taken if kind == 'user']
+
+
+def work():
+    """ Flushes the buffer forever """
+    # misc imports this module
+    from . import misc
+    while True:
+        try:
+            uids = flush()
+        except Exception:
+            logging.exception('Could not flush the vote buffer')
+            uids = None
+        if uids:
+            misc.invalidate_user_cache(*uids)
+        if uids is None or rconn.scard(DIRTY_KEY) < FLUSH_BATCH:
+            time.sleep(config.votes.flush_interval)
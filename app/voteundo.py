@@ -0,0 +1,163 @@
+""" Background removal of all the votes cast by a user (the admin "Remove votes" button).
+
+A user can have tens of thousands of votes, so the admin view only queues the job with `enqueue` and the worker
+(see scripts/voteundo.py) does the work. Votes are processed in chunks of `CHUNK_SIZE`: the changes to every
+post or comment and to every author are added up with GROUP BY, applied with one UPDATE per table and the votes
+are deleted, all in one transaction per chunk. The progress is kept in redis and shown in the user's sidebar.
+
+The worker moves each job to `PROCESSING_KEY` while it runs it and puts back whatever is left there when it
+starts, so a job isn't lost if the worker dies. Chunks are committed as they go, so a job that's run again only
+picks up the votes that are left. While it runs, the job's status expires unless it's refreshed after every
+chunk, so a dead job doesn't keep the user from being queued again.
+"""
+import json
+import logging
+from peewee import fn, Case
+from .models import rconn, db, User, SubPost, SubPostComment, SubPostVote, SubPostCommentVote
+from . import ranking, sitestats, userstats
+
+QUEUE_KEY = 'voteundo/queue'
+PROCESSING_KEY = 'voteundo/processing'
+CHUNK_SIZE = 1000
+# How long the result of a finished job is shown
+STATUS_TTL = 86400
+# How long a running job's status lasts without progress before the job is considered dead
+RUNNING_TTL = 600
+
+
+def _status_key(uid):
+    return 'voteundo/status/{0}'.format(uid)
+
+
+def get_status(uid):
+    """ Returns a dict with the `state` ('queued', 'running', 'done' or 'failed') of the vote removal of a user,
+    the `total` number of votes and how many are `done`, or None if there's no job """
+    status = rconn.hgetall(_status_key(uid))
+    if not status:
+        return None
+    status = {k.decode(): v.decode() for k, v in status.items()}
+    return {'state': status['state'], 'total': int(status['total']), 'done': int(status['done'])}
+
+
+def enqueue(uid):
+    """ Queues the removal of all the votes of a user. Returns False if it's already queued or running (a job
+    that stopped making progress isn't running anymore) """
+    status = get_status(uid)
+    if status and status['state'] in ('queued', 'running'):
+        return False
+    total = SubPostVote.select().where(SubPostVote.uid == uid).count()
+    total += SubPostCommentVote.select().where(SubPostCommentVote.uid == uid).count()
+    key = _status_key(uid)
+    p = rconn.pipeline()
+    p.delete(key)
+    p.hset(key, mapping={'state': 'queued', 'total': total, 'done': 0})
+    p.lpush(QUEUE_KEY, json.dumps({'uid': uid}))
+    p.execute()
+    return True
+
+
+def _undo_chunk(uid, target_type, last):
+    """ Removes the next chunk of votes of `uid` on posts or comments, starting after the vote with xid `last`.
+    Returns a (last xid, votes processed, authors whose score changed) tuple, or None if there are no votes left. """
+    if target_type == 'post':
+        model, field, target, target_pk = SubPostVote, SubPostVote.pid, SubPost, SubPost.pid
+    else:
+        model, field, target, target_pk = SubPostCommentVote, SubPostCommentVote.cid, SubPostComment, SubPostComment.cid
+
+    xids = model.select(model.xid).where((model.uid == uid) & (model.xid > last)).order_by(model.xid)
+    xids = [x for x, in xids.limit(CHUNK_SIZE).tuples()]
+    if not xids:
+        return None
+    in_chunk = (model.uid == uid) & (model.xid.between(xids[0], xids[-1]))
+    removed = in_chunk
+    if target_type == 'post':
+        # Self-votes on posts are kept (they're cast when the post is created)
+        removed &= target.uid != uid
+
+    value = Case(None, [(model.positive == 1, 1)], -1)
+    targets = model.select(field.alias('id'), fn.SUM(value).alias('score'),
+                           fn.SUM(Case(None, [(model.positive == 1, 1)], 0)).alias('upvotes'),
+                           fn.SUM(Case(None, [(model.positive == 1, 0)], 1)).alias('downvotes'))
+    targets = list(targets.join(target, on=(target_pk == field)).where(removed).group_by(field).dicts())
+    authors = model.select(target.uid.alias('uid'), fn.SUM(value).alias('score'))
+    authors = authors.join(target, on=(target_pk == field)).where(removed & target.uid.is_null(False))
+    authors = {x['uid']: x['score'] for x in authors.group_by(target.uid).dicts()}
+    given = sum(x['score'] for x in targets)
+    upvotes = sum(x['upvotes'] for x in targets)
+    downvotes = sum(x['downvotes'] for x in targets)
+
+    with db.atomic():
+        if targets:
+            ids = [x['id'] for x in targets]
+
+            def delta(name, factor=1):
+                return Case(target_pk, [(x['id'], x[name] * factor) for x in targets], 0)
+
+            fields = {target.score: fn.COALESCE(target.score, 0) - delta('score'),
+                      target.upvotes: target.upvotes - delta('upvotes'),
+                      target.downvotes: target.downvotes - delta('downvotes')}
+            if target_type == 'post':
+                # The time component of the hot ranking doesn't change, so it moves along with the score
+                fields[SubPost.hot] = SubPost.hot - delta('score', 20)
+            target.update(fields).where(target_pk << ids).execute()
+            User.update(score=User.score - Case(User.uid, list(authors.items()), 0),
+                        xp=User.xp - Case(User.uid, list(authors.items()), 0),
+                        given=User.given - Case(User.uid, [(uid, given)], 0)).where(
+                User.uid << list(set(authors) | {uid})).execute()
+            userstats.add_votes(uid, -upvotes, -downvotes)
+        delete = model.delete().where(in_chunk)
+        if target_type == 'post':
+            delete = delete.where(field.is_null() | field.not_in(SubPost.select(SubPost.pid).where(SubPost.uid == uid)))
+        # Votes on posts or comments that no longer exist are deleted too
+        delete.execute()
+    sitestats.incr(upvotes=-upvotes, downvotes=-downvotes)
+
+    if target_type == 'post' and targets:
+        sids = dict(SubPost.select(SubPost.pid, SubPost.sid).where(SubPost.pid << ids).tuples())
+        for post in targets:
+            ranking.incr_post(post['id'], sids[post['id']], -post['score'])
+    return xids[-1], len(xids), list(authors)
+
+
+def _heartbeat(key, done=0):
+    """ Marks the job as running for another `RUNNING_TTL` seconds, adding `done` to the processed votes """
+    p = rconn.pipeline()
+    p.hset(key, 'state', 'running')
+    p.hincrby(key, 'done', done)
+    p.expire(key, RUNNING_TTL)
+    p.execute()
+
+
+def process(uid):
+    """ Removes all the votes of a user, updating the job's status as it goes """
+    # misc imports this module
+    from . import misc
+    key = _status_key(uid)
+    _heartbeat(key)
+    for target_type in ('post', 'comment'):
+        last = 0
+        while True:
+            result = _undo_chunk(uid, target_type, last)
+            if result is None:
+                break
+            last, count, authors = result
+            misc.invalidate_user_cache(uid, *authors)
+            _heartbeat(key, count)
+    rconn.hset(key, 'state', 'done')
+    rconn.expire(key, STATUS_TTL)
+
+
+def work():
+    """ Processes the queue forever, after putting back the jobs a previous worker didn't finish """
+    while rconn.rpoplpush(PROCESSING_KEY, QUEUE_KEY):
+        pass
+    while True:
+        raw = rconn.brpoplpush(QUEUE_KEY, PROCESSING_KEY, 0)
+        job = json.loads(raw.decode())
+        try:
+            process(job['uid'])
+        except Exception:
+            logging.exception('Could not remove the votes of user %s', job['uid'])
+            rconn.hset(_status_key(job['uid']), 'state', 'failed')
+            rconn.expire(_status_key(job['uid']), STATUS_TTL)
+        rconn.lrem(PROCESSING_KEY, 1, raw)
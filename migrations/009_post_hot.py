@@ -0,0 +1,61 @@
+"""Peewee migrations -- 009_post_hot.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    SubPost = migrator.orm['sub_post']
+    migrator.add_fields(SubPost, hot=pw.DoubleField(default=0))
+
+    def backfill_hot():
+        if isinstance(database, pw.PostgresqlDatabase):
+            epoch = "EXTRACT(EPOCH FROM posted)"
+        elif isinstance(database, pw.MySQLDatabase):
+            epoch = "UNIX_TIMESTAMP(posted)"
+        else:
+            epoch = "CAST(strftime('%s', posted) AS INTEGER)"
+        database.execute_sql("UPDATE sub_post SET hot = COALESCE(score, 0) * 20 + ({0} - 1134028003) / 1500.0"
+                             .format(epoch))
+
+    migrator.python(backfill_hot)
+    migrator.add_index(SubPost, 'sid', 'deleted', 'hot')
+    migrator.add_index(SubPost, 'deleted', 'hot')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    SubPost = migrator.orm['sub_post']
+    migrator.drop_index(SubPost, 'deleted', 'hot')
+    migrator.drop_index(SubPost, 'sid', 'deleted', 'hot')
+    migrator.remove_fields(SubPost, 'hot')
@@ -0,0 +1,81 @@
+"""Peewee migrations -- 010_comment_path.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import hashlib
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+SEGMENT = 8
+MAX_LENGTH = 255
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    SubPostComment = migrator.orm['sub_post_comment']
+    migrator.add_fields(SubPostComment,
+                        path=pw.CharField(max_length=MAX_LENGTH, null=True),
+                        depth=pw.IntegerField(default=0))
+
+    def backfill_paths():
+        """ Same as misc.get_comment_path, one post at a time """
+        param = database.param
+        posts = database.execute_sql("SELECT DISTINCT pid FROM sub_post_comment WHERE pid IS NOT NULL").fetchall()
+        for (pid,) in posts:
+            rows = database.execute_sql("SELECT cid, parentcid FROM sub_post_comment WHERE pid = {0}".format(param),
+                                        (pid,)).fetchall()
+            children = {}
+            for cid, parentcid in rows:
+                children.setdefault(parentcid, []).append(cid)
+
+            updates = []
+            pending = [(cid, '', -1) for cid in children.get(None, [])]
+            while pending:
+                cid, ppath, pdepth = pending.pop()
+                segment = hashlib.md5(str(cid).encode()).hexdigest()[:SEGMENT]
+                path = ppath + segment if len(ppath) + SEGMENT <= MAX_LENGTH else ppath
+                updates.append((path, pdepth + 1, cid))
+                pending.extend((x, path, pdepth + 1) for x in children.get(cid, []))
+
+            with database.atomic():
+                for update in updates:
+                    database.execute_sql("UPDATE sub_post_comment SET path = {0}, depth = {0} WHERE cid = {0}"
+                                         .format(param), update)
+
+    migrator.python(backfill_paths)
+    migrator.add_index(SubPostComment, 'pid', 'path')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    SubPostComment = migrator.orm['sub_post_comment']
+    migrator.drop_index(SubPostComment, 'pid', 'path')
+    migrator.remove_fields(SubPostComment, 'path', 'depth')
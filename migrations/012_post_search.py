@@ -0,0 +1,59 @@
+"""Peewee migrations -- 012_post_search.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    @migrator.create_model
+    class SubPostSearchToken(pw.Model):
+        token = pw.CharField(max_length=32)
+        pid = pw.ForeignKeyField(db_column='pid', model=migrator.orm['sub_post'], field='pid')
+        weight = pw.IntegerField()
+
+        class Meta:
+            table_name = "sub_post_search_token"
+            indexes = (
+                (('token', 'pid'), True),
+            )
+
+    if isinstance(database, pw.MySQLDatabase):
+        # The default collations ignore case and accents, so tokens like 'café' and 'cafe' would clash in the
+        # unique index. The tokens are already lowercase and we want them compared as they are.
+        migrator.sql('ALTER TABLE `sub_post_search_token` MODIFY `token` VARCHAR(32) '
+                     'CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.remove_model('sub_post_search_token')
@@ -0,0 +1,106 @@
+"""Peewee migrations -- 013_post_domain.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+from urllib.parse import urlparse
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+# Same as misc.MULTI_LABEL_SUFFIXES when this migration was written
+MULTI_LABEL_SUFFIXES = frozenset((
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk', 'sch.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'co.nz', 'net.nz', 'org.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp', 'co.kr', 'or.kr', 'co.in', 'net.in', 'org.in',
+    'com.br', 'net.br', 'org.br', 'gov.br', 'com.ar', 'com.mx', 'com.cn', 'net.cn', 'org.cn',
+    'com.tw', 'com.hk', 'com.sg', 'com.tr', 'com.ua', 'com.pl', 'co.il', 'co.za',
+    'github.io', 'gitlab.io', 'blogspot.com', 'appspot.com', 'herokuapp.com', 'wordpress.com', 'tumblr.com',
+))
+
+
+def get_link_domain(link):
+    """ Same as misc.get_link_domain """
+    try:
+        host = urlparse(link).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    host = host.rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return host[:255] or None
+
+
+def get_base_domain(domain):
+    """ Same as misc.get_base_domain """
+    if not domain:
+        return None
+    labels = domain.split('.')
+    if ':' in domain or labels[-1].isdigit():
+        return domain
+    if len(labels) > 2 and '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    SubPost = migrator.orm['sub_post']
+    migrator.add_fields(SubPost,
+                        domain=pw.CharField(max_length=255, null=True),
+                        base_domain=pw.CharField(max_length=255, null=True))
+
+    def backfill_domains():
+        param = database.param
+        last = 0
+        while True:
+            rows = database.execute_sql("SELECT pid, link FROM sub_post WHERE link IS NOT NULL AND pid > {0} "
+                                        "ORDER BY pid LIMIT 1000".format(param), (last,)).fetchall()
+            if not rows:
+                break
+            with database.atomic():
+                for pid, link in rows:
+                    domain = get_link_domain(link)
+                    database.execute_sql("UPDATE sub_post SET domain = {0}, base_domain = {0} WHERE pid = {0}"
+                                         .format(param), (domain, get_base_domain(domain), pid))
+            last = rows[-1][0]
+
+    migrator.python(backfill_domains)
+    migrator.add_index(SubPost, 'domain', 'pid')
+    migrator.add_index(SubPost, 'base_domain', 'pid')
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    SubPost = migrator.orm['sub_post']
+    migrator.drop_index(SubPost, 'base_domain', 'pid')
+    migrator.drop_index(SubPost, 'domain', 'pid')
+    migrator.remove_fields(SubPost, 'domain', 'base_domain')
@@ -0,0 +1,88 @@
+"""Peewee migrations -- 014_unique_votes.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    SubPostVote = migrator.orm['sub_post_vote']
+    SubPostCommentVote = migrator.orm['sub_post_comment_vote']
+    User = migrator.orm['user']
+
+    def dedupe_votes(table, target, target_table, target_pk):
+        """ Only keeps the most recent vote of every user on every post or comment and recounts the votes of
+        the posts or comments that had duplicates, the score of their authors and the `given` of the voters """
+        param = database.param
+        affected = database.execute_sql("SELECT DISTINCT {1} FROM {0} WHERE uid IS NOT NULL AND {1} IS NOT NULL "
+                                        "GROUP BY uid, {1} HAVING COUNT(*) > 1".format(table, target)).fetchall()
+        # The derived table is there because MySQL doesn't allow a subquery on the table we're deleting from
+        duplicates = ("uid IS NOT NULL AND {1} IS NOT NULL AND xid NOT IN "
+                      "(SELECT xid FROM (SELECT MAX(xid) AS xid FROM {0} GROUP BY uid, {1}) AS keep)"
+                      .format(table, target))
+        # Every duplicate was added to the `given` of its voter
+        given = database.execute_sql("SELECT uid, SUM(CASE WHEN positive = 1 THEN 1 ELSE -1 END) FROM {0} "
+                                     "WHERE {1} GROUP BY uid".format(table, duplicates)).fetchall()
+        database.execute_sql("DELETE FROM {0} WHERE {1}".format(table, duplicates))
+        for uid, amount in given:
+            User.update(given=User.given - amount).where(User.uid == uid).execute()
+
+        for (pcid,) in affected:
+            upvotes, downvotes = database.execute_sql(
+                "SELECT COALESCE(SUM(CASE WHEN positive = 1 THEN 1 ELSE 0 END), 0), "
+                "COALESCE(SUM(CASE WHEN positive = 0 THEN 1 ELSE 0 END), 0) FROM {0} WHERE {1} = {2}"
+                .format(table, target, param), (pcid,)).fetchone()
+            old_score, author = database.execute_sql("SELECT COALESCE(score, 0), uid FROM {0} WHERE {1} = {2}"
+                                                     .format(target_table, target_pk, param), (pcid,)).fetchone()
+            score = upvotes - downvotes
+            database.execute_sql("UPDATE {0} SET upvotes = {2}, downvotes = {2}, score = {2} WHERE {1} = {2}"
+                                 .format(target_table, target_pk, param), (upvotes, downvotes, score, pcid))
+            if target_table == 'sub_post':
+                # Same as cast_vote: hot moves 20 points per point of score
+                database.execute_sql("UPDATE sub_post SET hot = hot + {0} WHERE pid = {0}".format(param),
+                                     ((score - old_score) * 20, pcid))
+            if author and score != old_score:
+                # The author's score moves along with the score of the post or comment
+                User.update(score=User.score + (score - old_score)).where(User.uid == author).execute()
+
+    migrator.python(dedupe_votes, 'sub_post_vote', 'pid', 'sub_post', 'pid')
+    migrator.python(dedupe_votes, 'sub_post_comment_vote', 'cid', 'sub_post_comment', 'cid')
+    migrator.add_index(SubPostVote, 'uid', 'pid', unique=True)
+    migrator.add_index(SubPostCommentVote, 'uid', 'cid', unique=True)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    SubPostVote = migrator.orm['sub_post_vote']
+    SubPostCommentVote = migrator.orm['sub_post_comment_vote']
+    migrator.drop_index(SubPostCommentVote, 'uid', 'cid')
+    migrator.drop_index(SubPostVote, 'uid', 'pid')
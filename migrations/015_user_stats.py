@@ -0,0 +1,54 @@
+"""Peewee migrations -- 015_user_stats.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    # Rows are built from the posts, comments and votes the first time they're needed
+    @migrator.create_model
+    class UserStats(pw.Model):
+        uid = pw.ForeignKeyField(db_column='uid', model=migrator.orm['user'], field='uid', primary_key=True)
+        post_count = pw.IntegerField(default=0)
+        comment_count = pw.IntegerField(default=0)
+        upvotes_given = pw.IntegerField(default=0)
+        downvotes_given = pw.IntegerField(default=0)
+        habits = pw.TextField(default='{}')
+
+        class Meta:
+            table_name = "user_stats"
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.remove_model('user_stats')
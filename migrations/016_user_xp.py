@@ -0,0 +1,64 @@
+"""Peewee migrations -- 016_user_xp.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import datetime as dt
+import peewee as pw
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+# Badge scores from app/badges.py when this migration was written
+BADGE_SCORES = {'admin': 700, 'bugger': 500, 'eadop': 500, 'donor': 500, 'splaw': 100, 'hitler': 100, 'miner': 300,
+                'spotlight': 200, 'commando': 300, 'enthusiasm': -100, 'broccoli': 100, 'cabbage': 100,
+                'shitposter2018': 250}
+
+
+def migrate(migrator, database, fake=False, **kwargs):
+    """Write your migrations here."""
+    User = migrator.orm['user']
+    UserMetadata = migrator.orm['user_metadata']
+    migrator.add_fields(User, xp=pw.IntegerField(default=0))
+
+    def backfill_xp():
+        bonus = {}
+        badges = UserMetadata.select(UserMetadata.uid, UserMetadata.value).where(UserMetadata.key == 'badge')
+        for uid, value in badges.tuples():
+            bonus[uid] = bonus.get(uid, 0) + BADGE_SCORES.get(value, 0)
+        with database.atomic():
+            User.update(xp=User.score).execute()
+            for uid, score in bonus.items():
+                if score:
+                    User.update(xp=User.score + score).where(User.uid == uid).execute()
+
+    migrator.python(backfill_xp)
+
+
+def rollback(migrator, database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.remove_fields(migrator.orm['user'], 'xp')
@@ -10,6 +10,7 @@ from app.models import User, Client, Grant, Message, SiteLog, SiteMetadata, Sub,
     SubSubscriber, Token, UserMetadata, UserSaved, \
     UserUploads, UserIgnores, \
     SubUploads, SubPostPollOption, SubPostPollVote, SubPostReport, APIToken, APITokenSettings
+from app.misc import invalidate_user_cache
 
 parser = argparse.ArgumentParser(description='Manage administrators.')
 addremove = parser.add_mutually_exclusive_group(required=True)
@@ -27,6 +28,7 @@ if args.add:
         print("Error: User does not exist")
         sys.exit(1)
     UserMetadata.create(uid=user.uid, key='admin', value='1')
+    invalidate_user_cache(user.uid)
     print("Done.")
 elif args.remove:
     try:
@@ -38,6 +40,7 @@ elif args.remove:
     try:
         umeta = UserMetadata.get((UserMetadata.uid == user.uid) & (UserMetadata.key == 'admin'))
         umeta.delete_instance()
+        invalidate_user_cache(user.uid)
         print("Done.")
     except UserMetadata.DoesNotExist:
         print("Error: User is not an administrator.")
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+""" Benchmarks the comment tree builder with synthetic threads """
+import __fix
+import argparse
+import random
+import time
+
+from app.misc import build_comment_tree
+
+parser = argparse.ArgumentParser(description='Benchmark the comment tree builder.')
+parser.add_argument('--sizes', metavar='N', type=int, nargs='+', default=[1000, 2500, 5000, 10000],
+                    help='Number of comments of each thread')
+parser.add_argument('--runs', type=int, default=5, help='Runs per thread size (the best one is reported)')
+parser.add_argument('--seed', type=int, default=1, help='Random seed used to generate the threads')
+args = parser.parse_args()
+
+
+def make_thread(size):
+    """ Generates a thread where every comment replies to the post or to a random previous comment """
+    comments = []
+    for cid in range(size):
+        parent = None if not comments or random.random() < 0.2 else random.choice(comments)['cid']
+        comments.append({'cid': cid, 'parentcid': parent})
+    random.shuffle(comments)
+    return comments
+
+
+random.seed(args.seed)
+print("{0:>10} {1:>12} {2:>14}".format('comments', 'best (ms)', 'us/comment'))
+for size in args.sizes:
+    thread = make_thread(size)
+    best = None
+    for _ in range(args.runs):
+        comments = [dict(x) for x in thread]
+        start = time.perf_counter()
+        build_comment_tree(comments)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{0:>10} {1:>12.2f} {2:>14.3f}".format(size, best * 1000, best * 1e6 / size))
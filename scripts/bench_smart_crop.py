@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+""" Benchmarks the thumbnail smart crop with tall synthetic images """
+import __fix
+import argparse
+import time
+
+import numpy
+from PIL import Image
+
+from app.misc import smart_crop
+
+parser = argparse.ArgumentParser(description='Benchmark the thumbnail smart crop.')
+parser.add_argument('--width', type=int, default=800, help='Width of the images')
+parser.add_argument('--heights', metavar='N', type=int, nargs='+', default=[1000, 2000, 4000, 8000],
+                    help='Height of each image')
+parser.add_argument('--runs', type=int, default=3, help='Runs per image (the best one is reported)')
+args = parser.parse_args()
+
+
+def make_image(width, height):
+    """ A flat gray image with a band of noise in the lower half (the part the crop should keep) """
+    pixels = numpy.full((height, width, 3), 200, dtype=numpy.uint8)
+    start = height - width - height // 8
+    pixels[start:start + width] = numpy.random.randint(0, 256, (width, width, 3), dtype=numpy.uint8)
+    return Image.fromarray(pixels, 'RGB'), start
+
+
+numpy.random.seed(1)
+print("{0:>8} {1:>12} {2:>10} {3:>10}".format('height', 'best (ms)', 'band at', 'crop at'))
+for height in args.heights:
+    im, band = make_image(args.width, height)
+    best = None
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        cropped = smart_crop(im)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # Find where the crop starts by looking for its first row in the original image
+    rows = numpy.asarray(im)
+    top = int(numpy.flatnonzero((rows == numpy.asarray(cropped)[0]).all(axis=(1, 2)))[0])
+    print("{0:>8} {1:>12.2f} {2:>10} {3:>10}".format(height, best * 1000, band, top))
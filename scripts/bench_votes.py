@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Benchmarks cast_vote with concurrent gevent clients against the configured (local!) database.
+Creates a throwaway sub, post and users, votes on the post at random and removes everything at the end,
+including what the votes added to redis (rankings, site stats, user snapshots). """
+import __fix
+from gevent import monkey
+monkey.patch_all()
+import argparse  # noqa
+import datetime  # noqa
+import random  # noqa
+import time  # noqa
+import uuid  # noqa
+
+import gevent  # noqa
+from app import create_app, misc, ranking, sitestats, userstats, votebuffer  # noqa
+from app.models import rconn, User, Sub, SubPost, SubPostVote  # noqa
+
+parser = argparse.ArgumentParser(description='Benchmark the vote write path.')
+parser.add_argument('--clients', type=int, default=20, help='Concurrent clients')
+parser.add_argument('--votes', type=int, default=2000, help='Votes cast by every client')
+parser.add_argument('--users', type=int, default=50, help='Users voting (fewer users means more races)')
+args = parser.parse_args()
+
+app = create_app()
+
+
+def client(uids, pid, count):
+    with app.test_request_context():
+        for _ in range(count):
+            misc.cast_vote(random.choice(uids), 'post', pid, random.choice(('up', 'down')))
+
+
+def flush_votes():
+    """ With votes.write_behind the counters are still in redis """
+    if votebuffer.enabled():
+        while votebuffer.flush() is not None:
+            pass
+
+
+with app.app_context():
+    tag = uuid.uuid4().hex[:8]
+    uids = [str(uuid.uuid4()) for _ in range(args.users)]
+    User.insert_many([{'uid': uid, 'name': 'bench_{0}_{1}'.format(tag, i), 'crypto': 1, 'language': 'en',
+                       'given': 1000000} for i, uid in enumerate(uids)]).execute()
+    sub = Sub.create(sid=str(uuid.uuid4()), name='bench_' + tag, title='Vote benchmark')
+    post = SubPost.create(sid=sub.sid, uid=uids[0], title='Vote benchmark', link=None, content='', ptype=0,
+                          posted=datetime.datetime.utcnow(), score=0, upvotes=0, downvotes=0, deleted=0, comments=0)
+    try:
+        start = time.perf_counter()
+        gevent.joinall([gevent.spawn(client, uids, post.pid, args.votes) for _ in range(args.clients)])
+        elapsed = time.perf_counter() - start
+
+        total = args.clients * args.votes
+        print("{0} votes by {1} clients in {2:.2f}s: {3:.0f} votes/s".format(total, args.clients, elapsed,
+                                                                               total / elapsed))
+        flush_votes()
+        post = SubPost.get(SubPost.pid == post.pid)
+        upvotes = SubPostVote.select().where((SubPostVote.pid == post.pid) & (SubPostVote.positive == 1)).count()
+        downvotes = SubPostVote.select().where((SubPostVote.pid == post.pid) & (SubPostVote.positive == 0)).count()
+        print("Counters: {0} up, {1} down, score {2}. Vote rows: {3} up, {4} down. {5}".format(
+            post.upvotes, post.downvotes, post.score, upvotes, downvotes,
+            'OK' if (post.upvotes, post.downvotes, post.score) == (upvotes, downvotes, upvotes - downvotes)
+            else 'MISMATCH'))
+    finally:
+        flush_votes()
+        # cast_vote added the net votes to the site stats
+        upvotes = SubPostVote.select().where((SubPostVote.pid == post.pid) & (SubPostVote.positive == 1)).count()
+        downvotes = SubPostVote.select().where((SubPostVote.pid == post.pid) & (SubPostVote.positive == 0)).count()
+        sitestats.incr(upvotes=-upvotes, downvotes=-downvotes)
+        ranking.remove_post(post.pid, sub.sid)
+        userstats.reset(*uids)
+        for uid in uids:
+            for key in rconn.scan_iter('user/{0}/*'.format(uid)):
+                rconn.delete(key)
+        SubPostVote.delete().where(SubPostVote.pid == post.pid).execute()
+        SubPost.delete().where(SubPost.pid == post.pid).execute()
+        Sub.delete().where(Sub.sid == sub.sid).execute()
+        User.delete().where(User.uid << uids).execute()
+print("Done.")
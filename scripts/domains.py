@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import __fix
+import argparse
+from collections import Counter
+
+from app.models import Sub, SubPost
+from app.misc import iter_domain_posts
+from app import ranking, search
+
+parser = argparse.ArgumentParser(description='Find (and optionally delete) the posts linking to a domain, '
+                                             'e.g. after banning it.')
+parser.add_argument('domain', help='Domain to look for. Subdomains are included')
+parser.add_argument('--delete', action='store_true', help='Delete the posts (as if an admin did it)')
+parser.add_argument('--batch-size', type=int, default=500, help='Posts loaded at once')
+args = parser.parse_args()
+
+total = 0
+for posts in iter_domain_posts(args.domain, args.batch_size):
+    for post in posts:
+        print(post.pid, post.link)
+    total += len(posts)
+    if args.delete:
+        SubPost.update(deleted=2).where(SubPost.pid << [x.pid for x in posts]).execute()
+        for sid, count in Counter(x.sid_id for x in posts).items():
+            Sub.update(posts=Sub.posts - count).where(Sub.sid == sid).execute()
+        for post in posts:
+            ranking.remove_post(post.pid, post.sid_id)
+            search.remove_post(post.pid)
+
+print("{0} posts {1}.".format(total, 'deleted' if args.delete else 'found'))
+print("Done.")
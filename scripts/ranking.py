@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+import __fix
+import argparse
+
+from app import ranking
+
+parser = argparse.ArgumentParser(description='Manage the post rankings stored in redis.')
+parser.add_argument('--rebuild', action='store_true', help='Rebuild the rankings from the database')
+args = parser.parse_args()
+
+if args.rebuild:
+    ranking.rebuild()
+    print("Done.")
+else:
+    print("Rankings are " + ("ready." if ranking.is_ready() else "not built. Use --rebuild to build them."))
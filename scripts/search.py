@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+import __fix
+import argparse
+
+from app import search
+
+parser = argparse.ArgumentParser(description='Manage the post search index.')
+parser.add_argument('--rebuild', action='store_true', required=True,
+                    help='Index all the posts from scratch (new and edited posts are indexed as they come)')
+args = parser.parse_args()
+
+print("Indexed {0} posts.".format(search.rebuild()))
+print("Done.")
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+import __fix
+import argparse
+
+from app import sitestats
+
+parser = argparse.ArgumentParser(description='Manage the site counters shown in the admin dashboard.')
+action = parser.add_mutually_exclusive_group(required=True)
+action.add_argument('--recount', action='store_true',
+                    help='Count everything in the database and reset the totals. Slow on big sites')
+action.add_argument('--rollup', action='store_true',
+                    help='Move the daily counters of past days to the database (the dashboard does it too)')
+args = parser.parse_args()
+
+if args.recount:
+    for counter, total in sitestats.recount().items():
+        print("  ", counter, total)
+else:
+    sitestats.rollup()
+print("Done.")
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+""" Fetches the thumbnails of new posts. Run one or more of these next to the app. """
+import __fix
+from gevent import monkey
+monkey.patch_all()
+from app import create_app, thumbnails  # noqa
+
+app = create_app()
+
+with app.app_context():
+    thumbnails.work()
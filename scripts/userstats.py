@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+import __fix
+import argparse
+import sys
+
+from peewee import fn
+from app.models import User
+from app import userstats
+
+parser = argparse.ArgumentParser(description='Manage the activity counters shown in the user profiles.')
+parser.add_argument('--user', metavar='USERNAME', help='Only rebuild the counters of this user')
+parser.add_argument('--rebuild', action='store_true', required=True,
+                    help='Rebuild the counters (everybody\'s are rebuilt from the database as they\'re needed)')
+args = parser.parse_args()
+
+if args.user:
+    try:
+        user = User.get(fn.Lower(User.name) == args.user.lower())
+    except User.DoesNotExist:
+        print("Error: User does not exist")
+        sys.exit(1)
+    userstats.reset(user.uid)
+    print(userstats.rebuild(user.uid))
+else:
+    userstats.reset()
+print("Done.")
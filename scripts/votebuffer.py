@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+""" Writes the buffered vote counters to the database. Only needed if `votes.write_behind` is enabled. """
+import __fix
+from gevent import monkey
+monkey.patch_all()
+from app import create_app, votebuffer  # noqa
+
+app = create_app()
+
+with app.app_context():
+    votebuffer.work()
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+""" Removes the votes of the users queued with the admin "Remove votes" button. Run it next to the app. """
+import __fix
+from gevent import monkey
+monkey.patch_all()
+from app import create_app, voteundo  # noqa
+
+app = create_app()
+
+with app.app_context():
+    voteundo.work()